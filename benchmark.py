@@ -0,0 +1,1957 @@
+# benchmark.py - Заміри швидкодії шару БД на тимчасовій базі
+#
+# Запуск:
+#   python benchmark.py pool [--iterations N]
+#   python benchmark.py explain [--lessons N]
+#   python benchmark.py replay [--save FILE | --check FILE] [--repeat N]
+#   python benchmark.py dispatch [--iterations N]
+#   python benchmark.py instructors [--iterations N]
+#   python benchmark.py ratings [--lessons N] [--iterations N]
+#   python benchmark.py report [--lessons N] [--seeds N]
+#   python benchmark.py export [--lessons N] [--days N]
+#   python benchmark.py latency [--lessons N] [--duration S] [--rate N] [--slow-rate N]
+#   python benchmark.py seed --output FILE [--instructors N] [--lessons N] [--years N]
+#   python benchmark.py wal [--lessons N] [--writers N] [--readers N] [--duration S]
+#   python benchmark.py booking [--users N] [--rtt-ms MS] [--duration S]
+#   python benchmark.py suite [--db FILE | --instructors N --lessons N --years N] [--save FILE] [--compare FILE]
+#   python benchmark.py concurrency [--slots N] [--delay S]
+import argparse
+import ast
+import asyncio
+import json
+import os
+import pickle
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import database
+
+INSTRUCTORS = [
+    (1001, 'Інструктор А', 'Автомат'),
+    (1002, 'Інструктор Б', 'Автомат'),
+    (1003, 'Інструктор В', 'Механіка'),
+    (1004, 'Інструктор Г', 'Механіка'),
+]
+DURATIONS = ["1 година", "2 години", "1.5 години"]
+
+# ======================= ПІДГОТОВКА БД =======================
+def create_database(path, lessons=2000, seed=42):
+    """Створити схему як у main() та заповнити її уроками й блокуваннями"""
+    database.DB_NAME = path
+    database.init_db()
+    database.init_lessons_table()
+    database.init_students_table()
+    database.migrate_database()
+    database.init_schedule_blocks_table()
+    database.init_persistence_table()
+    database.init_availability_table()
+
+    rnd = random.Random(seed)
+    today = date.today()
+
+    with database.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO instructors (telegram_id, name, transmission_type) VALUES (?, ?, ?)",
+            INSTRUCTORS
+        )
+        cursor.execute("SELECT id FROM instructors")
+        instructor_ids = [row[0] for row in cursor.fetchall()]
+
+        rows = []
+        for _ in range(lessons):
+            lesson_date = today + timedelta(days=rnd.randint(-365, 30))
+            hour = rnd.randint(8, 17)
+            status = rnd.choice(['active', 'completed', 'completed', 'cancelled'])
+            duration = rnd.choice(DURATIONS)
+            rows.append((
+                rnd.choice(instructor_ids),
+                "Учень",
+                rnd.randint(1, 500),
+                lesson_date.strftime('%d.%m.%Y'),
+                lesson_date.strftime('%Y-%m-%d'),
+                f"{hour:02d}:00",
+                f"{lesson_date:%Y-%m-%d} {hour:02d}:00",
+                duration,
+                database.duration_to_minutes(duration),
+                status,
+                rnd.choice([None, 3, 4, 5, 5]) if status == 'completed' else None,
+            ))
+        cursor.executemany("""
+            INSERT INTO lessons (instructor_id, student_name, student_telegram_id, date, date_iso, time, starts_at,
+                                 duration, duration_minutes, status, rating)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+
+        blocks = []
+        for _ in range(lessons // 20):
+            block_date = today + timedelta(days=rnd.randint(-30, 30))
+            hour = rnd.randint(8, 16)
+            blocks.append((
+                rnd.choice(instructor_ids),
+                block_date.strftime('%Y-%m-%d'),
+                f"{hour:02d}:00",
+                f"{hour + 1:02d}:00",
+                "blocked",
+            ))
+        cursor.executemany("""
+            INSERT INTO schedule_blocks (instructor_id, date, time_start, time_end, block_type)
+            VALUES (?, ?, ?, ?, ?)
+        """, blocks)
+        conn.commit()
+    database.invalidate_instructor_cache()
+
+@contextmanager
+def connect_per_call_db():
+    """Поведінка get_db до пулу: нове з'єднання на кожен виклик"""
+    conn = sqlite3.connect(database.DB_NAME)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def booking_flow(student_id):
+    """Запити одного проходу запису: інструктор → дати → час → перевірка → запис"""
+    name = random.choice(INSTRUCTORS)[1]
+    instructor_id, _ = database.get_instructor_by_name(name)
+    database.get_instructor_rating(name)
+    dates = [date.today() + timedelta(days=i) for i in range(14)]
+    database.get_instructor_busy_schedule(instructor_id, dates)
+    lesson_day = random.choice(dates)
+    lesson_date = lesson_day.strftime('%d.%m.%Y')
+    database.is_time_slot_available(instructor_id, lesson_date, "10:00", "1 година")
+    database.get_student_by_telegram_id(student_id)
+    with database.get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("""
+            INSERT INTO lessons (instructor_id, student_name, student_telegram_id, date, date_iso, time, starts_at,
+                                 duration, duration_minutes, status)
+            VALUES (?, 'Учень', ?, ?, ?, '10:00', ?, '1 година', 60, 'active')
+        """, (instructor_id, student_id, lesson_date, f"{lesson_day:%Y-%m-%d}", f"{lesson_day:%Y-%m-%d} 10:00"))
+        conn.commit()
+
+def _time_flow(iterations):
+    started = time.perf_counter()
+    for i in range(iterations):
+        booking_flow(i)
+    return time.perf_counter() - started
+
+# ======================= БЕНЧМАРКИ =======================
+def bench_pool(args):
+    """Порівняння connect-per-call з пулом з'єднань на сценарії запису"""
+    with tempfile.TemporaryDirectory() as tmp:
+        create_database(os.path.join(tmp, "bench.db"), lessons=args.lessons)
+
+        pooled_get_db = database.get_db
+        results = {}
+        for label, get_db in (("connect-per-call", connect_per_call_db), ("pool", pooled_get_db)):
+            database.get_db = get_db
+            try:
+                _time_flow(10)  # прогрів
+                results[label] = _time_flow(args.iterations)
+            finally:
+                database.get_db = pooled_get_db
+
+        database.get_pool().close_all()
+
+    print(f"📊 Сценарій запису, {args.iterations} проходів, {args.lessons} уроків у БД")
+    for label, elapsed in results.items():
+        per_flow = elapsed / args.iterations * 1000
+        print(f"   {label:<18} {elapsed:7.3f} с  ({per_flow:.3f} мс/прохід)")
+    speedup = results["connect-per-call"] / results["pool"]
+    print(f"   Прискорення: x{speedup:.2f}")
+
+# ======================= ПЛАНИ ЗАПИТІВ =======================
+SOURCES = ("bot.py", "database.py")
+
+# Повне читання таблиці, яке закладене в сам запит
+FULL_SCAN_ALLOWED = {
+    "instructors": "довідник з кількох рядків",
+    "students": "пошук за телефоном через REPLACE/LIKE не індексується",
+    "sqlite_master": "перевірка доступності WAL у set_journal_mode, кілька рядків схеми",
+}
+# Запити, яким повне читання дозволене, — точний текст після нормалізації пробілів,
+# щоб виняток не поширювався на інші запити з таким самим фрагментом
+FULL_SCAN_ALLOWED_QUERIES = {
+    " ".join(sql.split()): reason for sql, reason in (
+        ("""SELECT i.name AS instructor_name, sb.date, sb.time_start, sb.time_end, sb.reason, sb.created_at
+            FROM schedule_blocks sb JOIN instructors i ON sb.instructor_id = i.id
+            ORDER BY sb.date DESC, sb.time_start""", "експорт блокувань — весь список"),
+        ("SELECT id, date, time FROM lessons WHERE starts_at IS NULL",
+         "бекфіл starts_at у migrate_database — один прохід при старті"),
+        ("SELECT id, duration FROM lessons WHERE duration_minutes IS NULL",
+         "бекфіл duration_minutes у migrate_database"),
+        ("SELECT instructor_id, date_iso, busy_mask FROM instructor_availability",
+         "перебудова масок вільних годин — усі дні з розкладу"),
+        ("SELECT instructor_id, date, time_start, time_end FROM schedule_blocks",
+         "перебудова масок вільних годин — усі блокування"),
+    )
+}
+
+# Підстановки для f-string запитів: {placeholders} у IN (...), ім'я поля-прапорця, SET оновлення.
+# f-string з іншими змінними не перевіряється — перевірка виводить їх окремим списком
+FSTRING_SAMPLES = {
+    "placeholders": "?, ?",
+    "flag": "reminder_24h_sent",
+    "set_clause": "status = ?",
+}
+
+# execute() курсора та awaitable-обгортки database.aio
+SQL_CALLS = ("execute", "executemany", "fetch_all", "fetch_one", "execute_write")
+
+def render_fstring(node):
+    """Текст f-string запиту з FSTRING_SAMPLES замість підстановок; None, якщо підстановка невідома"""
+    parts = []
+    for value in node.values:
+        if isinstance(value, ast.Constant):
+            parts.append(value.value)
+        elif isinstance(value.value, ast.Name) and value.value.id in FSTRING_SAMPLES:
+            parts.append(FSTRING_SAMPLES[value.value.id])
+        else:
+            return None
+    return "".join(parts)
+
+def collect_queries():
+    """SQL SELECT/UPDATE/DELETE з execute()/aio.fetch_*() та констант *_SQL у bot.py та database.py.
+
+    Повертає (запити, неперевірені): f-string з підстановками поза FSTRING_SAMPLES
+    і запити, зібрані в змінну, не розібрати — їх місця йдуть у другий список.
+    """
+    base = os.path.dirname(os.path.abspath(__file__))
+    queries, unchecked = [], []
+    for filename in SOURCES:
+        with open(os.path.join(base, filename), encoding="utf-8") as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            # Запити, винесені в константи модуля (EXPORT_LESSONS_SQL тощо)
+            if (isinstance(node, ast.Assign) and len(node.targets) == 1
+                    and getattr(node.targets[0], "id", "").endswith("_SQL")):
+                literal = node.value
+            elif isinstance(node, ast.Call) and getattr(node.func, "attr", None) in SQL_CALLS:
+                literal = node.args[0] if node.args else None
+            else:
+                continue
+            if isinstance(literal, ast.JoinedStr):
+                text = render_fstring(literal)
+                if text is None:
+                    sql = " ".join(ast.unparse(literal).split())
+                    if re.match(r"f['\"](SELECT|UPDATE|DELETE)\b", sql, re.IGNORECASE):
+                        unchecked.append(f"{filename}:{node.lineno}")
+                    continue
+            elif isinstance(literal, ast.Constant) and isinstance(literal.value, str):
+                text = literal.value
+            else:
+                continue
+            sql = " ".join(re.sub(r"--[^\n]*", "", text).split())
+            if re.match(r"(SELECT|UPDATE|DELETE)\b", sql, re.IGNORECASE):
+                queries.append((f"{filename}:{node.lineno}", sql))
+    return queries, unchecked
+
+def table_aliases(sql):
+    """{alias або ім'я таблиці: таблиця} для FROM/JOIN/UPDATE"""
+    aliases = {}
+    for table, alias in re.findall(r"\b(?:FROM|JOIN|UPDATE)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", sql, re.IGNORECASE):
+        aliases[table] = table
+        if alias and alias.upper() not in ("WHERE", "SET", "ON", "ORDER", "GROUP", "LEFT", "JOIN", "LIMIT"):
+            aliases[alias] = table
+    return aliases
+
+def full_scans(conn, sql):
+    """Таблиці, які план запиту читає повністю"""
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count("?")).fetchall()
+    aliases = table_aliases(sql)
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        match = re.match(r"SCAN (\w+)", detail)
+        if match:
+            scans.append((aliases.get(match.group(1), match.group(1)), detail))
+    return scans
+
+def bench_explain(args):
+    """EXPLAIN QUERY PLAN для кожного запиту: жодного повного сканування lessons/schedule_blocks"""
+    queries, unchecked = collect_queries()
+    failures, skipped = [], []
+    with tempfile.TemporaryDirectory() as tmp:
+        create_database(os.path.join(tmp, "explain.db"), lessons=args.lessons)
+        with database.get_db() as conn:
+            for location, sql in queries:
+                try:
+                    scans = full_scans(conn, sql)
+                except sqlite3.OperationalError as e:
+                    skipped.append((location, str(e)))
+                    continue
+                if sql in FULL_SCAN_ALLOWED_QUERIES:
+                    continue
+                for table, detail in scans:
+                    if table not in FULL_SCAN_ALLOWED:
+                        failures.append((location, detail, sql))
+        database.get_pool().close_all()
+
+    print(f"🔎 Перевірено {len(queries)} запитів на БД з {args.lessons} уроків")
+    for location, error in skipped:
+        print(f"   ⚠️ {location}: пропущено ({error})")
+    stale = set(FULL_SCAN_ALLOWED_QUERIES) - {sql for _, sql in queries}
+    for sql in sorted(stale):
+        print(f"   ⚠️ виняток FULL_SCAN_ALLOWED_QUERIES не відповідає жодному запиту: {sql[:120]}")
+    if unchecked:
+        print(f"   ⚠️ f-string з підстановками поза FSTRING_SAMPLES не перевірено: {', '.join(unchecked)}")
+    print("   ℹ️ SQL, зібраний у змінну (не літерал у виклику і не константа *_SQL), не перевіряється")
+    for location, detail, sql in failures:
+        print(f"   ❌ {location}: {detail}\n      {sql[:160]}")
+    if failures:
+        print(f"❌ Повне сканування таблиці: {len(failures)}")
+        sys.exit(1)
+    print("✅ Повних сканувань lessons/schedule_blocks немає")
+
+# ======================= REPLAY =======================
+# Записані послідовності повідомлень. "/start" — команда, "#pick N" — N-та кнопка
+# останньої клавіатури, "#job <name>" — запуск фонової задачі бота.
+STUDENT_ID, STUDENT2_ID = 5001, 5002
+INSTRUCTOR_ID = 197658460        # Урядко Артур
+ADMIN_INSTRUCTOR_ID = 669706811  # адмін і інструктор (Тест Тест)
+ADMIN_ONLY_ID = 280240917
+
+REPLAY_SCENARIOS = [
+    (STUDENT_ID, [
+        "/start", "привіт", "🚀 Записатися на заняття", "🚙 Мотоцикл", "🚗 Автомат",
+        "#pick 0", "31.12.2099", "#pick 2", "25:00", "#pick 0", "3 години", "2 години",
+        "💬 Додати коментар", "🔙 Назад", "✏️ Змінити коментар", "Перше заняття", "✅ Підтвердити",
+        "📋 Мої записи", "📊 Моя статистика", "❌ Скасувати запис", "9", "1", "✅ Так, скасувати",
+    ]),
+    (STUDENT2_ID, [
+        "/start", "#job check_completed", "⭐⭐⭐⭐", "✍️ Написати коментар", "Все супер",
+        "⭐⭐", "⏭️ Пропустити", "🔙 Назад",
+    ]),
+    (INSTRUCTOR_ID, [
+        "/start", "📅 Мій розклад", "📅 На тиждень", "📅 Мій розклад", "📅 Свій період",
+        "01.03.2026 - 31.03.2026", "🔙 Назад", "📊 Моя статистика", "#pick 0", "🔙 Назад",
+        "⚙️ Управління графіком", "📋 Мої блокування", "🔙 Назад", "❌ Історія скасувань",
+        "⭐ Оцінити учня", "🔙 Назад", "🚗 Автомат", "#pick 0", "🔙 Назад", "🔙 Назад",
+    ]),
+    (ADMIN_INSTRUCTOR_ID, [
+        "/start", "📊 Моя статистика", "🔙 Назад", "🔐 Панель адміна", "✏️ Управління записами",
+        "❌ Скасувати запис учня", "#pick 0", "#pick 0", "🔙 Назад", "🔙 Назад", "🔙 Назад",
+    ]),
+    (ADMIN_ONLY_ID, [
+        "/start", "🔐 Панель адміна", "➕ Додати учня", "🔙 Назад", "/start",
+        "📥 Експорт в Excel", "🔙 Назад", "🔙 Назад",
+    ]),
+    (424242, ["/start", "🔐 Панель адміна", "📅 Мій розклад", "щось", "⭐"]),
+    (STUDENT2_ID, [
+        "🚀 Записатися на заняття", "🚙 Механіка", "⚡ Найближчий вільний час", "🔙 Назад",
+        "⚡ Найближчий вільний час", "щось", "#pick 1", "1 година", "🔙 Скасувати",
+    ]),
+]
+REPLAY_NOW = datetime(2026, 3, 2, 9, 15)
+# Еталонна стенограма: replay без аргументів порівнює з нею, replay --save перезаписує
+REPLAY_TRANSCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "replay_transcript.json")
+
+class ReplayUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.first_name = f"User{user_id}"
+        self.last_name = None
+        self.username = None
+
+class ReplayMessage:
+    def __init__(self, user, text, transcript):
+        self.from_user = user
+        self.chat_id = user.id
+        self.text = text
+        self.contact = None
+        self._transcript = transcript
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        self._transcript.append(("reply", text, describe_markup(reply_markup)))
+
+class ReplayBot:
+    def __init__(self, transcript):
+        self._transcript = transcript
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self._transcript.append(("send", chat_id, text, describe_markup(reply_markup)))
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        self._transcript.append(("document", chat_id, filename))
+
+class ReplayUpdate:
+    def __init__(self, message, bot):
+        self.message = message
+        self._bot = bot
+
+    def get_bot(self):
+        return self._bot
+
+class ReplayApplication:
+    persistence = None
+
+class ReplayContext:
+    def __init__(self, bot, user_data, bot_data):
+        self.bot = bot
+        self.user_data = user_data
+        self.bot_data = bot_data
+        self.args = []
+        self.job_queue = None
+        self.application = ReplayApplication()
+
+def describe_markup(markup):
+    """Кнопки клавіатури як список рядків (для порівняння і #pick)"""
+    if markup is None:
+        return None
+    rows = getattr(markup, "keyboard", None) or getattr(markup, "inline_keyboard", None)
+    if rows is None:
+        return type(markup).__name__
+    return [[getattr(button, "text", button) for button in row] for row in rows]
+
+def freeze_time(bot, now):
+    """Підміняє datetime у bot.py: now() завжди повертає REPLAY_NOW"""
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return tz.localize(now) if tz else now
+    bot.datetime = FrozenDatetime
+
+def seed_replay_database(bot, path):
+    database.DB_NAME = path
+    bot.DB_NAME = path
+    database.init_db()
+    database.init_lessons_table()
+    database.init_students_table()
+    database.migrate_database()
+    database.init_schedule_blocks_table()
+    database.init_persistence_table()
+    database.init_availability_table()
+    bot.ensure_instructors_exist()
+    database.register_student("Учень Один", "+380501111111", STUDENT_ID, 490, "link_490")
+    database.register_student("Учень Два", "+380502222222", STUDENT2_ID, 550, "link_550")
+
+    lessons = [
+        (INSTRUCTOR_ID, "Учень Два", STUDENT2_ID, 0, "08:00", "1 година", "active"),
+        (INSTRUCTOR_ID, "Учень Один", STUDENT_ID, 1, "10:00", "1 година", "active"),
+        (INSTRUCTOR_ID, "Учень Один", STUDENT_ID, 3, "12:00", "2 години", "active"),
+        (INSTRUCTOR_ID, "Учень Два", STUDENT2_ID, -3, "09:00", "1 година", "completed"),
+        (INSTRUCTOR_ID, "Учень Два", STUDENT2_ID, -2, "11:00", "1 година", "cancelled"),
+        (ADMIN_INSTRUCTOR_ID, "Учень Два", STUDENT2_ID, 2, "14:00", "1 година", "active"),
+    ]
+    with database.get_db() as conn:
+        cursor = conn.cursor()
+        for telegram_id, name, student_id, day, time_str, duration, status in lessons:
+            instructor_id, _ = database.get_instructor_by_name(
+                cursor.execute("SELECT name FROM instructors WHERE telegram_id = ?", (telegram_id,)).fetchone()[0]
+            )
+            lesson_day = REPLAY_NOW.date() + timedelta(days=day)
+            cursor.execute("""
+                INSERT INTO lessons (instructor_id, student_name, student_telegram_id, date, date_iso, time,
+                                     starts_at, duration, duration_minutes, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (instructor_id, name, student_id, lesson_day.strftime('%d.%m.%Y'), f"{lesson_day:%Y-%m-%d}",
+                  time_str, f"{lesson_day:%Y-%m-%d} {time_str}", duration, database.duration_to_minutes(duration),
+                  status))
+        conn.commit()
+    database.add_schedule_block(
+        database.get_instructor_by_name("Урядко Артур")[0],
+        f"{REPLAY_NOW.date() + timedelta(days=1):%Y-%m-%d}", "14:00", "16:00", "blocked", "Техогляд"
+    )
+
+async def run_replay(bot):
+    """Прогнати сценарії; повертає (стенограма, час обробки кожного повідомлення)"""
+    transcript = []
+    timings = []
+    bot_data = {}
+    replay_bot = ReplayBot(transcript)
+    for user_id, steps in REPLAY_SCENARIOS:
+        user = ReplayUser(user_id)
+        user_data = {}
+        for step in steps:
+            transcript.append(("in", user_id, step))
+            context = ReplayContext(replay_bot, user_data, bot_data)
+            if step.startswith("#job "):
+                context.job = None
+                await getattr(bot, f"{step.split()[1]}_lessons")(context)
+                continue
+            if step.startswith("#pick "):
+                keyboards = [entry[-1] for entry in transcript if entry[0] == "reply" and isinstance(entry[-1], list)]
+                buttons = [text for row in keyboards[-1] for text in row] if keyboards else []
+                index = int(step.split()[1])
+                step = buttons[index] if index < len(buttons) else ""
+                transcript.append(("picked", step))
+            update = ReplayUpdate(ReplayMessage(user, step, transcript), replay_bot)
+            started = time.perf_counter()
+            if step == "/start":
+                await bot.start(update, context)
+            else:
+                await bot.handle_message(update, context)
+                timings.append(time.perf_counter() - started)
+            transcript.append(("state", user_data.get("state")))
+
+    with database.get_db() as conn:
+        for row in conn.execute("""
+            SELECT id, instructor_id, student_telegram_id, date, time, duration, status,
+                   rating, feedback, booking_comment, cancelled_by
+            FROM lessons ORDER BY id
+        """):
+            transcript.append(("lesson",) + tuple(row))
+    return transcript, timings
+
+def bench_replay(args):
+    """Повтор записаних сценаріїв: стенограма відповідей та час на повідомлення"""
+    import logging
+    logging.disable(logging.CRITICAL)
+    import bot
+
+    freeze_time(bot, REPLAY_NOW)
+    all_timings = []
+    transcript = None
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as tmp:
+            seed_replay_database(bot, os.path.join(tmp, "replay.db"))
+            transcript, timings = asyncio.run(run_replay(bot))
+            all_timings.extend(timings)
+            database.get_pool().close_all()
+    # CURRENT_TIMESTAMP з БД (cancelled_at тощо) — реальний час, а не REPLAY_NOW
+    dumped = json.dumps(transcript, ensure_ascii=False, default=str)
+    for real_day in {date.today(), datetime.utcnow().date()}:
+        dumped = re.sub(rf"{real_day:%Y-%m-%d} \d\d:\d\d(:\d\d)?", "<now>", dumped)
+    transcript = json.loads(dumped)
+
+    all_timings.sort()
+    print(f"🔁 {len(all_timings)} повідомлень, {len(transcript)} записів стенограми")
+    print(f"   середнє {sum(all_timings) / len(all_timings) * 1000:.3f} мс, "
+          f"медіана {all_timings[len(all_timings) // 2] * 1000:.3f} мс")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(transcript, f, ensure_ascii=False, indent=1)
+            f.write("\n")
+        print(f"💾 Стенограму збережено: {args.save}")
+    check = args.check or (None if args.save else REPLAY_TRANSCRIPT)
+    if check:
+        with open(check, encoding="utf-8") as f:
+            expected = json.load(f)
+        for index, (got, want) in enumerate(zip(transcript, expected)):
+            if got != want:
+                print(f"❌ Розбіжність у записі {index}:\n   було:  {want}\n   стало: {got}")
+                sys.exit(1)
+        if len(transcript) != len(expected):
+            print(f"❌ Різна довжина стенограми: {len(expected)} → {len(transcript)}")
+            sys.exit(1)
+        print("✅ Поведінка збігається зі збереженою стенограмою")
+
+# Повідомлення, які не змінюють стан і не звертаються до БД: їх час — це чиста маршрутизація
+DISPATCH_PROBES = [
+    ("", "щось"),
+    ("", "⭐"),
+    ("rating_feedback", "текст"),
+    ("waiting_for_confirmation", "текст"),
+    ("instructor_schedule_menu", "текст"),
+    ("unknown_state", "текст"),
+]
+
+def bench_dispatch(args):
+    """Час маршрутизації handle_message на повідомленнях, що проходять всі перевірки"""
+    import logging
+    logging.disable(logging.CRITICAL)
+    import bot
+
+    transcript = []
+    replay_bot = ReplayBot(transcript)
+    user = ReplayUser(424242)
+
+    async def run():
+        results = {}
+        for state, text in DISPATCH_PROBES:
+            context = ReplayContext(replay_bot, {"state": state}, {})
+            update = ReplayUpdate(ReplayMessage(user, text, transcript), replay_bot)
+            started = time.perf_counter()
+            for _ in range(args.iterations):
+                await bot.handle_message(update, context)
+            results[(state, text)] = (time.perf_counter() - started) / args.iterations
+        return results
+
+    results = asyncio.run(run())
+    if transcript:
+        print(f"⚠️ Проби дали відповіді: {transcript[:3]}")
+    print(f"🧭 Маршрутизація, {args.iterations} повторів на пробу")
+    for (state, text), elapsed in results.items():
+        print(f"   {state or '—':<28} {text:<8} {elapsed * 1e6:7.2f} мкс")
+    print(f"   середнє {sum(results.values()) / len(results) * 1e6:.2f} мкс/повідомлення")
+
+def bench_instructors(args):
+    """Запити до instructors у сценаріях replay та час одного пошуку з кешем і без"""
+    import logging
+    logging.disable(logging.CRITICAL)
+    import bot
+
+    statements = []
+    connect = database.ConnectionPool._connect
+
+    def traced_connect(pool):
+        conn = connect(pool)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    freeze_time(bot, REPLAY_NOW)
+    database.ConnectionPool._connect = traced_connect
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            seed_replay_database(bot, os.path.join(tmp, "replay.db"))
+            database.invalidate_instructor_cache()
+            stats_before = dict(database.INSTRUCTOR_CACHE_STATS)
+            statements.clear()
+            _, timings = asyncio.run(run_replay(bot))
+            directory_queries = [sql for sql in statements if re.search(r"\bFROM instructors\b", sql)]
+            hits = database.INSTRUCTOR_CACHE_STATS['hits'] - stats_before['hits']
+            misses = database.INSTRUCTOR_CACHE_STATS['misses'] - stats_before['misses']
+            print(f"🔁 {len(timings)} повідомлень: {len(statements)} SQL-запитів, "
+                  f"з них до instructors {len(directory_queries)}")
+            print(f"   кеш довідника: {hits} влучань, {misses} промахів")
+
+            lookups = [
+                ("get_instructor_by_telegram_id", lambda: database.get_instructor_by_telegram_id(INSTRUCTOR_ID)),
+                ("get_instructor_by_name", lambda: database.get_instructor_by_name("Урядко Артур")),
+                ("get_instructors_by_transmission", lambda: database.get_instructors_by_transmission("Механіка")),
+                ("get_all_instructors", database.get_all_instructors),
+            ]
+            print(f"⏱️ Один пошук, {args.iterations} повторів")
+            for name, lookup in lookups:
+                started = time.perf_counter()
+                for _ in range(args.iterations):
+                    database.invalidate_instructor_cache()
+                    lookup()
+                uncached = (time.perf_counter() - started) / args.iterations
+                started = time.perf_counter()
+                for _ in range(args.iterations):
+                    lookup()
+                cached = (time.perf_counter() - started) / args.iterations
+                print(f"   {name:<32} з БД {uncached * 1e6:8.1f} мкс   з кешу {cached * 1e6:6.2f} мкс")
+            database.get_pool().close_all()
+    finally:
+        database.ConnectionPool._connect = connect
+
+    if directory_queries and len(directory_queries) > misses:
+        print("❌ Довідник інструкторів читається з БД повз кеш:")
+        for sql in directory_queries:
+            print(f"   {' '.join(sql.split())[:120]}")
+        sys.exit(1)
+
+# Середній рейтинг до агрегатів: AVG по всій історії уроків інструктора
+LEGACY_RATING_SQL = """
+    SELECT AVG(rating)
+    FROM lessons l
+    JOIN instructors i ON l.instructor_id = i.id
+    WHERE i.name = ? AND l.rating IS NOT NULL
+"""
+
+def legacy_ratings(names):
+    with database.get_db() as conn:
+        ratings = {}
+        for name in names:
+            result = conn.execute(LEGACY_RATING_SQL, (name,)).fetchone()
+            ratings[name] = round(result[0], 1) if result and result[0] else 0
+        return ratings
+
+def bench_ratings(args):
+    """Рейтинги для вибору інструктора: AVG на кожного проти агрегатів; агрегати сходяться з lessons"""
+    rnd = random.Random(7)
+    with tempfile.TemporaryDirectory() as tmp:
+        create_database(os.path.join(tmp, "ratings.db"), lessons=args.lessons)
+        names = [name for _, name, _ in INSTRUCTORS]
+
+        results = {}
+        for label, fetch in (("AVG на інструктора", legacy_ratings), ("агрегати", database.get_instructor_ratings)):
+            fetch(names)  # прогрів
+            started = time.perf_counter()
+            for _ in range(args.iterations):
+                ratings = fetch(names)
+            results[label] = ((time.perf_counter() - started) / args.iterations, ratings)
+
+        # Всі шляхи запису, що зачіпають оцінку: оцінка учня, повторна оцінка, перенесення, видалення
+        with database.get_db() as conn:
+            lesson_ids = [row[0] for row in conn.execute("SELECT id FROM lessons WHERE status = 'completed'")]
+        instructor_ids = [database.get_instructor_by_name(name)[0] for name in names]
+        for lesson_id in rnd.sample(lesson_ids, min(200, len(lesson_ids))):
+            action = rnd.choice(("rate", "rate", "move", "delete", "clear"))
+            if action == "rate":
+                database.add_lesson_rating(lesson_id, rnd.randint(1, 5))
+            elif action == "move":
+                database.update_lesson(lesson_id, instructor_id=rnd.choice(instructor_ids))
+            elif action == "clear":
+                database.update_lesson(lesson_id, rating=None)
+            else:
+                with database.get_db() as conn:
+                    conn.execute("DELETE FROM lessons WHERE id = ?", (lesson_id,))
+                    conn.commit()
+        after_writes = database.get_instructor_ratings(names)
+        expected = legacy_ratings(names)
+        drifted = database.rebuild_instructor_ratings()
+        database.get_pool().close_all()
+
+    print(f"⭐ Рейтинги {len(names)} інструкторів, {args.lessons} уроків, {args.iterations} повторів")
+    for label, (elapsed, _) in results.items():
+        print(f"   {label:<20} {elapsed * 1000:8.3f} мс")
+    print(f"   Прискорення: x{results['AVG на інструктора'][0] / results['агрегати'][0]:.1f}")
+
+    mismatches = [label for label, (_, ratings) in results.items() if ratings != results['AVG на інструктора'][1]]
+    if mismatches or after_writes != expected or drifted:
+        print(f"❌ Агрегати розходяться з AVG: {after_writes} != {expected}, перебудова виправила {drifted}")
+        sys.exit(1)
+    print("✅ Агрегати збігаються з AVG до і після 200 змін, перебудова не знайшла розбіжностей")
+
+def legacy_admin_report(date_from, date_to):
+    """get_admin_report_by_instructors до групового запиту: вибірка і підсумки в Python на кожного"""
+    with database.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name FROM instructors ORDER BY name")
+        result = []
+        for inst_id, inst_name in cursor.fetchall():
+            cursor.execute("""
+                SELECT date, duration, status, rating
+                FROM lessons
+                WHERE instructor_id = ?
+                AND date_iso BETWEEN ? AND ?
+                AND status IN ('active', 'completed', 'cancelled')
+            """, (inst_id, date_from, date_to))
+            lessons_in_range = cursor.fetchall()
+            total_lessons = len([l for l in lessons_in_range if l[2] != 'cancelled'])
+            cancelled = len([l for l in lessons_in_range if l[2] == 'cancelled'])
+            total_hours = 0
+            ratings = []
+            for _, duration, status, rating in lessons_in_range:
+                if status != 'cancelled':
+                    if duration and '1.5' in str(duration):
+                        total_hours += 1.5
+                    elif duration and '2' in str(duration):
+                        total_hours += 2
+                    else:
+                        total_hours += 1
+                if rating:
+                    ratings.append(rating)
+            avg_rating = sum(ratings) / len(ratings) if ratings else 0
+            result.append((inst_name, total_lessons, total_hours, avg_rating, cancelled))
+        result.sort(key=lambda x: x[2], reverse=True)
+        return result
+
+def add_report_edge_cases(rnd):
+    """Рідкісні значення, які звіт має рахувати так само: інші тривалості, оцінка 0, інші статуси"""
+    with database.get_db() as conn:
+        conn.execute("INSERT INTO instructors (telegram_id, name, transmission_type) VALUES (1099, 'Без уроків', 'Автомат')")
+        instructor_ids = [row[0] for row in conn.execute("SELECT id FROM instructors")]
+        rows = []
+        for _ in range(500):
+            lesson_day = date.today() + timedelta(days=rnd.randint(-400, 40))
+            duration = rnd.choice(["1.5 години", "2 години", "90 хв", "", "1 година"])
+            rows.append((
+                rnd.choice(instructor_ids), lesson_day.strftime('%d.%m.%Y'), f"{lesson_day:%Y-%m-%d}",
+                duration, database.duration_to_minutes(duration),
+                rnd.choice(["active", "completed", "cancelled", "pending"]),
+                rnd.choice([None, 0, 1, 2, 5]),
+            ))
+        conn.executemany("""
+            INSERT INTO lessons (instructor_id, student_name, date, date_iso, time, duration, duration_minutes,
+                                 status, rating)
+            VALUES (?, 'Учень', ?, ?, '10:00', ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+    database.invalidate_instructor_cache()
+
+def bench_report(args):
+    """Звіт адміна по інструкторах: еквівалентність старій реалізації та час на великій історії"""
+    checked = 0
+    for seed in range(args.seeds):
+        rnd = random.Random(seed)
+        with tempfile.TemporaryDirectory() as tmp:
+            create_database(os.path.join(tmp, "report.db"), lessons=rnd.randint(0, 3000), seed=seed)
+            add_report_edge_cases(rnd)
+            for _ in range(20):
+                start = date.today() + timedelta(days=rnd.randint(-420, 40))
+                date_from, date_to = f"{start:%Y-%m-%d}", f"{start + timedelta(days=rnd.randint(0, 120)):%Y-%m-%d}"
+                expected = legacy_admin_report(date_from, date_to)
+                got = database.get_admin_report_by_instructors(date_from, date_to)
+                if got != expected:
+                    print(f"❌ seed={seed} {date_from}..{date_to}\n   було:  {expected}\n   стало: {got}")
+                    sys.exit(1)
+                checked += 1
+            database.get_pool().close_all()
+    print(f"✅ {checked} випадкових періодів на {args.seeds} базах: звіт збігається зі старою реалізацією")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        create_database(os.path.join(tmp, "report.db"), lessons=args.lessons)
+        date_from, date_to = f"{date.today() - timedelta(days=30):%Y-%m-%d}", f"{date.today():%Y-%m-%d}"
+        results = {}
+        for label, report in (("N+1 запитів", legacy_admin_report), ("груповий запит", database.get_admin_report_by_instructors)):
+            report(date_from, date_to)  # прогрів
+            started = time.perf_counter()
+            for _ in range(20):
+                report(date_from, date_to)
+            results[label] = (time.perf_counter() - started) / 20
+        database.get_pool().close_all()
+
+    print(f"📋 Звіт за 30 днів, {args.lessons} уроків")
+    for label, elapsed in results.items():
+        print(f"   {label:<16} {elapsed * 1000:8.3f} мс")
+
+def legacy_export_lessons_sheet(date_from, date_to):
+    """Аркуш "Уроки" як до потокового експорту: вся історія через fetchall, фільтр strptime, ширини по комірках"""
+    from io import BytesIO
+    from openpyxl import Workbook
+
+    with database.get_db() as conn:
+        all_lessons = conn.execute("""
+            SELECT l.id, l.date, l.time, i.name, s.name, s.phone, s.tariff, l.duration,
+                   s.tariff * l.duration_minutes / 60.0, l.status, l.rating, l.feedback,
+                   l.instructor_rating, l.instructor_feedback
+            FROM lessons l
+            LEFT JOIN instructors i ON l.instructor_id = i.id
+            LEFT JOIN students s ON l.student_telegram_id = s.telegram_id
+            ORDER BY l.date DESC, l.time DESC
+        """).fetchall()
+    date_from_obj = datetime.strptime(date_from, "%d.%m.%Y")
+    date_to_obj = datetime.strptime(date_to, "%d.%m.%Y")
+    wb = Workbook()
+    ws = wb.active
+    for lesson in all_lessons:
+        try:
+            if date_from_obj <= datetime.strptime(lesson[1], "%d.%m.%Y") <= date_to_obj:
+                ws.append(lesson)
+        except (ValueError, TypeError):
+            continue
+    for column in ws.columns:
+        column = [cell for cell in column]
+        max_length = max(len(str(cell.value)) for cell in column)
+        ws.column_dimensions[column[0].column_letter].width = min(max_length + 2, 50)
+    excel_file = BytesIO()
+    wb.save(excel_file)
+    return excel_file
+
+def _measure(func, *args):
+    """(результат, секунди, пік пам'яті в МБ); пам'ять — окремим прогоном, tracemalloc сповільнює"""
+    import tracemalloc
+    started = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+async def _max_loop_stall(coro, tick=0.01):
+    """Найбільша затримка таймера event loop, поки виконується coro"""
+    stall = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal stall
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(tick)
+            stall = max(stall, time.perf_counter() - started - tick)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    try:
+        await coro
+    finally:
+        done.set()
+        await ticker_task
+    return stall
+
+def bench_export(args):
+    """Excel-експорт: потоковий write-only проти старого, пам'ять і блокування event loop"""
+    import logging
+    logging.disable(logging.CRITICAL)
+    from openpyxl import load_workbook
+    import bot
+
+    with tempfile.TemporaryDirectory() as tmp:
+        create_database(os.path.join(tmp, "export.db"), lessons=args.lessons)
+        with database.get_db() as conn:
+            conn.executemany(
+                "INSERT INTO students (name, phone, telegram_id, tariff) VALUES (?, ?, ?, ?)",
+                [(f"Учень {i}", f"+38050{i:07d}", i, 490) for i in range(1, 501)]
+            )
+            conn.commit()
+        date_from = (date.today() - timedelta(days=args.days)).strftime('%d.%m.%Y')
+        date_to = date.today().strftime('%d.%m.%Y')
+
+        legacy_file, legacy_time, legacy_peak = _measure(legacy_export_lessons_sheet, date_from, date_to)
+        (excel_file, summary), new_time, new_peak = _measure(bot.build_excel_export, date_from, date_to)
+
+        async def inline():
+            bot.build_excel_export(date_from, date_to)
+
+        async def threaded():
+            await asyncio.to_thread(bot.build_excel_export, date_from, date_to)
+
+        inline_stall = asyncio.run(_max_loop_stall(inline()))
+        threaded_stall = asyncio.run(_max_loop_stall(threaded()))
+
+        with database.get_db() as conn:
+            expected = conn.execute(
+                "SELECT COUNT(*) FROM lessons WHERE date_iso BETWEEN ? AND ?",
+                (database.normalize_date(date_from), database.normalize_date(date_to))
+            ).fetchone()[0]
+        database.get_pool().close_all()
+
+    wb = load_workbook(excel_file, read_only=True)
+    lesson_rows = sum(1 for _ in wb["Уроки"].iter_rows()) - 1
+    legacy_rows = sum(1 for _ in load_workbook(legacy_file, read_only=True).active.iter_rows())
+
+    print(f"📥 Експорт {args.days} днів з {args.lessons} уроків: {summary['lessons']} рядків, аркуші {wb.sheetnames}")
+    print(f"   старий (лише аркуш Уроки)  {legacy_time * 1000:8.1f} мс, пік пам'яті {legacy_peak:6.1f} МБ")
+    print(f"   потоковий (всі аркуші)      {new_time * 1000:8.1f} мс, пік пам'яті {new_peak:6.1f} МБ")
+    print(f"   найбільша затримка event loop: в циклі {inline_stall * 1000:.1f} мс, "
+          f"в робочому потоці {threaded_stall * 1000:.1f} мс")
+    if not (lesson_rows == expected == summary['lessons'] == legacy_rows):
+        print(f"❌ Кількість рядків: файл {lesson_rows}, старий {legacy_rows}, БД {expected}, підсумок {summary['lessons']}")
+        sys.exit(1)
+    print("✅ Рядки уроків збігаються з БД і старим експортом")
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+async def run_latency_load(bot, duration, rate, slow_rate, seed=7):
+    """Відкрите навантаження: учні дивляться записи, адмін будує річний звіт.
+
+    Час відповіді рахується від запланованого моменту приходу оновлення, тож
+    очікування, поки event loop зайнятий чужим запитом, теж потрапляє в затримку.
+    """
+    rnd = random.Random(seed)
+    replay_bot = ReplayBot([])
+    today = date.today()
+    year_ago = (today - timedelta(days=365)).strftime('%Y-%m-%d')
+    latencies = {"quick": [], "slow": []}
+
+    async def request(kind, at, handler, user_id, *args):
+        await asyncio.sleep(max(0.0, at - time.perf_counter()))
+        user = ReplayUser(user_id)
+        update = ReplayUpdate(ReplayMessage(user, "", []), replay_bot)
+        context = ReplayContext(replay_bot, {}, {})
+        await handler(update, context, *args)
+        latencies[kind].append(time.perf_counter() - at)
+
+    started = time.perf_counter()
+    tasks = []
+    at = started
+    while at < started + duration:
+        at += rnd.expovariate(rate)
+        handler = rnd.choice([bot.show_student_lessons, bot.show_lessons_to_cancel])
+        tasks.append(request("quick", at, handler, rnd.randint(1, 500)))
+    at = started
+    while at < started + duration:
+        at += rnd.expovariate(slow_rate)
+        tasks.append(request("slow", at, bot.generate_admin_report, ADMIN_ONLY_ID,
+                             year_ago, today.strftime('%Y-%m-%d'), "рік"))
+    await asyncio.gather(*tasks)
+    return latencies
+
+def bench_latency(args):
+    """Затримки обробників під конкурентним навантаженням: запити в пулі потоків проти event loop"""
+    import logging
+    logging.disable(logging.CRITICAL)
+    import bot
+
+    with tempfile.TemporaryDirectory() as tmp:
+        create_database(os.path.join(tmp, "latency.db"), lessons=args.lessons)
+        print(f"⏱  {args.duration:.0f} с навантаження: {args.rate:.0f} запитів учнів/с, "
+              f"{args.slow_rate:.1f} річних звітів/с, {args.lessons} уроків")
+        for offload in (False, True):
+            database.DB_OFFLOAD = offload
+            latencies = asyncio.run(run_latency_load(bot, args.duration, args.rate, args.slow_rate))
+            label = "пул потоків " if offload else "event loop  "
+            for kind in ("quick", "slow"):
+                values = latencies[kind]
+                print(f"   {label} {kind:5} n={len(values):5}  p50 {_percentile(values, 0.5) * 1000:8.1f} мс  "
+                      f"p99 {_percentile(values, 0.99) * 1000:8.1f} мс  max {max(values) * 1000:8.1f} мс")
+        database.shutdown_db_executor()
+        database.get_pool().close_all()
+
+# ======================= СИНТЕТИЧНІ ДАНІ =======================
+FIRST_NAMES = ["Олександр", "Андрій", "Марія", "Олена", "Іван", "Тарас", "Наталія", "Юлія", "Богдан", "Оксана",
+               "Василь", "Ірина", "Дмитро", "Софія", "Максим", "Анна", "Роман", "Катерина", "Сергій", "Віра"]
+LAST_NAMES = ["Коваленко", "Бондаренко", "Ткаченко", "Шевчук", "Мельник", "Кравченко", "Олійник", "Поліщук",
+              "Лисенко", "Савчук", "Мороз", "Руденко", "Гнатюк", "Марченко", "Павлюк", "Кушнір"]
+# (тривалість, вага) — переважно годинні уроки
+SEED_DURATIONS = (("1 година", 60), ("2 години", 35), ("1.5 години", 5))
+SEED_HOURS = range(8, 18)
+# Частка минулих уроків, у яких date записано як РРРР-ММ-ДД (так писали старі версії бота)
+LEGACY_DATE_SHARE = 0.1
+# Максимальна частка зайнятих погодинних клітинок розкладу, далі генератор обрізає кількість уроків
+MAX_SCHEDULE_LOAD = 0.6
+SEED_BATCH = 50000
+
+def _person(rnd, index):
+    return f"{rnd.choice(LAST_NAMES)} {rnd.choice(FIRST_NAMES)} {index}"
+
+def generate_database(path, instructors=50, lessons=200000, years=3, future_days=60, seed=42):
+    """Реалістична БД: інструктори, учні, уроки за кілька років і блокування.
+
+    Уроки інструктора не перетинаються, минулі — завершені або скасовані, майбутні
+    переважно активні; частина минулих має date у форматі РРРР-ММ-ДД.
+    Повертає фактичну кількість уроків (менше запитаної, якщо розклад не вміщає).
+    """
+    database.DB_NAME = path
+    database.init_db()
+    database.init_lessons_table()
+    database.init_students_table()
+    database.migrate_database()
+    database.init_schedule_blocks_table()
+    database.init_persistence_table()
+    database.init_availability_table()
+
+    rnd = random.Random(seed)
+    today = date.today()
+    first_day = today - timedelta(days=365 * years)
+    days = 365 * years + future_days
+    hours = list(SEED_HOURS)
+    average_cells = sum(-(-database.duration_to_minutes(label) // 60) * weight
+                        for label, weight in SEED_DURATIONS) / sum(weight for _, weight in SEED_DURATIONS)
+    capacity = int(instructors * days * len(hours) * MAX_SCHEDULE_LOAD / average_cells)
+    if lessons > capacity:
+        print(f"⚠️ {lessons} уроків не вміщаються в розклад {instructors} інструкторів за {years} р., буде {capacity}")
+        lessons = capacity
+
+    with database.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO instructors (telegram_id, name, phone, transmission_type, price_per_hour, is_active)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [
+            (700000000 + i, _person(rnd, i), f"+38067{i:07d}", "Автомат" if i % 2 else "Механіка",
+             rnd.choice([490, 550]), int(rnd.random() < 0.95))
+            for i in range(instructors)
+        ])
+        instructor_ids = [row[0] for row in cursor.execute("SELECT id FROM instructors ORDER BY id")]
+
+        students = [
+            (_person(rnd, i), f"+38050{i:07d}", 900000000 + i, rnd.choice([490, 550]),
+             rnd.choice(["admin", "link_490", "link_550"]))
+            for i in range(max(100, lessons // 40))
+        ]
+        cursor.executemany(
+            "INSERT INTO students (name, phone, telegram_id, tariff, registered_via) VALUES (?, ?, ?, ?, ?)",
+            students
+        )
+
+        labels, weights = zip(*SEED_DURATIONS)
+        busy = set()
+        rows = []
+        inserted = 0
+        while inserted + len(rows) < lessons:
+            instructor_id = rnd.choice(instructor_ids)
+            day = rnd.randrange(days)
+            duration = rnd.choices(labels, weights)[0]
+            minutes = database.duration_to_minutes(duration)
+            cells = -(-minutes // 60)
+            hour = rnd.choice(hours[:len(hours) - cells + 1])
+            slots = [(instructor_id, day, hour + i) for i in range(cells)]
+            if any(slot in busy for slot in slots):
+                continue
+            busy.update(slots)
+
+            lesson_day = first_day + timedelta(days=day)
+            date_iso = lesson_day.strftime('%Y-%m-%d')
+            past = lesson_day < today
+            if past:
+                status = rnd.choices(["completed", "cancelled"], [85, 15])[0]
+            else:
+                status = rnd.choices(["active", "cancelled"], [90, 10])[0]
+            rated = status == "completed" and rnd.random() < 0.6
+            name, phone, telegram_id, tariff, _ = rnd.choice(students)
+            rows.append((
+                instructor_id, name, telegram_id, phone, tariff,
+                date_iso if past and rnd.random() < LEGACY_DATE_SHARE else lesson_day.strftime('%d.%m.%Y'),
+                date_iso, f"{hour:02d}:00", f"{date_iso} {hour:02d}:00", duration, minutes, status,
+                rnd.choices([5, 4, 3, 2, 1], [60, 25, 10, 3, 2])[0] if rated else None,
+                "Все чудово" if rated and rnd.random() < 0.2 else None,
+                rnd.choice(["student", "admin"]) if status == "cancelled" else None,
+                f"{date_iso} 07:00:00" if status == "cancelled" else None,
+                int(past), int(past),
+                "Перше заняття" if rnd.random() < 0.1 else None,
+                rnd.choice([3, 4, 5]) if status == "completed" and rnd.random() < 0.3 else None,
+            ))
+            if len(rows) == SEED_BATCH:
+                _insert_seed_lessons(cursor, rows)
+                inserted += len(rows)
+                rows = []
+        _insert_seed_lessons(cursor, rows)
+
+        blocks = []
+        for instructor_id in instructor_ids:
+            for _ in range(max(1, days // 30)):
+                day = rnd.randrange(days)
+                hour = rnd.choice(hours[:-1])
+                if (instructor_id, day, hour) in busy or (instructor_id, day, hour + 1) in busy:
+                    continue
+                blocks.append((
+                    instructor_id, (first_day + timedelta(days=day)).strftime('%Y-%m-%d'),
+                    f"{hour:02d}:00", f"{hour + 2:02d}:00", "blocked", rnd.choice(["", "Техогляд", "Відпустка"]),
+                ))
+        cursor.executemany("""
+            INSERT INTO schedule_blocks (instructor_id, date, time_start, time_end, block_type, reason)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, blocks)
+        conn.commit()
+        total = cursor.execute("SELECT COUNT(*) FROM lessons").fetchone()[0]
+    database.invalidate_instructor_cache()
+    return total
+
+def _insert_seed_lessons(cursor, rows):
+    cursor.executemany("""
+        INSERT INTO lessons (instructor_id, student_name, student_telegram_id, student_phone, student_tariff,
+                             date, date_iso, time, starts_at, duration, duration_minutes, status, rating, feedback,
+                             cancelled_by, cancelled_at, reminder_24h_sent, reminder_2h_sent, booking_comment,
+                             instructor_rating)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+
+def bench_seed(args):
+    """Згенерувати синтетичну БД у файл (для suite --db, explain вручну тощо)"""
+    if os.path.exists(args.output):
+        sys.exit(f"❌ {args.output} вже існує")
+    started = time.perf_counter()
+    total = generate_database(args.output, args.instructors, args.lessons, args.years, seed=args.seed)
+    database.get_pool().close_all()
+    size = os.path.getsize(args.output) / 1024 / 1024
+    print(f"🌱 {args.output}: {args.instructors} інструкторів, {total} уроків за {args.years} р., "
+          f"{size:.1f} МБ за {time.perf_counter() - started:.1f} с")
+
+# ======================= НАБІР ЗАМІРІВ =======================
+# Публічні функції database.py, які suite не міряє, і чому
+SUITE_SKIP = {
+    "init_db": "одноразово при старті",
+    "init_lessons_table": "одноразово при старті",
+    "init_schedule_blocks_table": "одноразово при старті",
+    "init_students_table": "одноразово при старті",
+    "init_persistence_table": "одноразово при старті",
+    "init_availability_table": "одноразово при старті",
+    "migrate_database": "одноразово при старті",
+    "create_indexes": "частина init_*",
+    "drop_obsolete_indexes": "частина migrate_database",
+    "get_pool": "службова, міряється в pool",
+    "get_db": "службова, міряється в pool",
+    "get_db_executor": "службова",
+    "shutdown_db_executor": "службова",
+    "run_db": "корутина, міряється в latency",
+    "set_journal_mode": "одноразово при відкритті з'єднання, міряється в wal",
+}
+SUITE_MIN_BATCH = 0.05
+
+def suite_fixtures():
+    """Реальні аргументи для викликів: зайнятий інструктор, його учень, уроки різних статусів"""
+    today = date.today()
+    row = database.fetch_one("""
+        SELECT l.id, l.instructor_id, i.name, i.telegram_id, l.date, l.date_iso, l.time, l.student_telegram_id
+        FROM lessons l JOIN instructors i ON i.id = l.instructor_id
+        WHERE l.status = 'active' AND l.date_iso > ? AND i.is_active = 1
+        ORDER BY l.date_iso, l.id LIMIT 1
+    """, (today.strftime('%Y-%m-%d'),))
+    lesson_id, instructor_id, instructor_name, instructor_tg, lesson_date, date_iso, lesson_time, student_id = row
+    # Учень без уроків на цю дату — його запис упреться в зайнятість інструктора, а не в ліміти
+    other_student = database.fetch_one("""
+        SELECT s.telegram_id, s.name, s.phone, s.tariff FROM students s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM lessons l WHERE l.student_telegram_id = s.telegram_id
+            AND l.date_iso BETWEEN ? AND ? AND l.status = 'active'
+        ) LIMIT 1
+    """, ((date.fromisoformat(date_iso) - timedelta(days=6)).strftime('%Y-%m-%d'),
+          (date.fromisoformat(date_iso) + timedelta(days=6)).strftime('%Y-%m-%d')))
+    completed = database.fetch_one("SELECT id, rating FROM lessons WHERE status = 'completed' ORDER BY id DESC LIMIT 1")
+    upcoming = [r[0] for r in database.fetch_all(
+        "SELECT id FROM lessons WHERE status = 'active' ORDER BY starts_at LIMIT 200"
+    )]
+    phone = database.fetch_one("SELECT phone FROM students WHERE telegram_id = ?", (student_id,))[0]
+    names = [r[0] for r in database.fetch_all("SELECT name FROM instructors WHERE is_active = 1 LIMIT 10")]
+    return {
+        "lesson_id": lesson_id, "instructor_id": instructor_id, "instructor_name": instructor_name,
+        "instructor_tg": instructor_tg, "date": lesson_date, "date_ddmm": date.fromisoformat(date_iso).strftime('%d.%m.%Y'),
+        "date_iso": date_iso, "time": lesson_time, "student_id": student_id, "phone": phone,
+        "other_student": other_student, "completed_id": completed[0], "completed_rating": completed[1] or 5,
+        "upcoming": upcoming, "names": names, "today": today,
+    }
+
+def suite_cases(bot, f):
+    """(назва, функція без аргументів) для кожного заміру"""
+    today = f["today"]
+    month_ago = (today - timedelta(days=30)).strftime('%Y-%m-%d')
+    year_ago = (today - timedelta(days=365)).strftime('%Y-%m-%d')
+    today_iso = today.strftime('%Y-%m-%d')
+    week = [date.fromisoformat(f["date_iso"]) + timedelta(days=i) for i in range(14)]
+
+    def schedule_block_roundtrip():
+        database.add_schedule_block(f["instructor_id"], f["date_iso"], "19:00", "20:00", "blocked", "suite")
+        block_id = database.fetch_one(
+            "SELECT id FROM schedule_blocks WHERE instructor_id = ? AND reason = 'suite'", (f["instructor_id"],)
+        )[0]
+        database.remove_schedule_block(block_id)
+
+    save_lesson = _save_lesson_conflict(bot, f)
+    return [
+        ("validate_time_format", lambda: database.validate_time_format("14:00")),
+        ("validate_date_format", lambda: database.validate_date_format(f["date_ddmm"])),
+        ("normalize_date", lambda: database.normalize_date(f["date_ddmm"])),
+        ("lesson_starts_at", lambda: database.lesson_starts_at(f["date_ddmm"], "14:00")),
+        ("duration_to_minutes", lambda: database.duration_to_minutes("1.5 години")),
+        ("minutes_to_hours", lambda: database.minutes_to_hours(90)),
+        ("fetch_all", lambda: database.fetch_all(
+            "SELECT id FROM lessons WHERE instructor_id = ? AND date_iso = ?", (f["instructor_id"], f["date_iso"]))),
+        ("fetch_one", lambda: database.fetch_one("SELECT name FROM students WHERE telegram_id = ?", (f["student_id"],))),
+        ("get_wal_size", database.get_wal_size),
+        ("checkpoint_wal", lambda: database.checkpoint_wal("PASSIVE")),
+        ("execute_write", lambda: database.execute_write(
+            "UPDATE lessons SET booking_comment = booking_comment WHERE id = ?", (f["lesson_id"],))),
+        ("get_instructor_directory", database.get_instructor_directory),
+        ("invalidate_instructor_cache", lambda: (database.invalidate_instructor_cache(),
+                                                 database.get_instructor_directory())),
+        ("get_instructors_by_transmission", lambda: database.get_instructors_by_transmission("Автомат")),
+        ("get_instructor_by_name", lambda: database.get_instructor_by_name(f["instructor_name"])),
+        ("get_instructor_by_telegram_id", lambda: database.get_instructor_by_telegram_id(f["instructor_tg"])),
+        ("get_instructor_by_id", lambda: database.get_instructor_by_id(f["instructor_id"])),
+        ("get_instructor_rating", lambda: database.get_instructor_rating(f["instructor_name"])),
+        ("get_instructor_ratings", lambda: database.get_instructor_ratings(f["names"])),
+        ("rebuild_instructor_ratings", database.rebuild_instructor_ratings),
+        ("get_all_instructors", database.get_all_instructors),
+        ("get_active_instructors", database.get_active_instructors),
+        ("add_schedule_block", schedule_block_roundtrip),
+        ("remove_schedule_block", schedule_block_roundtrip),
+        ("get_schedule_blocks", lambda: database.get_schedule_blocks(f["instructor_id"], f["date_iso"])),
+        ("is_time_blocked", lambda: database.is_time_blocked(f["instructor_id"], f["date_iso"], "14:00")),
+        ("get_instructor_busy_schedule", lambda: database.get_instructor_busy_schedule(f["instructor_id"], week)),
+        ("get_instructor_availability", lambda: database.get_instructor_availability(f["instructor_id"], week)),
+        ("get_instructors_availability", lambda: database.get_instructors_availability(
+            [database.get_instructor_by_name(name)[0] for name in f["names"]], week)),
+        ("availability_mask", lambda: database.availability_mask([("09:00", 90), ("14:00", 60)], [("16:00", "18:00")])),
+        ("rebuild_instructor_availability", database.rebuild_instructor_availability),
+        ("is_time_slot_available", lambda: database.is_time_slot_available(
+            f["instructor_id"], f["date"], f["time"], "1 година")),
+        ("update_lesson", lambda: database.update_lesson(f["lesson_id"], time=f["time"])),
+        ("mark_reminders_sent", lambda: database.mark_reminders_sent("reminder_24h_sent", f["upcoming"])),
+        ("get_pending_reminders", lambda: database.get_pending_reminders("reminder_2h_sent", f["upcoming"])),
+        ("complete_started_lessons", lambda: database.complete_started_lessons(f"{today_iso} 00:00")),
+        ("add_lesson_rating", lambda: database.add_lesson_rating(f["completed_id"], f["completed_rating"])),
+        ("add_instructor_rating", lambda: database.add_instructor_rating(f["completed_id"], 5)),
+        ("get_instructor_stats_period", lambda: database.get_instructor_stats_period(
+            f["instructor_id"], month_ago, today_iso)),
+        ("get_admin_report_by_instructors", lambda: database.get_admin_report_by_instructors(month_ago, today_iso)),
+        ("get_admin_report_by_instructors[рік]", lambda: database.get_admin_report_by_instructors(year_ago, today_iso)),
+        ("get_instructor_report", lambda: database.get_instructor_report(f["instructor_id"], month_ago, today_iso)),
+        ("register_student", lambda: database.register_student("Учень Suite", "+380509999999", 999999999, 490)),
+        ("get_student_by_telegram_id", lambda: database.get_student_by_telegram_id(f["student_id"])),
+        ("get_student_by_phone", lambda: database.get_student_by_phone(f["phone"])),
+        ("bot.get_available_time_slots", lambda: bot.get_available_time_slots(f["instructor_name"], f["date_ddmm"])),
+        ("bot.get_next_dates", lambda: bot.get_next_dates(14, f["instructor_name"])),
+        ("bot.get_available_slots_by_date", lambda: bot.get_available_slots_by_date(f["instructor_name"], week)),
+        ("bot.get_free_hours_by_date", lambda: bot.get_free_hours_by_date(f["instructor_name"], week)),
+        ("bot.find_first_free_slots", lambda: bot.find_first_free_slots("Автомат", 14, 6)),
+        ("try_book_lesson[конфлікт]", lambda: database.try_book_lesson(
+            f["instructor_id"], f["other_student"][1], f["other_student"][0], f["other_student"][2],
+            f["other_student"][3], f["date_ddmm"], f["time"], "1 година")),
+        ("bot.save_lesson[конфлікт]", save_lesson),
+        ("save_conversation_state", lambda: database.save_conversation_state(
+            [("user", str(f["student_id"]), pickle.dumps({"state": "choosing_date", "instructor": f["instructor_name"]}))])),
+        ("load_conversation_state", lambda: database.load_conversation_state("user")),
+    ]
+
+def _save_lesson_conflict(bot, f):
+    """save_lesson до відмови «Інструктор зайнятий»: усі перевірки, без INSERT"""
+    telegram_id, name, phone, tariff = f["other_student"]
+    transcript = []
+    replay_bot = ReplayBot(transcript)
+    user = ReplayUser(telegram_id)
+    user_data = {
+        "instructor": f["instructor_name"], "date": f["date_ddmm"], "time": f["time"], "duration": "1 година",
+        "student_name": name, "student_phone": phone, "student_tariff": tariff,
+    }
+    loop = asyncio.new_event_loop()
+
+    def call():
+        transcript.clear()
+        update = ReplayUpdate(ReplayMessage(user, "✅ Підтвердити", transcript), replay_bot)
+        loop.run_until_complete(bot.save_lesson(update, ReplayContext(replay_bot, dict(user_data), {})))
+        if not transcript or "зайнятий" not in transcript[0][1]:
+            raise RuntimeError(f"save_lesson не дійшов до перевірки інструктора: {transcript}")
+    return call
+
+def time_case(func, rounds):
+    """Калібрування як у pytest-benchmark: партія триває ≥ SUITE_MIN_BATCH, далі rounds партій"""
+    func()
+    iterations = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= SUITE_MIN_BATCH:
+            break
+        iterations *= 2 if elapsed == 0 else max(2, min(10, int(SUITE_MIN_BATCH / elapsed) + 1))
+    per_call = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        per_call.append((time.perf_counter() - started) / iterations)
+    per_call.sort()
+    return {
+        "min": per_call[0], "median": per_call[len(per_call) // 2],
+        "mean": sum(per_call) / len(per_call), "iterations": iterations,
+    }
+
+def bench_suite(args):
+    """Час кожної публічної функції database.py і гарячих помічників bot.py"""
+    import logging
+    import shutil
+    logging.disable(logging.CRITICAL)
+    import bot
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "suite.db")
+        if args.db:
+            # Працюємо з копією: suite пише в БД (блокування, оцінки, реєстрація)
+            shutil.copyfile(args.db, path)
+            database.DB_NAME = path
+            database.invalidate_instructor_cache()
+            lessons = database.fetch_one("SELECT COUNT(*) FROM lessons")[0]
+        else:
+            lessons = generate_database(path, args.instructors, args.lessons, args.years)
+        bot.DB_NAME = path
+        database.DB_OFFLOAD = False
+
+        fixtures = suite_fixtures()
+        cases = suite_cases(bot, fixtures)
+        if args.filter:
+            cases = [(name, func) for name, func in cases if args.filter in name]
+
+        print(f"📏 {lessons} уроків, {args.rounds} партій на функцію")
+        print(f"   {'функція':42} {'min, мс':>10} {'медіана, мс':>12} {'середнє, мс':>12} {'оп/с':>10} {'зміна':>8}")
+        results = {}
+        for name, func in cases:
+            stats = time_case(func, args.rounds)
+            results[name] = stats
+            change = ""
+            if name in baseline:
+                change = f"{(stats['median'] / baseline[name]['median'] - 1) * 100:+.0f}%"
+            print(f"   {name:42} {stats['min'] * 1000:10.3f} {stats['median'] * 1000:12.3f} "
+                  f"{stats['mean'] * 1000:12.3f} {1 / stats['median']:10.0f} {change:>8}")
+
+        covered = {name.split("[")[0] for name, _ in suite_cases(bot, fixtures)}
+        public = {
+            name for name, value in vars(database).items()
+            if callable(value) and not name.startswith("_") and not isinstance(value, type)
+            and getattr(value, "__module__", None) == database.__name__
+        }
+        missing = sorted(public - covered - set(SUITE_SKIP))
+        if missing:
+            print(f"⚠️ Без заміру: {', '.join(missing)}")
+
+        asyncio.set_event_loop(None)
+        database.get_pool().close_all()
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"lessons": lessons, "rounds": args.rounds, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"💾 Базова лінія збережена в {args.save}")
+
+# ======================= WAL ПІД НАВАНТАЖЕННЯМ =======================
+def booking_writer(stop, stats, seed, hold):
+    """Записи як у save_lesson: BEGIN IMMEDIATE, перевірки конфліктів, INSERT, COMMIT"""
+    rnd = random.Random(seed)
+    today = date.today()
+    instructor_ids = [row[0] for row in database.fetch_all("SELECT id FROM instructors")]
+    while not stop.is_set():
+        lesson_day = today + timedelta(days=rnd.randint(0, 30))
+        date_iso = lesson_day.strftime('%Y-%m-%d')
+        student_id = rnd.randint(1, 500)
+        instructor_id = rnd.choice(instructor_ids)
+        hour = rnd.randint(8, 17)
+        try:
+            with database.get_db() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("""
+                    SELECT time, duration_minutes FROM lessons
+                    WHERE student_telegram_id = ? AND date_iso = ? AND status = 'active'
+                """, (student_id, date_iso)).fetchall()
+                conn.execute("""
+                    SELECT SUM(duration_minutes) FROM lessons
+                    WHERE student_telegram_id = ? AND date_iso BETWEEN ? AND ? AND status = 'active'
+                """, (student_id, date_iso, date_iso)).fetchone()
+                conn.execute("""
+                    SELECT time, duration_minutes FROM lessons
+                    WHERE instructor_id = ? AND date_iso = ? AND status = 'active'
+                """, (instructor_id, date_iso)).fetchall()
+                conn.execute("""
+                    INSERT INTO lessons (instructor_id, student_name, student_telegram_id, date, date_iso, time,
+                                         starts_at, duration, duration_minutes, status)
+                    VALUES (?, 'Учень', ?, ?, ?, ?, ?, '1 година', 60, 'active')
+                """, (instructor_id, student_id, lesson_day.strftime('%d.%m.%Y'), date_iso, f"{hour:02d}:00",
+                      f"{date_iso} {hour:02d}:00"))
+                if hold:
+                    time.sleep(hold)
+                conn.commit()
+            stats["writes"] += 1
+        except sqlite3.OperationalError:
+            stats["write_errors"] += 1
+
+def lessons_reader(stop, stats, seed):
+    """Читання як у «Мої записи» та виборі дати: час кожного запиту"""
+    rnd = random.Random(seed)
+    today = date.today()
+    dates = [today + timedelta(days=i) for i in range(14)]
+    instructor_ids = [row[0] for row in database.fetch_all("SELECT id FROM instructors")]
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            database.fetch_all("""
+                SELECT l.date, l.time, l.duration, i.name FROM lessons l
+                JOIN instructors i ON i.id = l.instructor_id
+                WHERE l.student_telegram_id = ? AND l.date_iso >= ? AND l.status = 'active'
+                ORDER BY l.date_iso, l.time
+            """, (rnd.randint(1, 500), today.strftime('%Y-%m-%d')))
+            database.get_instructor_busy_schedule(rnd.choice(instructor_ids), dates)
+            stats["reads"].append(time.perf_counter() - started)
+        except sqlite3.OperationalError:
+            stats["read_errors"] += 1
+
+def bench_wal(args):
+    """Затримка читань під інтенсивними записами: журнал відкату проти WAL"""
+    import logging
+    import threading
+    logging.disable(logging.CRITICAL)
+
+    print(f"✍️  {args.writers} записувачі(в) бронювань без пауз, {args.readers} читачі(в), "
+          f"{args.duration:.0f} с на режим, {args.lessons} уроків")
+    for mode in ("truncate", "wal"):
+        with tempfile.TemporaryDirectory() as tmp:
+            database.JOURNAL_MODE = mode
+            create_database(os.path.join(tmp, f"{mode}.db"), lessons=args.lessons)
+            actual = database.get_pool().journal_mode
+            stats = {"writes": 0, "write_errors": 0, "reads": [], "read_errors": 0}
+            stop = threading.Event()
+            threads = [threading.Thread(target=booking_writer, args=(stop, stats, i, args.hold_ms / 1000))
+                       for i in range(args.writers)]
+            threads += [threading.Thread(target=lessons_reader, args=(stop, stats, 100 + i))
+                        for i in range(args.readers)]
+            for thread in threads:
+                thread.start()
+            time.sleep(args.duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            wal_size = database.get_wal_size()
+            checkpoint = database.checkpoint_wal("TRUNCATE")
+            database.get_pool().close_all()
+
+            reads = stats["reads"]
+            print(f"   {actual:8} записів {stats['writes'] / args.duration:7.0f}/с  читань {len(reads) / args.duration:7.0f}/с  "
+                  f"читання p50 {_percentile(reads, 0.5) * 1000:7.2f} мс  p99 {_percentile(reads, 0.99) * 1000:7.2f} мс  "
+                  f"max {max(reads) * 1000:8.2f} мс  locked: {stats['write_errors'] + stats['read_errors']}")
+            if actual == "wal":
+                print(f"   -wal наприкінці {wal_size / 1024 / 1024:.1f} МБ, checkpoint TRUNCATE: {checkpoint}, "
+                      f"після: {database.get_wal_size()} Б")
+    database.JOURNAL_MODE = "wal"
+
+# ======================= КОНКУРЕНЦІЯ ЗА ЗАПИС =======================
+class SlowReplayMessage(ReplayMessage):
+    """Відповідь з затримкою мережі Telegram"""
+
+    def __init__(self, user, text, transcript, rtt):
+        super().__init__(user, text, transcript)
+        self._rtt = rtt
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        await asyncio.sleep(self._rtt)
+        await super().reply_text(text, reply_markup, **kwargs)
+
+class SlowReplayBot(ReplayBot):
+    def __init__(self, transcript, rtt):
+        super().__init__(transcript)
+        self._rtt = rtt
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        await asyncio.sleep(self._rtt)
+        await super().send_message(chat_id, text, reply_markup, **kwargs)
+
+@contextmanager
+def tracked_lock_hold(holds):
+    """Час від BEGIN IMMEDIATE до COMMIT/ROLLBACK на кожному з'єднанні пулу"""
+    original = database.ConnectionPool._connect
+
+    def _connect(pool):
+        conn = original(pool)
+        began = None
+
+        def trace(sql):
+            nonlocal began
+            statement = sql.lstrip().upper()
+            if statement.startswith("BEGIN IMMEDIATE"):
+                began = time.perf_counter()
+            elif began is not None and statement.startswith(("COMMIT", "ROLLBACK")):
+                holds.append(time.perf_counter() - began)
+                began = None
+        conn.set_trace_callback(trace)
+        return conn
+
+    database.ConnectionPool._connect = _connect
+    try:
+        yield holds
+    finally:
+        database.ConnectionPool._connect = original
+
+async def legacy_save_lesson(bot, update, context):
+    """Стара схема save_lesson: відмова надсилається, поки транзакція тримає блокування"""
+    user_data = context.user_data
+    instructor_id, _ = bot.get_instructor_by_name(user_data["instructor"])
+    start = int(user_data["time"].split(':')[0]) * 60
+    end = start + database.duration_to_minutes(user_data["duration"])
+    try:
+        with database.get_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.cursor()
+            result = database._check_booking(cursor, instructor_id, update.message.from_user.id,
+                                             database.normalize_date(user_data["date"]), start, end)
+            if result is not None:
+                await update.message.reply_text(bot.booking_refusal_text(result, user_data["date"]))
+                return
+            cursor.execute("""
+                INSERT INTO lessons (instructor_id, student_name, student_telegram_id, date, date_iso, time, starts_at,
+                                     duration, duration_minutes, status)
+                VALUES (?, '', ?, ?, ?, ?, ?, ?, ?, 'active')
+            """, (instructor_id, update.message.from_user.id, user_data["date"], database.normalize_date(user_data["date"]),
+                  user_data["time"], database.lesson_starts_at(user_data["date"], user_data["time"]),
+                  user_data["duration"], end - start))
+            conn.commit()
+        await update.message.reply_text("✅ *Заняття заброньовано!*")
+    except Exception:
+        await update.message.reply_text("❌ Помилка збереження запису.")
+
+async def run_booking_load(bot, handler, users, duration, rtt, seed=11):
+    """users учнів безперервно бронюють випадкові слоти 4 інструкторів на тиждень"""
+    rnd = random.Random(seed)
+    today = date.today()
+    names = [name for _, name, _ in INSTRUCTORS]
+    latencies = []
+    outcomes = {"ok": 0, "refused": 0, "error": 0}
+    deadline = time.perf_counter() + duration
+
+    async def student(user_id):
+        transcript = []
+        replay_bot = SlowReplayBot(transcript, rtt)
+        user = ReplayUser(user_id)
+        while time.perf_counter() < deadline:
+            user_data = {
+                "instructor": rnd.choice(names),
+                "date": (today + timedelta(days=rnd.randint(1, 7))).strftime('%d.%m.%Y'),
+                "time": f"{rnd.randint(8, 17):02d}:00",
+                "duration": rnd.choice(["1 година", "2 години"]),
+                "student_name": "Учень", "student_phone": "", "student_tariff": 490,
+            }
+            transcript.clear()
+            update = ReplayUpdate(SlowReplayMessage(user, "✅ Підтвердити", transcript, rtt), replay_bot)
+            started = time.perf_counter()
+            await handler(update, ReplayContext(replay_bot, user_data, {}))
+            latencies.append(time.perf_counter() - started)
+            reply = transcript[0][1] if transcript else ""
+            outcomes["ok" if "заброньовано" in reply else "error" if "Помилка" in reply else "refused"] += 1
+
+    await asyncio.gather(*(student(2000 + i) for i in range(users)))
+    return latencies, outcomes
+
+def bench_booking(args):
+    """Утримання блокування запису: відповідь у транзакції проти try_book_lesson"""
+    import logging
+    logging.disable(logging.CRITICAL)
+    import bot
+
+    print(f"🔒 {args.users} учнів бронюють одночасно, RTT Telegram {args.rtt_ms:.0f} мс, {args.duration:.0f} с на варіант")
+    variants = (
+        ("відповідь у транзакції", lambda update, context: legacy_save_lesson(bot, update, context)),
+        ("try_book_lesson", bot.save_lesson),
+    )
+    for label, handler in variants:
+        holds = []
+        with tempfile.TemporaryDirectory() as tmp, tracked_lock_hold(holds):
+            create_database(os.path.join(tmp, "booking.db"), lessons=args.lessons)
+            bot.DB_NAME = database.DB_NAME
+            latencies, outcomes = asyncio.run(run_booking_load(bot, handler, args.users, args.duration, args.rtt_ms / 1000))
+            database.shutdown_db_executor()
+            database.get_pool().close_all()
+        print(f"   {label}")
+        print(f"      блокування запису: n={len(holds)}  p50 {_percentile(holds, 0.5) * 1e6:9.0f} мкс  "
+              f"p99 {_percentile(holds, 0.99) * 1e6:9.0f} мкс  max {max(holds) * 1e6:9.0f} мкс")
+        print(f"      обробник: {len(latencies) / args.duration:6.1f} спроб/с  p50 {_percentile(latencies, 0.5) * 1000:7.1f} мс  "
+              f"p99 {_percentile(latencies, 0.99) * 1000:7.1f} мс  записано {outcomes['ok']}, "
+              f"відмов {outcomes['refused']}, помилок {outcomes['error']}")
+
+# ======================= МАСКИ ВІЛЬНИХ ГОДИН =======================
+def legacy_slots_by_date(bot, instructor_name, dates):
+    """get_available_slots_by_date до масок: уроки й блокування вікна, слоти кожного дня в Python"""
+    instructor_id = database.get_instructor_by_name(instructor_name)[0]
+    booked, blocks = database.get_instructor_busy_schedule(instructor_id, dates)
+    now = datetime.now(bot.TZ)
+    result = {}
+    for day in dates:
+        if day == now.date():
+            min_time = now + timedelta(hours=1)
+            start_hour = max(min_time.hour + (min_time.minute > 0), database.WORK_HOURS_START)
+        else:
+            start_hour = database.WORK_HOURS_START
+        busy = set()
+        for booked_time, minutes in booked.get(day.strftime('%Y-%m-%d'), []):
+            if ':' in booked_time:
+                start = int(booked_time.split(':')[0])
+                busy.update(f"{start + i:02d}:00" for i in range(-(-minutes // 60)))
+        day_blocks = blocks.get(day.strftime('%Y-%m-%d'), [])
+        result[day] = [
+            slot for slot in (f"{hour:02d}:00" for hour in range(start_hour, database.WORK_HOURS_END))
+            if slot not in busy and not any(time_start <= slot < time_end for time_start, time_end in day_blocks)
+        ]
+    return result
+
+def legacy_first_free_slots(bot, transmission, days, limit):
+    """Найближчі вільні години перебором: get_available_time_slots для кожного інструктора на кожен день"""
+    names = database.get_instructors_by_transmission(transmission)
+    ratings = database.get_instructor_ratings(names)
+    today = datetime.now(bot.TZ).date()
+    candidates = []
+    for name in names:
+        for i in range(days):
+            day = today + timedelta(days=i)
+            for slot in bot.get_available_time_slots(name, day.strftime('%d.%m.%Y')):
+                candidates.append((day, slot, name, ratings.get(name, 0)))
+    candidates.sort(key=lambda c: (c[0], c[1], -c[3], c[2]))
+    return candidates[:limit]
+
+def change_schedule(rnd, instructor_ids, students, window):
+    """Один випадковий запис у розклад тим шляхом, яким його робить бот"""
+    action = rnd.choice(("book", "book", "cancel", "move", "block", "unblock", "delete"))
+    day = rnd.choice(window)
+    hour = f"{rnd.randint(database.WORK_HOURS_START, database.WORK_HOURS_END - 1):02d}:{rnd.choice(('00', '30'))}"
+    if action == "book":
+        name, phone, telegram_id = rnd.choice(students)
+        database.try_book_lesson(rnd.choice(instructor_ids), name, telegram_id, phone, 490,
+                                 day.strftime('%d.%m.%Y'), hour, rnd.choice(DURATIONS))
+        return
+    if action in ("block", "unblock"):
+        block = database.fetch_one("SELECT id FROM schedule_blocks WHERE date >= ? ORDER BY random() LIMIT 1",
+                                   (window[0].strftime('%Y-%m-%d'),))
+        if action == "unblock" and block:
+            database.remove_schedule_block(block[0])
+        else:
+            end = f"{min(int(hour[:2]) + rnd.randint(1, 3), database.WORK_HOURS_END):02d}:00"
+            database.add_schedule_block(rnd.choice(instructor_ids), day.strftime('%d.%m.%Y'), hour[:2] + ":00", end,
+                                        "blocked")
+        return
+    lesson = database.fetch_one("SELECT id FROM lessons WHERE status = 'active' AND date_iso >= ? ORDER BY random() LIMIT 1",
+                                (window[0].strftime('%Y-%m-%d'),))
+    if not lesson:
+        return
+    if action == "cancel":
+        database.update_lesson(lesson[0], status='cancelled')
+    elif action == "move":
+        database.update_lesson(lesson[0], date=day.strftime('%d.%m.%Y'), time=hour, duration=rnd.choice(DURATIONS))
+    else:
+        database.execute_write("DELETE FROM lessons WHERE id = ?", (lesson[0],))
+
+def bench_availability(args):
+    """Вибір дати: уроки й блокування вікна проти масок instructor_availability; маски сходяться з розкладом"""
+    import logging
+    logging.disable(logging.CRITICAL)
+    import bot
+
+    rnd = random.Random(11)
+    with tempfile.TemporaryDirectory() as tmp:
+        create_database(os.path.join(tmp, "availability.db"), lessons=args.lessons)
+        bot.DB_NAME = database.DB_NAME
+        names = [name for _, name, _ in INSTRUCTORS]
+        instructor_ids = [database.get_instructor_by_name(name)[0] for name in names]
+        students = [(f"Учень {i}", f"+38050{i:07d}", 900000000 + i) for i in range(200)]
+        today = date.today()
+        window = [today + timedelta(days=i) for i in range(args.days)]
+        drift_after_seed = database.rebuild_instructor_availability()
+
+        results = {}
+        variants = (("уроки й блокування", lambda name: legacy_slots_by_date(bot, name, window)),
+                    ("маски", lambda name: bot.get_available_slots_by_date(name, window)))
+        for label, fetch in variants:
+            fetch(names[0])  # прогрів
+            started = time.perf_counter()
+            for i in range(args.iterations):
+                fetch(names[i % len(names)])
+            results[label] = (time.perf_counter() - started) / args.iterations
+        started = time.perf_counter()
+        for i in range(args.iterations):
+            bot.get_next_dates(args.days, names[i % len(names)])
+        next_dates = (time.perf_counter() - started) / args.iterations
+
+        first_free = {}
+        variants = (("по днях", lambda transmission: legacy_first_free_slots(bot, transmission, args.days, 6)),
+                    ("маски", lambda transmission: bot.find_first_free_slots(transmission, args.days, 6)))
+        for label, fetch in variants:
+            started = time.perf_counter()
+            for i in range(args.iterations // 10):
+                fetch(("Автомат", "Механіка")[i % 2])
+            first_free[label] = (time.perf_counter() - started) / (args.iterations // 10)
+
+        mismatched = 0
+        for _ in range(args.changes):
+            change_schedule(rnd, instructor_ids, students, window)
+        for name in names:
+            mismatched += legacy_slots_by_date(bot, name, window) != bot.get_available_slots_by_date(name, window)
+        for transmission in ("Автомат", "Механіка"):
+            mismatched += (legacy_first_free_slots(bot, transmission, args.days, 20)
+                           != bot.find_first_free_slots(transmission, args.days, 20))
+        drifted = database.rebuild_instructor_availability()
+        database.get_pool().close_all()
+
+    print(f"🗓️ Вільні години {len(names)} інструкторів на {args.days} днів, {args.lessons} уроків, {args.iterations} повторів")
+    for label, elapsed in results.items():
+        print(f"   {label:<20} {elapsed * 1000:8.3f} мс")
+    print(f"   Прискорення: x{results['уроки й блокування'] / results['маски']:.1f}; get_next_dates {next_dates * 1000:.3f} мс")
+    print(f"⚡ Найближчі вільні години коробки: по днях {first_free['по днях'] * 1000:.3f} мс, "
+          f"маски {first_free['маски'] * 1000:.3f} мс (x{first_free['по днях'] / first_free['маски']:.1f})")
+    if drift_after_seed or mismatched or drifted:
+        print(f"❌ Маски розходяться з розкладом: після наповнення {drift_after_seed} днів, "
+              f"після {args.changes} змін {drifted} днів, розбіжних списків слотів {mismatched}")
+        sys.exit(1)
+    print(f"✅ Слоти з масок збігаються з розкладом до і після {args.changes} змін, перебудова не знайшла розбіжностей")
+
+# ======================= СТАН РОЗМОВ =======================
+async def run_persistence_ticks(persistence, users, ticks, keystrokes, rnd):
+    """Як Application.update_persistence: за тик кожен з keystrokes кроків змінює user_data
+    випадкового учня, потім у persistence потрапляють змінені user_data і bot_data"""
+    user_data = {}
+    bot_data = {}
+    loop_time = []
+    for _ in range(ticks):
+        dirty = set()
+        for _ in range(keystrokes):
+            user_id = STUDENT_ID + rnd.randrange(users)
+            data = user_data.setdefault(user_id, {})
+            data["state"] = rnd.choice(("choosing_date", "choosing_time", "choosing_duration", "confirming"))
+            data["date"] = f"{rnd.randint(1, 28):02d}.11.2026"
+            dirty.add(user_id)
+            if rnd.random() < 0.05:
+                bot_data[f"rating_lesson_{user_id}"] = {"lesson_id": rnd.randrange(10 ** 6), "instructor": "Тест"}
+        started = time.perf_counter()
+        await asyncio.gather(persistence.update_bot_data(bot_data),
+                             *(persistence.update_user_data(user_id, user_data[user_id]) for user_id in dirty))
+        loop_time.append(time.perf_counter() - started)
+        await asyncio.sleep(0)
+    await persistence.flush()
+    return user_data, bot_data, loop_time
+
+def bench_persistence(args):
+    """Write-behind SQLitePersistence проти запису при кожному натисканні; відновлення після рестарту"""
+    import logging
+    logging.disable(logging.CRITICAL)
+    import persistence
+    from persistence import SQLitePersistence
+
+    batches = []
+    def counting_save(changed, dropped=()):
+        batches.append(len(changed) + len(dropped))
+        return database.save_conversation_state(changed, dropped)
+    persistence.save_conversation_state = counting_save
+
+    with tempfile.TemporaryDirectory() as tmp:
+        create_database(os.path.join(tmp, "persistence.db"), lessons=200)
+        rnd = random.Random(7)
+        total = args.ticks * args.keystrokes
+
+        started = time.perf_counter()
+        for _ in range(total):
+            user_id = STUDENT_ID + rnd.randrange(args.users)
+            database.save_conversation_state([("user", str(user_id), pickle.dumps({"state": "choosing_date"}))])
+        sync_seconds = time.perf_counter() - started
+        database.execute_write("DELETE FROM conversation_state")
+
+        user_data, bot_data, loop_time = asyncio.run(run_persistence_ticks(
+            SQLitePersistence(), args.users, args.ticks, args.keystrokes, random.Random(7)))
+        restored = SQLitePersistence()
+        restored_users = asyncio.run(restored.get_user_data())
+        restored_bot = asyncio.run(restored.get_bot_data())
+        database.shutdown_db_executor()
+        database.get_pool().close_all()
+
+    print(f"💾 {args.users} учнів, {total} змін user_data за {args.ticks} тиків")
+    print(f"   запис при кожній зміні:  {total} транзакцій, {sync_seconds * 1000:8.1f} мс в event loop")
+    print(f"   write-behind:            {len(batches)} транзакцій ({sum(batches)} рядків), "
+          f"{sum(loop_time) * 1000:8.1f} мс в event loop (p99 тику {_percentile(loop_time, 0.99) * 1000:.2f} мс)")
+    if restored_users == user_data and restored_bot == bot_data:
+        print(f"✅ Після рестарту відновлено user_data {len(restored_users)} учнів і {len(restored_bot)} ключів bot_data")
+    else:
+        print("❌ Відновлений стан не збігається зі збереженим")
+        sys.exit(1)
+
+def concurrency_update(update_id, user_id):
+    from telegram import Chat, Message, Update, User
+    user = User(user_id, f"user{user_id}", False)
+    return Update(update_id, message=Message(update_id, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user))
+
+async def run_concurrency(slots, delay):
+    from concurrency import PerUserUpdateProcessor
+    processor = PerUserUpdateProcessor(slots)
+    finished = {}
+    order = []
+    started = time.perf_counter()
+
+    async def handle(update_id, seconds):
+        await asyncio.sleep(seconds)
+        order.append(update_id)
+        finished[update_id] = time.perf_counter() - started
+
+    # slots + 1 оновлень одного учня, кожне delay с, і одне швидке від іншого
+    busy = [concurrency_update(i, STUDENT_ID) for i in range(slots + 1)]
+    other = concurrency_update(slots + 1, STUDENT_ID + 1)
+    tasks = [asyncio.create_task(processor.process_update(update, handle(update.update_id, delay))) for update in busy]
+    await asyncio.sleep(0)
+    tasks.append(asyncio.create_task(processor.process_update(other, handle(other.update_id, 0))))
+    await asyncio.sleep(0)
+    waiting = processor.waiting()
+    await asyncio.gather(*tasks)
+    return finished, order, waiting, len(processor._locks)
+
+def bench_concurrency(args):
+    """Черга оновлень одного учня не займає слоти max_concurrent_updates інших користувачів"""
+    finished, order, waiting, locks_left = asyncio.run(run_concurrency(args.slots, args.delay))
+    other = args.slots + 1
+    busy_order = [update_id for update_id in order if update_id != other]
+
+    print(f"🧵 {args.slots} слотів: {args.slots + 1} оновлень одного учня по {args.delay * 1000:.0f} мс + 1 від іншого")
+    print(f"   чекали на замок учня: {waiting}, інший користувач оброблений за {finished[other] * 1000:.1f} мс, "
+          f"черга учня — за {max(finished.values()) * 1000:.0f} мс")
+    problems = []
+    # Чекати інший користувач може лише на оновлення, що вже обробляються, а не на чергу
+    if finished[other] >= finished[1]:
+        problems.append("інший користувач чекав на чергу учня")
+    if busy_order != sorted(busy_order):
+        problems.append(f"порядок оновлень учня порушено: {busy_order}")
+    if waiting != args.slots:
+        problems.append(f"на замку чекало {waiting} оновлень замість {args.slots}")
+    if locks_left:
+        problems.append(f"лишилось замків: {locks_left}")
+    if problems:
+        for problem in problems:
+            print(f"❌ {problem}")
+        sys.exit(1)
+    print("✅ Оновлення учня по черзі, інший користувач не чекає")
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки шару БД")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pool_parser = subparsers.add_parser("pool", help="connect-per-call проти пулу з'єднань")
+    pool_parser.add_argument("--iterations", type=int, default=500)
+    pool_parser.add_argument("--lessons", type=int, default=2000)
+    pool_parser.set_defaults(func=bench_pool)
+
+    explain_parser = subparsers.add_parser("explain", help="EXPLAIN QUERY PLAN без повних сканувань")
+    explain_parser.add_argument("--lessons", type=int, default=100000)
+    explain_parser.set_defaults(func=bench_explain)
+
+    replay_parser = subparsers.add_parser("replay", help="повтор записаних сценаріїв handle_message")
+    replay_parser.add_argument("--save", nargs="?", const=REPLAY_TRANSCRIPT,
+                               help="зберегти стенограму у файл (без значення — перезаписати еталонну)")
+    replay_parser.add_argument("--check", help="порівняти зі стенограмою з файлу (за замовчуванням — з еталонною)")
+    replay_parser.add_argument("--repeat", type=int, default=1)
+    replay_parser.set_defaults(func=bench_replay)
+
+    dispatch_parser = subparsers.add_parser("dispatch", help="час маршрутизації handle_message")
+    dispatch_parser.add_argument("--iterations", type=int, default=20000)
+    dispatch_parser.set_defaults(func=bench_dispatch)
+
+    instructors_parser = subparsers.add_parser("instructors", help="кеш довідника інструкторів")
+    instructors_parser.add_argument("--iterations", type=int, default=2000)
+    instructors_parser.set_defaults(func=bench_instructors)
+
+    ratings_parser = subparsers.add_parser("ratings", help="агрегати рейтингів інструкторів")
+    ratings_parser.add_argument("--lessons", type=int, default=100000)
+    ratings_parser.add_argument("--iterations", type=int, default=200)
+    ratings_parser.set_defaults(func=bench_ratings)
+
+    report_parser = subparsers.add_parser("report", help="груповий звіт адміна по інструкторах")
+    report_parser.add_argument("--lessons", type=int, default=200000)
+    report_parser.add_argument("--seeds", type=int, default=10)
+    report_parser.set_defaults(func=bench_report)
+
+    export_parser = subparsers.add_parser("export", help="потоковий Excel-експорт")
+    export_parser.add_argument("--lessons", type=int, default=50000)
+    export_parser.add_argument("--days", type=int, default=60)
+    export_parser.set_defaults(func=bench_export)
+
+    latency_parser = subparsers.add_parser("latency", help="p50/p99 обробників: DB_OFFLOAD увімкнено і вимкнено")
+    latency_parser.add_argument("--lessons", type=int, default=200000)
+    latency_parser.add_argument("--duration", type=float, default=5.0)
+    latency_parser.add_argument("--rate", type=float, default=50.0)
+    latency_parser.add_argument("--slow-rate", type=float, default=2.0)
+    latency_parser.set_defaults(func=bench_latency)
+
+    seed_parser = subparsers.add_parser("seed", help="синтетична БД реалістичного обсягу")
+    seed_parser.add_argument("--output", required=True)
+    seed_parser.add_argument("--instructors", type=int, default=50)
+    seed_parser.add_argument("--lessons", type=int, default=200000)
+    seed_parser.add_argument("--years", type=int, default=3)
+    seed_parser.add_argument("--seed", type=int, default=42)
+    seed_parser.set_defaults(func=bench_seed)
+
+    suite_parser = subparsers.add_parser("suite", help="час кожної публічної функції БД і помічників бота")
+    suite_parser.add_argument("--db", help="готова БД (з seed); інакше генерується тимчасова")
+    suite_parser.add_argument("--instructors", type=int, default=50)
+    suite_parser.add_argument("--lessons", type=int, default=200000)
+    suite_parser.add_argument("--years", type=int, default=3)
+    suite_parser.add_argument("--rounds", type=int, default=5)
+    suite_parser.add_argument("--filter", help="лише функції, що містять рядок")
+    suite_parser.add_argument("--save", help="зберегти результати як базову лінію (JSON)")
+    suite_parser.add_argument("--compare", help="порівняти медіани з базовою лінією")
+    suite_parser.set_defaults(func=bench_suite)
+
+    wal_parser = subparsers.add_parser("wal", help="затримка читань під записами: журнал відкату проти WAL")
+    wal_parser.add_argument("--lessons", type=int, default=50000)
+    wal_parser.add_argument("--writers", type=int, default=2)
+    wal_parser.add_argument("--readers", type=int, default=4)
+    wal_parser.add_argument("--duration", type=float, default=5.0)
+    wal_parser.add_argument("--hold-ms", type=float, default=1.0, help="пауза перед COMMIT (відповідь у транзакції)")
+    wal_parser.set_defaults(func=bench_wal)
+
+    booking_parser = subparsers.add_parser("booking", help="час утримання блокування запису в save_lesson")
+    booking_parser.add_argument("--lessons", type=int, default=2000)
+    booking_parser.add_argument("--users", type=int, default=20)
+    booking_parser.add_argument("--duration", type=float, default=5.0)
+    booking_parser.add_argument("--rtt-ms", type=float, default=50.0, help="затримка відповіді Telegram")
+    booking_parser.set_defaults(func=bench_booking)
+
+    availability_parser = subparsers.add_parser("availability", help="маски вільних годин проти уроків і блокувань")
+    availability_parser.add_argument("--lessons", type=int, default=200000)
+    availability_parser.add_argument("--days", type=int, default=30)
+    availability_parser.add_argument("--iterations", type=int, default=500)
+    availability_parser.add_argument("--changes", type=int, default=500, help="випадкових змін розкладу")
+    availability_parser.set_defaults(func=bench_availability)
+
+    persistence_parser = subparsers.add_parser("persistence", help="write-behind стану розмов і відновлення після рестарту")
+    persistence_parser.add_argument("--users", type=int, default=200)
+    persistence_parser.add_argument("--ticks", type=int, default=50)
+    persistence_parser.add_argument("--keystrokes", type=int, default=100, help="змін user_data за тик")
+    persistence_parser.set_defaults(func=bench_persistence)
+
+    concurrency_parser = subparsers.add_parser("concurrency", help="черга одного учня проти слотів оновлень")
+    concurrency_parser.add_argument("--slots", type=int, default=4, help="max_concurrent_updates")
+    concurrency_parser.add_argument("--delay", type=float, default=0.2, help="тривалість оновлення учня, с")
+    concurrency_parser.set_defaults(func=bench_concurrency)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
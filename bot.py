@@ -1,10 +1,14 @@
 # bot.py - ВЕРСІЯ 20 PRODUCTION
 # ВИПРАВЛЕННЯ: rate_student_menu тепер показує всі completed уроки з оцінками - ТЕСТОВА ВЕРСІЯ З ОКРЕМОЮ БД
+import asyncio
 import sqlite3
 import re
+import secrets
 import logging
 import os
+import sys
 from datetime import datetime, timedelta
+from time import perf_counter
 from contextlib import contextmanager
 from io import BytesIO
 
@@ -17,9 +21,12 @@ from telegram.ext import (
     CallbackQueryHandler,
     filters
 )
+from telegram.request import HTTPXRequest
 import pytz
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Alignment, PatternFill
+from openpyxl.utils import get_column_letter
 
 # ==================== PRODUCTION КОНФІГУРАЦІЯ ====================
 # PRODUCTION БОТ TOKEN
@@ -31,6 +38,22 @@ ADMIN_ID = [
     884453802    # Стефанюк Ірина
 ]
 TIMEZONE = "Europe/Kyiv"
+# Адреса Bot API: локальний сервер або фейковий з loadtest.py (за замовчуванням — api.telegram.org)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+# Як часто (с) шукати завершені уроки та просити оцінку
+COMPLETED_CHECK_INTERVAL = int(os.getenv("COMPLETED_CHECK_INTERVAL", "900"))
+# Профілювати перші N секунд після старту і надіслати профіль власнику (0 — вимкнено)
+PROFILE_SECONDS = int(os.getenv("PROFILE_SECONDS", "0"))
+# Webhook-режим: публічна адреса сервісу (напр. https://bot.onrender.com); порожньо — polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+# Процеси-обробники у webhook-режимі; користувач завжди потрапляє в той самий (user_id % N)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WEBHOOK_PATH = "/telegram"
+# Telegram надсилає його в X-Telegram-Bot-Api-Secret-Token; чужі POST відкидаються
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Скільки оновлень різних користувачів обробляти одночасно (1 — строго по одному, як раніше)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
 
 # БАЗА ДАНИХ НА PERSISTENT DISK
 import os
@@ -42,9 +65,6 @@ else:
     print("⚠️ Persistent Disk не знайдено, використовую локальну БД")
 # ==================================================================
 
-# Робочі години
-WORK_HOURS_START = 8
-WORK_HOURS_END = 18
 # Ціни за годину
 PRICES = {
     "1 година": 420,
@@ -54,22 +74,44 @@ from database import (
     init_db, 
     init_lessons_table, 
     init_students_table,
+    init_persistence_table,
+    init_availability_table,
     migrate_database,
     get_instructors_by_transmission,
     get_instructor_by_name,
     get_instructor_by_telegram_id,
-    get_instructor_rating,
+    get_instructor_by_id,
+    get_active_instructors,
+    invalidate_instructor_cache,
+    get_instructor_availability,
+    get_instructors_availability,
+    get_instructor_ratings,
+    WORK_HOURS_START,
+    WORK_HOURS_END,
+    normalize_date,
+    lesson_starts_at,
+    duration_to_minutes,
+    minutes_to_hours,
     get_db as _original_get_db,
+    aio,
+    run_db,
+    shutdown_db_executor,
+    get_wal_size,
+    checkpoint_wal,
+    BOOKING_CONFLICT,
+    BOOKING_DAILY_LIMIT,
+    BOOKING_WEEKLY_LIMIT,
+    WAL_CHECKPOINT_INTERVAL,
+    WAL_TRUNCATE_BYTES,
     init_schedule_blocks_table,
-    get_instructor_stats_period,
-    get_admin_report_by_instructors,
-    get_instructor_report,
     get_all_instructors,
-    register_student,
-    get_student_by_telegram_id,
-    update_lesson,
     add_lesson_rating
 )
+from delivery import deliver
+from persistence import SQLitePersistence
+from concurrency import PerUserUpdateProcessor
+import metrics
+import profiler
 
 # ======================= HELPER FUNCTIONS =======================
 def get_student_by_phone(phone):
@@ -88,6 +130,12 @@ def get_student_by_phone(phone):
         logger.error(f"Error in get_student_by_phone: {e}")
         return None
 
+def lesson_price(tariff, duration):
+    """Вартість уроку для учня: 2 години — подвійний тариф, інше — один тариф; без тарифу — за PRICES"""
+    if tariff:
+        return tariff * 2 if "2" in duration else tariff
+    return PRICES.get(duration, 420)
+
 def add_instructor_rating(lesson_id, rating, feedback=""):
     """Додати оцінку та коментар інструктора для учня"""
     try:
@@ -104,20 +152,10 @@ def add_instructor_rating(lesson_id, rating, feedback=""):
         logger.error(f"Error in add_instructor_rating: {e}", exc_info=True)
         return False
 
-# Перевизначаємо get_db для тестової БД
-@contextmanager
-def get_db():
-    """Context manager для роботи з тестовою БД"""
-    conn = sqlite3.connect(DB_NAME)
-    try:
-        yield conn
-    finally:
-        conn.close()
-
-# Monkey patch для database модуля щоб використовував тестову БД
+# database модуль працює з БД на persistent disk через спільний пул з'єднань
 import database
 database.DB_NAME = DB_NAME
-database.get_db = get_db
+get_db = database.get_db
 
 # Налаштування логування
 logging.basicConfig(
@@ -164,6 +202,7 @@ def ensure_instructors_exist():
         
         if added > 0:
             conn.commit()
+            invalidate_instructor_cache()
             logger.info(f"🎉 Автоматично додано {added} інструкторів")
         else:
             logger.info("ℹ️ Всі інструктори вже є в базі")
@@ -184,13 +223,17 @@ def get_next_dates(days=14, instructor_name=None):
     else:
         start_date = now.date()
     
-    for i in range(days):
-        date = start_date + timedelta(days=i)
-        
-        if date < now.date():
-            continue
-            
-        date_formatted = date.strftime('%d.%m.%Y')
+    candidates = [
+        start_date + timedelta(days=i)
+        for i in range(days)
+        if start_date + timedelta(days=i) >= now.date()
+    ]
+    
+    # Маски вільних годин на все вікно — один запит до instructor_availability
+    if instructor_name:
+        free_by_date = get_free_hours_by_date(instructor_name, candidates)
+    
+    for date in candidates:
         weekday = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Нд"][date.weekday()]
         
         if date.weekday() == 5:
@@ -201,8 +244,7 @@ def get_next_dates(days=14, instructor_name=None):
             weekday_display = weekday
         
         if instructor_name:
-            free_slots = get_available_time_slots(instructor_name, date_formatted)
-            free_count = len(free_slots)
+            free_count = free_by_date.get(date, 0).bit_count()
             
             if free_count > 0:
                 formatted = f"{weekday_display} {date.strftime('%d.%m')} ({free_count})"
@@ -213,78 +255,99 @@ def get_next_dates(days=14, instructor_name=None):
     
     return dates
 
-def get_available_time_slots(instructor_name, date_str):
-    """Отримати вільні часові слоти для інструктора"""
+def _free_mask(date, now, busy_mask):
+    """Маска вільних годин дня (біт i — година WORK_HOURS_START + i): сьогодні — не раніше ніж за годину"""
+    is_today = date == now.date()
+    
+    if is_today:
+        min_time = now + timedelta(hours=1)
+        min_hour = min_time.hour
+        
+        if min_time.minute > 0:
+            min_hour += 1
+        
+        start_hour = max(min_hour, WORK_HOURS_START)
+    else:
+        start_hour = WORK_HOURS_START
+    
+    work_hours = (1 << (WORK_HOURS_END - WORK_HOURS_START)) - 1
+    past_hours = (1 << min(start_hour - WORK_HOURS_START, WORK_HOURS_END - WORK_HOURS_START)) - 1
+    return work_hours & ~past_hours & ~busy_mask
+
+def _mask_to_slots(mask):
+    return [f"{hour:02d}:00" for hour in range(WORK_HOURS_START, WORK_HOURS_END)
+            if mask >> (hour - WORK_HOURS_START) & 1]
+
+def get_free_hours_by_date(instructor_name, dates):
+    """Маски вільних годин інструктора на кілька дат: {date: free_mask}"""
     try:
         instructor_data = get_instructor_by_name(instructor_name)
         if not instructor_data:
-            return []
+            return {}
         
-        instructor_id = instructor_data[0]
+        busy = get_instructor_availability(instructor_data[0], dates)
+        if busy is None:
+            return {}
         
-        date_obj = datetime.strptime(date_str, "%d.%m.%Y")
         now = datetime.now(TZ)
-        is_today = date_obj.date() == now.date()
-        
-        all_slots = []
-        
-        if is_today:
-            min_time = now + timedelta(hours=1)
-            min_hour = min_time.hour
-            
-            if min_time.minute > 0:
-                min_hour += 1
-            
-            start_hour = max(min_hour, WORK_HOURS_START)
-        else:
-            start_hour = WORK_HOURS_START
-        
-        if start_hour < WORK_HOURS_START:
-            start_hour = WORK_HOURS_START
-        
-        hour = start_hour
-        while hour < WORK_HOURS_END:
-            all_slots.append(f"{hour:02d}:00")
-            hour += 1
-        
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT time, duration FROM lessons
-                WHERE instructor_id = ? AND date = ? AND status = 'active'
-            """, (instructor_id, date_str))
-            booked = cursor.fetchall()
-        
-        blocked_hours = set()
-        for booked_time, duration in booked:
-            if ':' not in booked_time:
-                continue
-            
-            start_h = int(booked_time.split(':')[0])
-            
-            if "1.5" in duration:
-                hours_blocked = 2
-            elif "2" in duration:
-                hours_blocked = 2
-            else:
-                hours_blocked = 1
-            
-            for i in range(hours_blocked):
-                blocked_hours.add(f"{start_h + i:02d}:00")
-        
-        from database import is_time_blocked
-        date_formatted = date_obj.strftime("%Y-%m-%d")
+        return {date: _free_mask(date, now, busy.get(date.strftime('%Y-%m-%d'), 0)) for date in dates}
         
-        free_slots = [
-            slot for slot in all_slots 
-            if slot not in blocked_hours
-            and not is_time_blocked(instructor_id, date_formatted, slot)
-        ]
+    except Exception as e:
+        logger.error(f"Помилка get_free_hours_by_date: {e}")
+        return {}
+
+def get_available_slots_by_date(instructor_name, dates):
+    """Вільні слоти інструктора на кілька дат: {date: [слоти]}"""
+    return {date: _mask_to_slots(mask) for date, mask in get_free_hours_by_date(instructor_name, dates).items()}
+
+def get_available_time_slots(instructor_name, date_str):
+    """Отримати вільні часові слоти для інструктора"""
+    try:
+        date = datetime.strptime(date_str, "%d.%m.%Y").date()
+    except Exception as e:
+        logger.error(f"Помилка get_available_time_slots: {e}")
+        return []
+    
+    return get_available_slots_by_date(instructor_name, [date]).get(date, [])
+
+def find_first_free_slots(transmission, days=14, limit=6):
+    """Найближчі вільні години всіх інструкторів коробки: [(date, "ГГ:00", ім'я, рейтинг)].
+
+    Спершу раніші, в одну годину — вищий рейтинг. Маски всього вікна для всіх
+    інструкторів — один запит, рейтинги — ще один, незалежно від кількості днів.
+    """
+    try:
+        instructors = {}
+        for name in get_instructors_by_transmission(transmission):
+            instructor_data = get_instructor_by_name(name)
+            if instructor_data:
+                instructors[instructor_data[0]] = name
+        if not instructors:
+            return []
         
-        return free_slots
+        now = datetime.now(TZ)
+        dates = [now.date() + timedelta(days=i) for i in range(days)]
+        busy = get_instructors_availability(instructors, dates)
+        if busy is None:
+            return []
+        ratings = get_instructor_ratings(instructors.values())
+        # Рейтинг за спаданням, при рівному — за ім'ям, як у списку інструкторів
+        ranked = sorted(instructors.items(), key=lambda item: (-ratings.get(item[1], 0), item[1]))
+        
+        slots = []
+        for date in dates:
+            free = [(name, _free_mask(date, now, busy[instructor_id].get(date.strftime('%Y-%m-%d'), 0)))
+                    for instructor_id, name in ranked]
+            for hour in range(WORK_HOURS_START, WORK_HOURS_END):
+                for name, mask in free:
+                    if mask >> (hour - WORK_HOURS_START) & 1:
+                        slots.append((date, f"{hour:02d}:00", name, ratings.get(name, 0)))
+                        if len(slots) == limit:
+                            return slots
+        return slots
         
     except Exception as e:
-        logger.error(f"Помилка get_available_time_slots: {e}")
+        logger.error(f"Помилка find_first_free_slots: {e}")
         return []
 
 # ======================= VALIDATORS =======================
@@ -317,10 +380,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if is_admin(user_id):
         try:
-            with get_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM instructors WHERE telegram_id = ?", (user_id,))
-                is_instructor = cursor.fetchone() is not None
+            is_instructor = get_instructor_by_telegram_id(user_id) is not None
             
             if is_instructor:
                 keyboard = [
@@ -362,10 +422,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
 
     try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM instructors WHERE telegram_id = ?", (user_id,))
-            is_instructor = cursor.fetchone() is not None
+        is_instructor = get_instructor_by_telegram_id(user_id) is not None
 
         if is_instructor:
             keyboard = [
@@ -386,7 +443,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode="Markdown"
             )
         else:
-            student = get_student_by_telegram_id(user_id)
+            student = await aio.get_student_by_telegram_id(user_id)
             
             if student:
                 context.user_data["student_name"] = student[1]
@@ -438,7 +495,7 @@ async def register_student_with_tariff(update: Update, context: ContextTypes.DEF
     user_id = user.id
     logger.info(f"🟡 register_student_with_tariff викликано! User: {user_id}, Tariff: {tariff}")
     
-    student = get_student_by_telegram_id(user_id)
+    student = await aio.get_student_by_telegram_id(user_id)
     
     if student:
         logger.info(f"✅ Учень вже зареєстрований: {student[1]}")
@@ -474,967 +531,757 @@ async def register_student_with_tariff(update: Update, context: ContextTypes.DEF
 
 # ======================= HANDLE MESSAGE =======================
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Головний обробник"""
+    """Головний обробник: маршрутизація за таблицею MESSAGE_ROUTES"""
     text = update.message.text
     state = context.user_data.get("state", "")
-    user_id = update.message.from_user.id
-    
+
     logger.info(f"📥 Message: '{text}' | State: '{state}'")
-    
+
     try:
-        # === ОЦІНЮВАННЯ ІНСТРУКТОРА УЧНЕМ ===
-        if text in ["⭐", "⭐⭐", "⭐⭐⭐", "⭐⭐⭐⭐", "⭐⭐⭐⭐⭐"]:
-            lesson_data = context.bot_data.get(f"rating_lesson_{user_id}")
-            
-            if lesson_data:
-                rating_map = {
-                    "⭐": 1,
-                    "⭐⭐": 2,
-                    "⭐⭐⭐": 3,
-                    "⭐⭐⭐⭐": 4,
-                    "⭐⭐⭐⭐⭐": 5
-                }
-                rating = rating_map.get(text, 5)
-                
-                with get_db() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        UPDATE lessons
-                        SET rating = ?
-                        WHERE id = ?
-                    """, (rating, lesson_data['lesson_id']))
-                    conn.commit()
-                
-                context.bot_data[f"rating_feedback_{user_id}"] = {
-                    'lesson_id': lesson_data['lesson_id'],
-                    'instructor_name': lesson_data['instructor_name'],
-                    'rating': rating
-                }
-                
-                del context.bot_data[f"rating_lesson_{user_id}"]
-                
-                context.user_data["state"] = "rating_feedback"
-                
-                keyboard = [
-                    [KeyboardButton("✍️ Написати коментар")],
-                    [KeyboardButton("⏭️ Пропустити")]
-                ]
-                
-                await update.message.reply_text(
-                    f"✅ *Дякуємо за оцінку!*\n"
-                    f"⭐ Оцінка: {rating}/5\n\n"
-                    f"💬 Хочете залишити коментар?",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
-                    parse_mode="Markdown"
-                )
-                
-                logger.info(f"✅ Учень {user_id} оцінив урок {lesson_data['lesson_id']}: {rating}/5")
-                return
-            else:
-                logger.warning(f"⚠️ Учень {user_id} надіслав оцінку але немає lesson_data")
-        
-        if text == "⏭️ Пропустити" and f"rating_lesson_{user_id}" in context.bot_data:
-            lesson_data = context.bot_data.get(f"rating_lesson_{user_id}")
-            del context.bot_data[f"rating_lesson_{user_id}"]
-            
-            await update.message.reply_text(
-                f"✅ Дякуємо!\n\n"
-                f"📅 {lesson_data['date']} {lesson_data['time']}\n"
-                f"👨‍🏫 {lesson_data['instructor_name']}"
-            )
-            
-            logger.info(f"⏭️ Учень {user_id} пропустив оцінювання уроку {lesson_data['lesson_id']}")
-            await start(update, context)
-            return
-        
-        if state == "rating_feedback":
-            feedback_data = context.bot_data.get(f"rating_feedback_{user_id}")
-            
-            if text == "✍️ Написати коментар":
-                context.user_data["state"] = "rating_feedback_input"
-                
-                keyboard = [[KeyboardButton("⏭️ Пропустити")]]
-                
-                await update.message.reply_text(
-                    "💬 Введіть ваш коментар:",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                )
-                return
-            
-            elif text == "⏭️ Пропустити":
-                if feedback_data:
-                    del context.bot_data[f"rating_feedback_{user_id}"]
-                    context.user_data.clear()
-                    
-                    await update.message.reply_text(
-                        f"✅ *Дякуємо за відгук!*\n\n"
-                        f"👨‍🏫 {feedback_data['instructor_name']}\n"
-                        f"⭐ Оцінка: {feedback_data['rating']}/5",
-                        parse_mode="Markdown"
-                    )
-                    
-                    logger.info(f"⏭️ Учень {user_id} пропустив коментар для уроку {feedback_data['lesson_id']}")
-                    await start(update, context)
-                    return
-        
-        if state == "rating_feedback_input":
-            feedback_data = context.bot_data.get(f"rating_feedback_{user_id}")
-            
-            if text == "⏭️ Пропустити":
-                if feedback_data:
-                    del context.bot_data[f"rating_feedback_{user_id}"]
-                    context.user_data.clear()
-                    
-                    await update.message.reply_text(
-                        f"✅ *Дякуємо за відгук!*\n\n"
-                        f"👨‍🏫 {feedback_data['instructor_name']}\n"
-                        f"⭐ Оцінка: {feedback_data['rating']}/5",
-                        parse_mode="Markdown"
-                    )
-                    
-                    logger.info(f"⏭️ Учень {user_id} пропустив коментар для уроку {feedback_data['lesson_id']}")
-                    await start(update, context)
-                    return
-            else:
-                feedback_text = text
-                
-                with get_db() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        UPDATE lessons
-                        SET feedback = ?
-                        WHERE id = ?
-                    """, (feedback_text, feedback_data['lesson_id']))
-                    conn.commit()
-                
-                del context.bot_data[f"rating_feedback_{user_id}"]
-                context.user_data.clear()
-                
-                await update.message.reply_text(
-                    f"✅ *Дякуємо за відгук!*\n\n"
-                    f"👨‍🏫 {feedback_data['instructor_name']}\n"
-                    f"⭐ Оцінка: {feedback_data['rating']}/5\n"
-                    f"💬 \"{feedback_text}\"",
-                    parse_mode="Markdown"
-                )
-                
-                logger.info(f"✅ Учень {user_id} залишив коментар для уроку {feedback_data['lesson_id']}")
-                await start(update, context)
-                return
-        
-        # === РЕЄСТРАЦІЯ УЧНЯ ===
-        if state == "registration_name":
-            if text == "🔙 Скасувати":
-                await update.message.reply_text("❌ Реєстрацію скасовано.")
-                return
-            
-            context.user_data["student_name"] = text
-            context.user_data["state"] = "registration_phone"
-            
-            keyboard = [[KeyboardButton("📱 Надати номер", request_contact=True)]]
-            keyboard.append([KeyboardButton("🔙 Скасувати")])
-            
-            await update.message.reply_text(
-                "📱 Тепер надайте ваш номер телефону:\n"
-                "(натисніть кнопку нижче або введіть вручну)",
-                reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-            )
-            return
-        
-        if state == "registration_phone":
-            if text == "🔙 Скасувати":
-                await update.message.reply_text("❌ Реєстрацію скасовано.")
-                return
-            
-            phone = None
-            if update.message.contact:
-                phone = update.message.contact.phone_number
-            elif validate_phone(text):
-                phone = text
-            else:
-                await update.message.reply_text("⚠️ Невірний формат номера. Спробуйте ще раз:")
-                return
-            
-            user_id = update.message.from_user.id
-            name = context.user_data["student_name"]
-            tariff = context.user_data["registration_tariff"]
-            
-            if register_student(name, phone, user_id, tariff, f"link_{tariff}"):
-                keyboard = [
-                    [KeyboardButton("🚀 Записатися на заняття")],
-                    [KeyboardButton("📋 Мої записи")]
-                ]
-                
-                await update.message.reply_text(
-                    f"✅ *Реєстрацію завершено!*\n\n"
-                    f"👤 Ім'я: {name}\n"
-                    f"📱 Телефон: {phone}\n"
-                    f"💰 Ваш тариф: *{tariff} грн/год* (фіксований)\n\n"
-                    f"ℹ️ Тариф закріплений за вами і не змінюється.\n\n"
-                    f"Натисніть кнопку нижче, щоб записатися на заняття:",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
-                    parse_mode="Markdown"
-                )
-            else:
-                await update.message.reply_text("❌ Помилка реєстрації. Спробуйте пізніше.")
-            
-            context.user_data.clear()
-            return
+        # Обробник, що повернув False, передає повідомлення наступному в ланцюжку
+        by_text, default_chain = ROUTE_INDEX.get(state) or ROUTE_INDEX[None]
+        for handler in by_text.get(text, default_chain):
+            with metrics.measure("route", handler.__name__, state):
+                handled = await handler(update, context)
+            if handled is not False:
+                break
+    except Exception as e:
+        logger.error(f"Error in handle_message: {e}", exc_info=True)
+        await update.message.reply_text("❌ Виникла помилка. Спробуйте /start")
 
-        # === ПАНЕЛЬ АДМІНА ===
-        if text == "🔐 Панель адміна":
-            if not is_admin(update.message.from_user.id):
-                await update.message.reply_text("❌ У вас немає доступу.")
-                return
-            await show_admin_panel(update, context)
-            return
-        
-        if text == "📥 Експорт в Excel":
-            await show_export_period_menu(update, context)
-            return
-        
-        if state == "admin_panel":
-            if update.message.text == "✏️ Управління записами":
-                await handle_admin_manage_bookings(update, context)
-                return
-            if update.message.text == "➕ Додати учня":
-                await admin_add_student_start(update, context)
-                return
-            await handle_admin_report(update, context)
-            return
-        
-        # === ДОДАВАННЯ УЧНЯ АДМІНОМ ===
-        if state == "admin_add_student_name":
-            await handle_admin_add_student_name(update, context)
-            return
-        
-        if state == "admin_add_student_phone":
-            await handle_admin_add_student_phone(update, context)
-            return
-        
-        if state == "admin_add_student_tariff":
-            await handle_admin_add_student_tariff(update, context)
-            return
-        
-        if state == "admin_add_student_tgid":
-            await handle_admin_add_student_tgid(update, context)
-            return
-        
-        if state == "admin_manage_bookings":
-            await handle_admin_manage_bookings(update, context)
-            return
-        
-        if state == "admin_cancel_select_date":
-            await handle_admin_cancel_select_date(update, context)
-            return
-        
-        if state == "admin_cancel_select_instructor":
-            await handle_admin_cancel_select_instructor(update, context)
-            return
-        
-        if state == "admin_cancel_select_lesson":
-            await handle_admin_cancel_select_lesson(update, context)
-            return
-        
-        # === РУЧНИЙ ЗАПИС УЧНЯ АДМІНОМ ===
-        if state == "admin_manual_enter_phone":
-            await handle_admin_manual_enter_phone(update, context)
-            return
-        
-        if state == "admin_manual_confirm_student":
-            await handle_admin_manual_confirm_student(update, context)
-            return
-        
-        if state == "admin_manual_enter_name":
-            await handle_admin_manual_enter_name(update, context)
-            return
-        
-        if state == "admin_manual_select_tariff":
-            await handle_admin_manual_select_tariff(update, context)
-            return
-        
-        if state == "admin_manual_select_transmission":
-            await handle_admin_manual_select_transmission(update, context)
-            return
-        
-        if state == "admin_manual_select_instructor":
-            await handle_admin_manual_select_instructor(update, context)
-            return
-        
-        if state == "admin_manual_select_date":
-            await handle_admin_manual_select_date(update, context)
-            return
-        
-        if state == "admin_manual_select_time":
-            await handle_admin_manual_select_time(update, context)
-            return
-        
-        if state == "admin_manual_select_duration":
-            await handle_admin_manual_select_duration(update, context)
-            return
-        
-        if state == "admin_manual_confirm":
-            await handle_admin_manual_confirm(update, context)
-            return
-        
-        if state == "admin_select_instructor_report":
-            await handle_instructor_report_select(update, context)
-            return
-        if state == "admin_instructor_report_period":
-            await handle_instructor_report_period(update, context)
-            return
-        if state == "admin_instructor_custom_period":
-            await handle_instructor_custom_period(update, context)
-            return
-        if state == "admin_report_period":
-            await handle_admin_report(update, context)
-            return
-        
-        # === ЕКСПОРТ З ВИБОРОМ ПЕРІОДУ ===
-        if state == "export_period":
-            await handle_export_period_choice(update, context)
-            return
-        
-        if state == "export_custom_period":
-            await handle_export_custom_period(update, context)
-            return
+# === ОЦІНЮВАННЯ ІНСТРУКТОРА УЧНЕМ ===
+async def rate_instructor_by_student(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    user_id = update.message.from_user.id
+    lesson_data = context.bot_data.get(f"rating_lesson_{user_id}")
 
-        # === МЕНЮ ІНСТРУКТОРА ===
-        if text == "🔙 Назад":
-            with get_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM instructors WHERE telegram_id = ?", (user_id,))
-                is_instructor = cursor.fetchone() is not None
-            
-            if is_instructor:
-                await start(update, context)
-                return
-        
-        if text == "📅 Мій розклад":
-            await show_instructor_schedule(update, context)
-            return
-        elif text == "⚙️ Управління графіком":
-            await manage_schedule(update, context)
-            return
-        elif text == "📊 Моя статистика":
-            with get_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM instructors WHERE telegram_id = ?", (user_id,))
-                is_instructor = cursor.fetchone() is not None
-            
-            if is_instructor:
-                await show_instructor_stats_menu(update, context)
-            else:
-                await show_student_statistics(update, context)
-            return
-        elif text == "❌ Історія скасувань":
-            await show_cancellation_history(update, context)
-            return
-        elif text == "⭐ Оцінити учня":
-            await rate_student_menu(update, context)
-            return
+    if not lesson_data:
+        logger.warning(f"⚠️ Учень {user_id} надіслав оцінку але немає lesson_data")
+        return False
 
-        # === СТАТИСТИКА ЗА ПЕРІОД ===
-        if state == "stats_period":
-            await handle_stats_period(update, context)
-            return
-        
-        if state == "stats_custom_period":
-            await handle_stats_custom_period(update, context)
-            return
-        
-        # === ОЦІНЮВАННЯ УЧНЯ ===
-        if state in ["rating_select_lesson", "rating_give_score", "rating_give_feedback"]:
-            await handle_rating_flow(update, context)
-            return
+    rating_map = {
+        "⭐": 1,
+        "⭐⭐": 2,
+        "⭐⭐⭐": 3,
+        "⭐⭐⭐⭐": 4,
+        "⭐⭐⭐⭐⭐": 5
+    }
+    rating = rating_map.get(text, 5)
 
-        # === КОРИГУВАННЯ ГРАФІКУ ===
-        if state in ["edit_schedule_select", "edit_schedule_date", "edit_schedule_time"]:
-            await handle_edit_schedule(update, context)
-            return
+    await aio.execute_write("""
+        UPDATE lessons
+        SET rating = ?
+        WHERE id = ?
+    """, (rating, lesson_data['lesson_id']))
 
-        # === УПРАВЛІННЯ ГРАФІКОМ ===
-        if state in ["schedule_menu", "block_choose_date", "block_choose_time_start", 
-                     "block_choose_time_end", "block_choose_reason", "unblock_choose_date", "waiting_unblock"]:
-            await handle_schedule_management(update, context)
-            return
+    context.bot_data[f"rating_feedback_{user_id}"] = {
+        'lesson_id': lesson_data['lesson_id'],
+        'instructor_name': lesson_data['instructor_name'],
+        'rating': rating
+    }
 
-        # === МЕНЮ СТУДЕНТА ===
-        if text == "🚀 Записатися на заняття":
-            keyboard = [
-                [KeyboardButton("🚗 Автомат"), KeyboardButton("🚙 Механіка")]
-            ]
-            context.user_data["state"] = "waiting_for_transmission"
-            
-            await update.message.reply_text(
-                "🚗 Оберіть тип коробки передач:",
-                reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            )
-            return
-        
-        if text == "📖 Мої записи" or text == "📋 Мої записи":
-            await show_student_lessons(update, context)
-            return
-        
-        if text == "❌ Скасувати запис":
-            await show_lessons_to_cancel(update, context)
-            return
-        
-        # === СКАСУВАННЯ ЗАПИСУ ===
-        if state == "cancel_lesson_select":
-            await handle_cancel_lesson(update, context)
-            return
-        
-        if state == "cancel_lesson_confirm":
-            await handle_cancel_confirmation(update, context)
-            return
-        
-        # === ПІДТВЕРДЖЕННЯ ===
-        if state == "waiting_for_confirmation":
-            if text == "✅ Підтвердити":
-                await save_lesson(update, context)
-                return
-            elif text in ["💬 Додати коментар", "✏️ Змінити коментар"]:
-                context.user_data["state"] = "waiting_for_booking_comment"
-                
-                keyboard = [
-                    [KeyboardButton("⏭️ Пропустити")],
-                    [KeyboardButton("🔙 Назад")]
-                ]
-                
-                await update.message.reply_text(
-                    "💬 *Введіть коментар для інструктора:*\n\n"
-                    "_Наприклад:_\n"
-                    "• \"Перше заняття\"\n"
-                    "• \"буду чекати в Тисмениці\"\n"
-                    "• \"практичний іспиту\"",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
-                    parse_mode="Markdown"
-                )
-                return
-            elif text == "🔙 Скасувати":
-                await update.message.reply_text("❌ Запис скасовано.")
-                await start(update, context)
-                return
-        
-        # === ВВЕДЕННЯ КОМЕНТАРЯ ===
-        if state == "waiting_for_booking_comment":
-            if text == "🔙 Назад":
-                context.user_data["state"] = "waiting_for_confirmation"
-                await show_booking_confirmation(update, context)
-                return
-            elif text == "⏭️ Пропустити":
-                context.user_data["booking_comment"] = ""
-                await show_booking_confirmation(update, context)
-                return
-            else:
-                context.user_data["booking_comment"] = text
-                
-                await update.message.reply_text(
-                    f"✅ Коментар збережено!\n\n"
-                    f"💬 \"{text}\""
-                )
-                
-                await show_booking_confirmation(update, context)
-                return
-        
-        # === МЕНЮ ВИБОРУ ПЕРІОДУ РОЗКЛАДУ ===
-        if state == "instructor_schedule_menu":
-            now = datetime.now(TZ)
-            today = now.date()
-            
-            if text == "📅 На сьогодні":
-                await show_instructor_schedule_period(update, context, date_from=today, date_to=today)
-                return
-            elif text == "📅 На завтра":
-                tomorrow = today + timedelta(days=1)
-                await show_instructor_schedule_period(update, context, date_from=tomorrow, date_to=tomorrow)
-                return
-            elif text == "📅 На тиждень":
-                week_end = today + timedelta(days=6)
-                await show_instructor_schedule_period(update, context, date_from=today, date_to=week_end)
-                return
-            elif text == "📅 Свій період":
-                context.user_data["state"] = "instructor_schedule_custom_period"
-                keyboard = [[KeyboardButton("🔙 Назад")]]
-                await update.message.reply_text(
-                    "📅 Введіть період у форматі:\n"
-                    "*ДД.ММ.РРРР - ДД.ММ.РРРР*\n\n"
-                    "Наприклад: 01.03.2026 - 15.03.2026",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
-                    parse_mode="Markdown"
-                )
-                return
-            elif text == "🔙 Назад":
-                await start(update, context)
-                return
-        
-        # === ВВЕДЕННЯ СВОГО ПЕРІОДУ ===
-        if state == "instructor_schedule_custom_period":
-            if text == "🔙 Назад":
-                await show_instructor_schedule(update, context)
-                return
-            
-            try:
-                parts = text.split('-')
-                if len(parts) != 2:
-                    raise ValueError("Неправильний формат")
-                
-                date_from_str = parts[0].strip()
-                date_to_str = parts[1].strip()
-                
-                date_from = datetime.strptime(date_from_str, "%d.%m.%Y").date()
-                date_to = datetime.strptime(date_to_str, "%d.%m.%Y").date()
-                
-                if date_from > date_to:
-                    await update.message.reply_text("❌ Дата початку не може бути пізніше дати кінця.")
-                    return
-                
-                await show_instructor_schedule_period(update, context, date_from=date_from, date_to=date_to)
-                return
-                
-            except Exception as e:
-                await update.message.reply_text(
-                    "❌ Неправильний формат дати.\n\n"
-                    "Використовуйте формат: *ДД.ММ.РРРР - ДД.ММ.РРРР*\n"
-                    "Наприклад: 01.03.2026 - 15.03.2026",
-                    parse_mode="Markdown"
-                )
-                return
-        
-        # === ВИБІР КОРОБКИ ===
-        if state == "waiting_for_transmission":
-            if text == "👨‍🏫 Обрати іншого інструктора":
-                transmission = context.user_data.get("transmission")
-                if transmission:
-                    context.user_data["state"] = "waiting_for_instructor"
-                    instructors = get_instructors_by_transmission(transmission)
-                    if not instructors:
-                        await update.message.reply_text("😔 Немає інструкторів для цього типу.")
-                        return
-
-                    keyboard = []
-                    for instructor in instructors:
-                        rating = get_instructor_rating(instructor)
-                        if rating > 0:
-                            stars = "⭐" * int(rating)
-                            keyboard.append([f"{instructor} {stars} ({rating:.1f})"])
-                        else:
-                            keyboard.append([f"{instructor} 🆕"])
-                    
-                    keyboard.append([KeyboardButton("🔙 Назад")])
-                    
-                    await update.message.reply_text(
-                        "👨‍🏫 Оберіть інструктора:",
-                        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                    )
-                    return
-            
-            if text not in ["🚗 Автомат", "🚙 Механіка"]:
-                await update.message.reply_text("⚠️ Оберіть коробку передач із меню.")
-                return
-            
-            transmission = "Автомат" if text == "🚗 Автомат" else "Механіка"
-            context.user_data["transmission"] = transmission
-            context.user_data["state"] = "waiting_for_instructor"
+    del context.bot_data[f"rating_lesson_{user_id}"]
+
+    context.user_data["state"] = "rating_feedback"
+
+    keyboard = [
+        [KeyboardButton("✍️ Написати коментар")],
+        [KeyboardButton("⏭️ Пропустити")]
+    ]
+
+    await update.message.reply_text(
+        f"✅ *Дякуємо за оцінку!*\n"
+        f"⭐ Оцінка: {rating}/5\n\n"
+        f"💬 Хочете залишити коментар?",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
+        parse_mode="Markdown"
+    )
+
+    logger.info(f"✅ Учень {user_id} оцінив урок {lesson_data['lesson_id']}: {rating}/5")
+
+async def skip_instructor_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    if f"rating_lesson_{user_id}" not in context.bot_data:
+        return False
+
+    lesson_data = context.bot_data.get(f"rating_lesson_{user_id}")
+    del context.bot_data[f"rating_lesson_{user_id}"]
+
+    await update.message.reply_text(
+        f"✅ Дякуємо!\n\n"
+        f"📅 {lesson_data['date']} {lesson_data['time']}\n"
+        f"👨‍🏫 {lesson_data['instructor_name']}"
+    )
+
+    logger.info(f"⏭️ Учень {user_id} пропустив оцінювання уроку {lesson_data['lesson_id']}")
+    await start(update, context)
+
+async def ask_rating_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["state"] = "rating_feedback_input"
+
+    keyboard = [[KeyboardButton("⏭️ Пропустити")]]
+
+    await update.message.reply_text(
+        "💬 Введіть ваш коментар:",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    )
+
+async def skip_rating_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    feedback_data = context.bot_data.get(f"rating_feedback_{user_id}")
+    if not feedback_data:
+        return False
+
+    del context.bot_data[f"rating_feedback_{user_id}"]
+    context.user_data.clear()
+
+    await update.message.reply_text(
+        f"✅ *Дякуємо за відгук!*\n\n"
+        f"👨‍🏫 {feedback_data['instructor_name']}\n"
+        f"⭐ Оцінка: {feedback_data['rating']}/5",
+        parse_mode="Markdown"
+    )
+
+    logger.info(f"⏭️ Учень {user_id} пропустив коментар для уроку {feedback_data['lesson_id']}")
+    await start(update, context)
+
+async def save_rating_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    feedback_data = context.bot_data.get(f"rating_feedback_{user_id}")
+    feedback_text = update.message.text
+
+    await aio.execute_write("""
+        UPDATE lessons
+        SET feedback = ?
+        WHERE id = ?
+    """, (feedback_text, feedback_data['lesson_id']))
+
+    del context.bot_data[f"rating_feedback_{user_id}"]
+    context.user_data.clear()
+
+    await update.message.reply_text(
+        f"✅ *Дякуємо за відгук!*\n\n"
+        f"👨‍🏫 {feedback_data['instructor_name']}\n"
+        f"⭐ Оцінка: {feedback_data['rating']}/5\n"
+        f"💬 \"{feedback_text}\"",
+        parse_mode="Markdown"
+    )
+
+    logger.info(f"✅ Учень {user_id} залишив коментар для уроку {feedback_data['lesson_id']}")
+    await start(update, context)
+
+# === РЕЄСТРАЦІЯ УЧНЯ ===
+async def cancel_registration(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("❌ Реєстрацію скасовано.")
+
+async def handle_registration_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["student_name"] = update.message.text
+    context.user_data["state"] = "registration_phone"
+
+    keyboard = [[KeyboardButton("📱 Надати номер", request_contact=True)]]
+    keyboard.append([KeyboardButton("🔙 Скасувати")])
+
+    await update.message.reply_text(
+        "📱 Тепер надайте ваш номер телефону:\n"
+        "(натисніть кнопку нижче або введіть вручну)",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    )
+
+async def handle_registration_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+
+    phone = None
+    if update.message.contact:
+        phone = update.message.contact.phone_number
+    elif validate_phone(text):
+        phone = text
+    else:
+        await update.message.reply_text("⚠️ Невірний формат номера. Спробуйте ще раз:")
+        return
+
+    user_id = update.message.from_user.id
+    name = context.user_data["student_name"]
+    tariff = context.user_data["registration_tariff"]
+
+    if await aio.register_student(name, phone, user_id, tariff, f"link_{tariff}"):
+        keyboard = [
+            [KeyboardButton("🚀 Записатися на заняття")],
+            [KeyboardButton("📋 Мої записи")]
+        ]
+
+        await update.message.reply_text(
+            f"✅ *Реєстрацію завершено!*\n\n"
+            f"👤 Ім'я: {name}\n"
+            f"📱 Телефон: {phone}\n"
+            f"💰 Ваш тариф: *{tariff} грн/год* (фіксований)\n\n"
+            f"ℹ️ Тариф закріплений за вами і не змінюється.\n\n"
+            f"Натисніть кнопку нижче, щоб записатися на заняття:",
+            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
+            parse_mode="Markdown"
+        )
+    else:
+        await update.message.reply_text("❌ Помилка реєстрації. Спробуйте пізніше.")
+
+    context.user_data.clear()
+
+# === ПАНЕЛЬ АДМІНА ===
+async def open_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас немає доступу.")
+        return
+    await show_admin_panel(update, context)
+
+# === МЕНЮ ІНСТРУКТОРА ===
+def is_instructor_user(user_id):
+    return get_instructor_by_telegram_id(user_id) is not None
+
+async def back_to_instructor_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_instructor_user(update.message.from_user.id):
+        return False
+    await start(update, context)
+
+async def show_my_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if is_instructor_user(update.message.from_user.id):
+        await show_instructor_stats_menu(update, context)
+    else:
+        await show_student_statistics(update, context)
+
+# === МЕНЮ СТУДЕНТА ===
+async def start_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [
+        [KeyboardButton("🚗 Автомат"), KeyboardButton("🚙 Механіка")]
+    ]
+    context.user_data["state"] = "waiting_for_transmission"
+
+    await update.message.reply_text(
+        "🚗 Оберіть тип коробки передач:",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    )
+
+# === ПІДТВЕРДЖЕННЯ ===
+async def ask_booking_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["state"] = "waiting_for_booking_comment"
+
+    keyboard = [
+        [KeyboardButton("⏭️ Пропустити")],
+        [KeyboardButton("🔙 Назад")]
+    ]
+
+    await update.message.reply_text(
+        "💬 *Введіть коментар для інструктора:*\n\n"
+        "_Наприклад:_\n"
+        "• \"Перше заняття\"\n"
+        "• \"буду чекати в Тисмениці\"\n"
+        "• \"практичний іспиту\"",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
+        parse_mode="Markdown"
+    )
+
+async def cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("❌ Запис скасовано.")
+    await start(update, context)
+
+# === ВВЕДЕННЯ КОМЕНТАРЯ ===
+async def back_to_booking_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["state"] = "waiting_for_confirmation"
+    await show_booking_confirmation(update, context)
+
+async def skip_booking_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["booking_comment"] = ""
+    await show_booking_confirmation(update, context)
+
+async def save_booking_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    context.user_data["booking_comment"] = text
+
+    await update.message.reply_text(
+        f"✅ Коментар збережено!\n\n"
+        f"💬 \"{text}\""
+    )
+
+    await show_booking_confirmation(update, context)
+
+# === МЕНЮ ВИБОРУ ПЕРІОДУ РОЗКЛАДУ ===
+async def show_schedule_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    today = datetime.now(TZ).date()
+    await show_instructor_schedule_period(update, context, date_from=today, date_to=today)
+
+async def show_schedule_tomorrow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tomorrow = datetime.now(TZ).date() + timedelta(days=1)
+    await show_instructor_schedule_period(update, context, date_from=tomorrow, date_to=tomorrow)
+
+async def show_schedule_week(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    today = datetime.now(TZ).date()
+    week_end = today + timedelta(days=6)
+    await show_instructor_schedule_period(update, context, date_from=today, date_to=week_end)
+
+async def ask_schedule_custom_period(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["state"] = "instructor_schedule_custom_period"
+    keyboard = [[KeyboardButton("🔙 Назад")]]
+    await update.message.reply_text(
+        "📅 Введіть період у форматі:\n"
+        "*ДД.ММ.РРРР - ДД.ММ.РРРР*\n\n"
+        "Наприклад: 01.03.2026 - 15.03.2026",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
+        parse_mode="Markdown"
+    )
+
+# === ВВЕДЕННЯ СВОГО ПЕРІОДУ ===
+async def handle_schedule_custom_period(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    try:
+        parts = text.split('-')
+        if len(parts) != 2:
+            raise ValueError("Неправильний формат")
+
+        date_from_str = parts[0].strip()
+        date_to_str = parts[1].strip()
+
+        date_from = datetime.strptime(date_from_str, "%d.%m.%Y").date()
+        date_to = datetime.strptime(date_to_str, "%d.%m.%Y").date()
+
+        if date_from > date_to:
+            await update.message.reply_text("❌ Дата початку не може бути пізніше дати кінця.")
+            return
+
+        await show_instructor_schedule_period(update, context, date_from=date_from, date_to=date_to)
+
+    except Exception as e:
+        await update.message.reply_text(
+            "❌ Неправильний формат дати.\n\n"
+            "Використовуйте формат: *ДД.ММ.РРРР - ДД.ММ.РРРР*\n"
+            "Наприклад: 01.03.2026 - 15.03.2026",
+            parse_mode="Markdown"
+        )
+
+# === ВИБІР КОРОБКИ ===
+async def send_instructor_choice(update: Update, instructors):
+    keyboard = []
+    ratings = await aio.get_instructor_ratings(instructors)
+    for instructor in instructors:
+        rating = ratings.get(instructor, 0)
+        if rating > 0:
+            stars = "⭐" * int(rating)
+            keyboard.append([f"{instructor} {stars} ({rating:.1f})"])
+        else:
+            keyboard.append([f"{instructor} 🆕"])
+
+    keyboard.append([KeyboardButton("⚡ Найближчий вільний час")])
+    keyboard.append([KeyboardButton("🔙 Назад")])
+
+    await update.message.reply_text(
+        "👨‍🏫 Оберіть інструктора:",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    )
+
+async def choose_another_instructor(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    transmission = context.user_data.get("transmission")
+    if not transmission:
+        await handle_transmission_choice(update, context)
+        return
+
+    context.user_data["state"] = "waiting_for_instructor"
+    instructors = get_instructors_by_transmission(transmission)
+    if not instructors:
+        await update.message.reply_text("😔 Немає інструкторів для цього типу.")
+        return
+
+    await send_instructor_choice(update, instructors)
+
+async def handle_transmission_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    if text not in ["🚗 Автомат", "🚙 Механіка"]:
+        await update.message.reply_text("⚠️ Оберіть коробку передач із меню.")
+        return
+
+    transmission = "Автомат" if text == "🚗 Автомат" else "Механіка"
+    context.user_data["transmission"] = transmission
+    context.user_data["state"] = "waiting_for_instructor"
+
+    instructors = get_instructors_by_transmission(transmission)
+    if not instructors:
+        await update.message.reply_text("😔 Немає інструкторів для цього типу.")
+        return
+
+    await send_instructor_choice(update, instructors)
+
+# === НАЙБЛИЖЧИЙ ВІЛЬНИЙ ЧАС ===
+async def show_first_free_slots(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    transmission = context.user_data.get("transmission")
+    if not transmission:
+        await start_booking(update, context)
+        return
+
+    slots = await run_db(find_first_free_slots, transmission, 14, 6)
+    if not slots:
+        await update.message.reply_text(
+            "😔 У всіх інструкторів зайняті години на найближчі 14 днів.\n"
+            "Оберіть інструктора або зайдіть завтра після 8:00."
+        )
+        return
+
+    offered = {}
+    keyboard = []
+    for date, time, name, rating in slots:
+        weekday = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Нд"][date.weekday()]
+        mark = f"⭐ {rating:.1f}" if rating > 0 else "🆕"
+        label = f"{weekday} {date.strftime('%d.%m')} {time} · {name} {mark}"
+        offered[label] = [name, date.strftime('%d.%m.%Y'), time]
+        keyboard.append([KeyboardButton(label)])
+    keyboard.append([KeyboardButton("🔙 Назад")])
+
+    context.user_data["first_free_slots"] = offered
+    context.user_data["state"] = "waiting_for_first_slot"
+
+    await update.message.reply_text(
+        "⚡ Найближчі вільні години (раніші — вище, в одну годину — за рейтингом):",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    )
+
+async def handle_first_slot_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    choice = context.user_data.get("first_free_slots", {}).get(update.message.text)
+    if not choice:
+        await update.message.reply_text("⚠️ Оберіть час з кнопок нижче.")
+        return
+
+    instructor, date, time = choice
+    free_slots = await run_db(get_available_time_slots, instructor, date)
+    if time not in free_slots:
+        await update.message.reply_text("😔 Цей час щойно зайняли. Ось оновлений список:")
+        await show_first_free_slots(update, context)
+        return
+
+    context.user_data.pop("first_free_slots", None)
+    context.user_data["instructor"] = instructor
+    context.user_data["date"] = date
+    context.user_data["time"] = time
+    context.user_data["state"] = "waiting_for_duration"
+    await send_duration_choice(update)
+
+# === ВИБІР ІНСТРУКТОРА ===
+async def handle_instructor_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    logger.info(f"👨‍🏫 Обробка вибору інструктора: {text}")
+
+    instructor_name = text.split(" ⭐")[0].split(" 🆕")[0]
+    context.user_data["instructor"] = instructor_name
+    context.user_data["state"] = "waiting_for_date"
+
+    dates = await run_db(get_next_dates, 14, instructor_name)
+
+    if not dates:
+        keyboard = [
+            [KeyboardButton("👨‍🏫 Обрати іншого інструктора")],
+            [KeyboardButton("🔙 Назад")]
+        ]
+        await update.message.reply_text(
+            f"😔 У інструктора {instructor_name} всі години зайняті на найближчі 14 днів\n\n"
+            f"💡 Що робити:\n"
+            f"• Оберіть іншого інструктора - у них можуть бути вільні години\n"
+            f"• Зайдіть завтра після 8:00 - бот оновиться і з'являться нові дати для запису\n\n"
+            f"📅 Вільні години оновлюються щодня о 8:00 ранку",
+            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        )
+        context.user_data["state"] = "waiting_for_transmission"
+        return
+
+    keyboard = []
+    for i in range(0, len(dates), 2):
+        row = [KeyboardButton(dates[i])]
+        if i + 1 < len(dates):
+            row.append(KeyboardButton(dates[i + 1]))
+        keyboard.append(row)
+
+    keyboard.append([KeyboardButton("🔙 Назад")])
+
+    await update.message.reply_text(
+        f"📅 Оберіть дату заняття:",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    )
+
+# === ВИБІР ДАТИ ===
+async def back_to_instructor_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    transmission = context.user_data.get("transmission")
+    instructors = get_instructors_by_transmission(transmission)
+
+    context.user_data["state"] = "waiting_for_instructor"
+
+    await send_instructor_choice(update, instructors)
+
+async def handle_date_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    logger.info(f"🔵 Обробка дати: {text}")
+
+    valid_date_markers = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Нд", "🟦", "🟥"]
+    if not any(marker in text for marker in valid_date_markers):
+        logger.warning(f"⚠️ Спроба ввести дату вручну: {text}")
+        await update.message.reply_text(
+            "⚠️ Будь ласка, оберіть дату з кнопок нижче.\n\n"
+            "Якщо потрібної дати немає у списку - зверніться до адміністратора або оберіть іншого інструктора."
+        )
+        return
+
+    date_parts = text.split()
+
+    if len(date_parts) >= 3 and date_parts[0] in ["🟦", "🟥"]:
+        date_candidate = date_parts[2].replace("(", "").replace(")", "")
+    elif len(date_parts) >= 2:
+        date_candidate = date_parts[1]
+    else:
+        date_str = text
+        date_candidate = None
+
+    if date_candidate:
+        if date_candidate.count('.') == 1:
+            current_year = datetime.now().year
+            date_str = f"{date_candidate}.{current_year}"
+        else:
+            date_str = date_candidate
+
+    logger.info(f"📆 Витягнута дата: {date_str}")
+
+    if not validate_date_format(date_str):
+        logger.warning(f"⚠️ Невірний формат дати: {date_str}")
+        await update.message.reply_text(
+            "⚠️ Невірний формат дати. Оберіть дату з меню."
+        )
+        return
+
+    date_obj = datetime.strptime(date_str, "%d.%m.%Y")
+    today = datetime.now(TZ).date()
+    if date_obj.date() < today:
+        logger.warning(f"⚠️ Минула дата: {date_str} (сьогодні: {today})")
+        await update.message.reply_text("⚠️ Неможливо записатися на минулу дату.")
+        return
+
+    context.user_data["date"] = date_str
+    instructor = context.user_data["instructor"]
+
+    free_slots = await run_db(get_available_time_slots, instructor, date_str)
+
+    if not free_slots:
+        await update.message.reply_text(
+            "😔 На цю дату немає вільних місць.\n"
+            "Оберіть іншу дату:"
+        )
+        return
+
+    context.user_data["state"] = "waiting_for_time"
+    await send_time_choice(update, free_slots)
+
+# === ВИБІР ЧАСУ ===
+async def send_time_choice(update: Update, free_slots):
+    keyboard = []
+    for i in range(0, len(free_slots), 3):
+        row = []
+        for j in range(3):
+            if i + j < len(free_slots):
+                row.append(KeyboardButton(free_slots[i + j]))
+        keyboard.append(row)
+
+    keyboard.append([KeyboardButton("🔙 Назад")])
+
+    await update.message.reply_text(
+        "🕐 Оберіть час заняття:",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    )
 
-            instructors = get_instructors_by_transmission(transmission)
-            if not instructors:
-                await update.message.reply_text("😔 Немає інструкторів для цього типу.")
-                return
+async def back_to_date_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["state"] = "waiting_for_date"
+    await update.message.reply_text("📅 Введіть іншу дату (ДД.ММ.РРРР):")
 
-            keyboard = []
-            for instructor in instructors:
-                rating = get_instructor_rating(instructor)
-                if rating > 0:
-                    stars = "⭐" * int(rating)
-                    keyboard.append([f"{instructor} {stars} ({rating:.1f})"])
-                else:
-                    keyboard.append([f"{instructor} 🆕"])
-            
-            keyboard.append([KeyboardButton("🔙 Назад")])
-            
-            await update.message.reply_text(
-                "👨‍🏫 Оберіть інструктора:",
-                reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            )
-            return
-        
-        # === ВИБІР ІНСТРУКТОРА ===
-        if state == "waiting_for_instructor":
-            logger.info(f"👨‍🏫 Обробка вибору інструктора: {text}")
-            
-            if text == "🔙 Назад":
-                await start(update, context)
-                return
-            
-            instructor_name = text.split(" ⭐")[0].split(" 🆕")[0]
-            context.user_data["instructor"] = instructor_name
-            context.user_data["state"] = "waiting_for_date"
-            
-            dates = get_next_dates(14, instructor_name)
-            
-            if not dates:
-                keyboard = [
-                    [KeyboardButton("👨‍🏫 Обрати іншого інструктора")],
-                    [KeyboardButton("🔙 Назад")]
-                ]
-                await update.message.reply_text(
-                    f"😔 У інструктора {instructor_name} всі години зайняті на найближчі 14 днів\n\n"
-                    f"💡 Що робити:\n"
-                    f"• Оберіть іншого інструктора - у них можуть бути вільні години\n"
-                    f"• Зайдіть завтра після 8:00 - бот оновиться і з'являться нові дати для запису\n\n"
-                    f"📅 Вільні години оновлюються щодня о 8:00 ранку",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                )
-                context.user_data["state"] = "waiting_for_transmission"
-                return
-            
-            keyboard = []
-            for i in range(0, len(dates), 2):
-                row = [KeyboardButton(dates[i])]
-                if i + 1 < len(dates):
-                    row.append(KeyboardButton(dates[i + 1]))
-                keyboard.append(row)
-            
-            keyboard.append([KeyboardButton("🔙 Назад")])
-            
-            await update.message.reply_text(
-                f"📅 Оберіть дату заняття:",
-                reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            )
-            return
-        
-        # === ВИБІР ДАТИ ===
-        if state == "waiting_for_date":
-            logger.info(f"🔵 Обробка дати: {text}")
-            
-            if text == "🔙 Назад":
-                transmission = context.user_data.get("transmission")
-                instructors = get_instructors_by_transmission(transmission)
-                
-                context.user_data["state"] = "waiting_for_instructor"
-                
-                keyboard = []
-                for instructor in instructors:
-                    rating = get_instructor_rating(instructor)
-                    if rating > 0:
-                        stars = "⭐" * int(rating)
-                        keyboard.append([f"{instructor} {stars} ({rating:.1f})"])
-                    else:
-                        keyboard.append([f"{instructor} 🆕"])
-                
-                keyboard.append([KeyboardButton("🔙 Назад")])
-                
-                await update.message.reply_text(
-                    "👨‍🏫 Оберіть інструктора:",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                )
-                return
-            
-            valid_date_markers = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Нд", "🟦", "🟥"]
-            if not any(marker in text for marker in valid_date_markers):
-                logger.warning(f"⚠️ Спроба ввести дату вручну: {text}")
-                await update.message.reply_text(
-                    "⚠️ Будь ласка, оберіть дату з кнопок нижче.\n\n"
-                    "Якщо потрібної дати немає у списку - зверніться до адміністратора або оберіть іншого інструктора."
-                )
-                return
-            
-            date_parts = text.split()
-            
-            if len(date_parts) >= 3 and date_parts[0] in ["🟦", "🟥"]:
-                date_candidate = date_parts[2].replace("(", "").replace(")", "")
-            elif len(date_parts) >= 2:
-                date_candidate = date_parts[1]
-            else:
-                date_str = text
-                date_candidate = None
-            
-            if date_candidate:
-                if date_candidate.count('.') == 1:
-                    current_year = datetime.now().year
-                    date_str = f"{date_candidate}.{current_year}"
-                else:
-                    date_str = date_candidate
-            
-            logger.info(f"📆 Витягнута дата: {date_str}")
-            
-            if not validate_date_format(date_str):
-                logger.warning(f"⚠️ Невірний формат дати: {date_str}")
-                await update.message.reply_text(
-                    "⚠️ Невірний формат дати. Оберіть дату з меню."
-                )
-                return
-            
-            date_obj = datetime.strptime(date_str, "%d.%m.%Y")
-            today = datetime.now(TZ).date()
-            if date_obj.date() < today:
-                logger.warning(f"⚠️ Минула дата: {date_str} (сьогодні: {today})")
-                await update.message.reply_text("⚠️ Неможливо записатися на минулу дату.")
-                return
-            
-            context.user_data["date"] = date_str
-            instructor = context.user_data["instructor"]
-            
-            free_slots = get_available_time_slots(instructor, date_str)
-            
-            if not free_slots:
-                await update.message.reply_text(
-                    "😔 На цю дату немає вільних місць.\n"
-                    "Оберіть іншу дату:"
-                )
-                return
-            
-            context.user_data["state"] = "waiting_for_time"
-            
-            keyboard = []
-            for i in range(0, len(free_slots), 3):
-                row = []
-                for j in range(3):
-                    if i + j < len(free_slots):
-                        row.append(KeyboardButton(free_slots[i + j]))
-                keyboard.append(row)
-            
-            keyboard.append([KeyboardButton("🔙 Назад")])
-            
-            await update.message.reply_text(
-                "🕐 Оберіть час заняття:",
-                reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            )
-            return
-        
-        # === ВИБІР ЧАСУ ===
-        if state == "waiting_for_time":
-            if text == "🔙 Назад":
-                context.user_data["state"] = "waiting_for_date"
-                await update.message.reply_text("📅 Введіть іншу дату (ДД.ММ.РРРР):")
-                return
-            
-            if not re.match(r'^([0-1][0-9]|2[0-3]):[0-5][0-9]$', text):
-                await update.message.reply_text(
-                    "⚠️ Будь ласка, оберіть час з кнопок нижче.\n\n"
-                    "Якщо потрібного часу немає - оберіть іншу дату або інструктора."
-                )
-                return
-            
-            instructor = context.user_data.get("instructor")
-            date = context.user_data.get("date")
-            free_slots = get_available_time_slots(instructor, date)
-            
-            if text not in free_slots:
-                await update.message.reply_text(
-                    "⚠️ Цей час недоступний. Будь ласка, оберіть час з доступних варіантів."
-                )
-                return
-            
-            context.user_data["time"] = text
-            context.user_data["state"] = "waiting_for_duration"
-            
-            keyboard = [
-                [KeyboardButton("1 година")],
-                [KeyboardButton("2 години")],
-                [KeyboardButton("🔙 Назад")]
-            ]
-            
+async def handle_time_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    if not re.match(r'^([0-1][0-9]|2[0-3]):[0-5][0-9]$', text):
+        await update.message.reply_text(
+            "⚠️ Будь ласка, оберіть час з кнопок нижче.\n\n"
+            "Якщо потрібного часу немає - оберіть іншу дату або інструктора."
+        )
+        return
+
+    instructor = context.user_data.get("instructor")
+    date = context.user_data.get("date")
+    free_slots = await run_db(get_available_time_slots, instructor, date)
+
+    if text not in free_slots:
+        await update.message.reply_text(
+            "⚠️ Цей час недоступний. Будь ласка, оберіть час з доступних варіантів."
+        )
+        return
+
+    context.user_data["time"] = text
+    context.user_data["state"] = "waiting_for_duration"
+    await send_duration_choice(update)
+
+# === ВИБІР ТРИВАЛОСТІ ===
+async def send_duration_choice(update: Update):
+    keyboard = [
+        [KeyboardButton("1 година")],
+        [KeyboardButton("2 години")],
+        [KeyboardButton("🔙 Назад")]
+    ]
+
+    await update.message.reply_text(
+        "⏱ Оберіть тривалість заняття:",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    )
+
+async def back_to_time_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    instructor = context.user_data["instructor"]
+    date = context.user_data["date"]
+    free_slots = await run_db(get_available_time_slots, instructor, date)
+
+    context.user_data["state"] = "waiting_for_time"
+    await send_time_choice(update, free_slots)
+
+async def handle_duration_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    if text not in ["1 година", "2 години"]:
+        await update.message.reply_text("⚠️ Оберіть тривалість із меню.")
+        return
+
+    if text == "2 години":
+        selected_time = context.user_data["time"]
+        instructor = context.user_data["instructor"]
+        date = context.user_data["date"]
+
+        selected_hour = int(selected_time.split(':')[0])
+        next_hour = f"{selected_hour + 1:02d}:00"
+
+        free_slots = await run_db(get_available_time_slots, instructor, date)
+
+        if next_hour not in free_slots and next_hour != f"{WORK_HOURS_END:02d}:00":
             await update.message.reply_text(
-                "⏱ Оберіть тривалість заняття:",
-                reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+                "⚠️ Наступна година зайнята. Оберіть інший час або 1 годину."
             )
             return
-        
-        # === ВИБІР ТРИВАЛОСТІ ===
-        if state == "waiting_for_duration":
-            if text == "🔙 Назад":
-                instructor = context.user_data["instructor"]
-                date = context.user_data["date"]
-                free_slots = get_available_time_slots(instructor, date)
-                
-                context.user_data["state"] = "waiting_for_time"
-                
-                keyboard = []
-                for i in range(0, len(free_slots), 3):
-                    row = []
-                    for j in range(3):
-                        if i + j < len(free_slots):
-                            row.append(KeyboardButton(free_slots[i + j]))
-                    keyboard.append(row)
-                
-                keyboard.append([KeyboardButton("🔙 Назад")])
-                
-                await update.message.reply_text(
-                    "🕐 Оберіть час заняття:",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                )
-                return
-            
-            if text not in ["1 година", "2 години"]:
-                await update.message.reply_text("⚠️ Оберіть тривалість із меню.")
-                return
-            
-            if text == "2 години":
-                selected_time = context.user_data["time"]
-                instructor = context.user_data["instructor"]
-                date = context.user_data["date"]
-                
-                selected_hour = int(selected_time.split(':')[0])
-                next_hour = f"{selected_hour + 1:02d}:00"
-                
-                free_slots = get_available_time_slots(instructor, date)
-                
-                if next_hour not in free_slots and next_hour != f"{WORK_HOURS_END:02d}:00":
-                    await update.message.reply_text(
-                        "⚠️ Наступна година зайнята. Оберіть інший час або 1 годину."
-                    )
-                    return
-            
-            context.user_data["duration"] = text
-            
-            user = update.message.from_user
-            student = get_student_by_telegram_id(user.id)
-            
-            if student:
-                student_id = student[0]
-                selected_date = context.user_data["date"]
-                selected_duration = text
-                
-                duration_hours = 2 if "2" in selected_duration else 1
-                
-                lesson_date = datetime.strptime(selected_date, "%d.%m.%Y")
-                
-                week_start = lesson_date - timedelta(days=lesson_date.weekday())
-                week_end = week_start + timedelta(days=6)
-                
-                with get_db() as conn:
-                    cursor = conn.cursor()
-                    
-                    cursor.execute("""
-                        SELECT date, duration
-                        FROM lessons
-                        WHERE student_telegram_id = ? AND status = 'active'
-                    """, (user.id,))
-                    all_lessons = cursor.fetchall()
-                    
-                    hours_this_week = 0
-                    for lesson_date_str, lesson_duration in all_lessons:
-                        try:
-                            ld = datetime.strptime(lesson_date_str, "%d.%m.%Y")
-                            if week_start <= ld <= week_end:
-                                if "2" in str(lesson_duration):
-                                    hours_this_week += 2
-                                elif "1.5" in str(lesson_duration):
-                                    hours_this_week += 1.5
-                                else:
-                                    hours_this_week += 1
-                        except:
-                            pass
-                
-                if hours_this_week + duration_hours > 6:
-                    remaining = 6 - hours_this_week
-                    await update.message.reply_text(
-                        f"⚠️ Перевищено ліміт!\n\n"
-                        f"На цей тиждень у вас вже заброньовано {hours_this_week:.1f} год.\n"
-                        f"Ліміт: 6 годин на тиждень\n"
-                        f"Доступно: {remaining:.1f} год.\n\n"
-                        f"Оберіть інший тиждень або зменшіть тривалість."
-                    )
-                    return
-                
-                context.user_data["student_name"] = student[1]
-                context.user_data["student_phone"] = student[2]
-                context.user_data["student_tariff"] = student[3]
-                
-                await show_booking_confirmation(update, context)
-            else:
-                await update.message.reply_text(
-                    "⚠️ *Помилка!*\n\n"
-                    "Для запису потрібна реєстрація через спеціальне посилання.\n"
-                    "Зверніться до адміністратора.",
-                    parse_mode="Markdown"
-                )
-                await start(update, context)
-            return
-        
-        # === ІМ'Я СТУДЕНТА ===
-        if state == "waiting_for_name":
-            if text == "🔙 Назад":
-                if "duration" not in context.user_data:
-                    await start(update, context)
-                    return
-                
-                context.user_data["state"] = "waiting_for_duration"
-                keyboard = [
-                    [KeyboardButton("1 година")],
-                    [KeyboardButton("2 години")],
-                    [KeyboardButton("🔙 Назад")]
-                ]
-                await update.message.reply_text(
-                    "⏱ Оберіть тривалість:",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                )
-                return
-            
-            if text.startswith("✅ "):
-                text = text[2:]
-            
-            context.user_data["student_name"] = text
-            context.user_data["state"] = "waiting_for_phone"
-            
-            keyboard = [[KeyboardButton("📱 Надати номер", request_contact=True)]]
-            keyboard.append([KeyboardButton("🔙 Назад")])
-            
+
+    context.user_data["duration"] = text
+
+    user = update.message.from_user
+    student = await aio.get_student_by_telegram_id(user.id)
+
+    if student:
+        student_id = student[0]
+        selected_date = context.user_data["date"]
+        selected_duration = text
+
+        selected_minutes = duration_to_minutes(selected_duration)
+
+        lesson_date = datetime.strptime(selected_date, "%d.%m.%Y")
+
+        week_start = lesson_date - timedelta(days=lesson_date.weekday())
+        week_end = week_start + timedelta(days=6)
+
+        minutes_this_week = (await aio.fetch_one("""
+            SELECT SUM(duration_minutes)
+            FROM lessons
+            WHERE student_telegram_id = ? AND status = 'active'
+            AND date_iso BETWEEN ? AND ?
+        """, (user.id, week_start.strftime("%Y-%m-%d"), week_end.strftime("%Y-%m-%d"))))[0] or 0
+
+        if minutes_this_week + selected_minutes > 6 * 60:
+            hours_this_week = minutes_this_week / 60
+            remaining = 6 - hours_this_week
             await update.message.reply_text(
-                "📱 Введіть номер телефону або натисніть кнопку нижче:",
-                reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+                f"⚠️ Перевищено ліміт!\n\n"
+                f"На цей тиждень у вас вже заброньовано {hours_this_week:.1f} год.\n"
+                f"Ліміт: 6 годин на тиждень\n"
+                f"Доступно: {remaining:.1f} год.\n\n"
+                f"Оберіть інший тиждень або зменшіть тривалість."
             )
             return
-        
-        # === ТЕЛЕФОН СТУДЕНТА ===
-        if state == "waiting_for_phone":
-            if text == "🔙 Назад":
-                user = update.message.from_user
-                auto_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-                keyboard = []
-                if auto_name:
-                    keyboard.append([KeyboardButton(f"✅ {auto_name}")])
-                keyboard.append([KeyboardButton("🔙 Назад")])
-                
-                context.user_data["state"] = "waiting_for_name"
-                await update.message.reply_text(
-                    "👤 Введіть ваше ім'я:",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                )
-                return
-            
-            phone = None
-            if update.message.contact:
-                phone = update.message.contact.phone_number
-            elif validate_phone(text):
-                phone = text
-            else:
-                await update.message.reply_text("⚠️ Невірний формат номера. Спробуйте ще раз:")
-                return
-            
-            context.user_data["student_phone"] = phone
-            
-            if "duration" not in context.user_data:
-                context.user_data["state"] = "waiting_for_transmission"
-                
-                keyboard = [
-                    [KeyboardButton("🚗 Автомат"), KeyboardButton("🚙 Механіка")]
-                ]
-                
-                await update.message.reply_text(
-                    "✅ Дякую! Тепер оберіть тип коробки передач:",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                )
-            else:
-                await show_booking_confirmation(update, context)
+
+        context.user_data["student_name"] = student[1]
+        context.user_data["student_phone"] = student[2]
+        context.user_data["student_tariff"] = student[3]
+
+        await show_booking_confirmation(update, context)
+    else:
+        await update.message.reply_text(
+            "⚠️ *Помилка!*\n\n"
+            "Для запису потрібна реєстрація через спеціальне посилання.\n"
+            "Зверніться до адміністратора.",
+            parse_mode="Markdown"
+        )
+        await start(update, context)
+
+# === ІМ'Я СТУДЕНТА ===
+async def handle_student_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    if text == "🔙 Назад":
+        if "duration" not in context.user_data:
+            await start(update, context)
             return
-        
-    except Exception as e:
-        logger.error(f"Error in handle_message: {e}", exc_info=True)
-        await update.message.reply_text("❌ Виникла помилка. Спробуйте /start")
+
+        context.user_data["state"] = "waiting_for_duration"
+        keyboard = [
+            [KeyboardButton("1 година")],
+            [KeyboardButton("2 години")],
+            [KeyboardButton("🔙 Назад")]
+        ]
+        await update.message.reply_text(
+            "⏱ Оберіть тривалість:",
+            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        )
+        return
+
+    if text.startswith("✅ "):
+        text = text[2:]
+
+    context.user_data["student_name"] = text
+    context.user_data["state"] = "waiting_for_phone"
+
+    keyboard = [[KeyboardButton("📱 Надати номер", request_contact=True)]]
+    keyboard.append([KeyboardButton("🔙 Назад")])
+
+    await update.message.reply_text(
+        "📱 Введіть номер телефону або натисніть кнопку нижче:",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    )
+
+# === ТЕЛЕФОН СТУДЕНТА ===
+async def handle_student_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    if text == "🔙 Назад":
+        user = update.message.from_user
+        auto_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
+        keyboard = []
+        if auto_name:
+            keyboard.append([KeyboardButton(f"✅ {auto_name}")])
+        keyboard.append([KeyboardButton("🔙 Назад")])
+
+        context.user_data["state"] = "waiting_for_name"
+        await update.message.reply_text(
+            "👤 Введіть ваше ім'я:",
+            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        )
+        return
+
+    phone = None
+    if update.message.contact:
+        phone = update.message.contact.phone_number
+    elif validate_phone(text):
+        phone = text
+    else:
+        await update.message.reply_text("⚠️ Невірний формат номера. Спробуйте ще раз:")
+        return
+
+    context.user_data["student_phone"] = phone
+
+    if "duration" not in context.user_data:
+        context.user_data["state"] = "waiting_for_transmission"
+
+        keyboard = [
+            [KeyboardButton("🚗 Автомат"), KeyboardButton("🚙 Механіка")]
+        ]
+
+        await update.message.reply_text(
+            "✅ Дякую! Тепер оберіть тип коробки передач:",
+            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        )
+    else:
+        await show_booking_confirmation(update, context)
 
 async def show_booking_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показати підтвердження бронювання"""
@@ -1447,13 +1294,7 @@ async def show_booking_confirmation(update: Update, context: ContextTypes.DEFAUL
     student_tariff = context.user_data.get("student_tariff", 0)
     booking_comment = context.user_data.get("booking_comment", "")
     
-    if student_tariff > 0:
-        if "2" in duration:
-            price = student_tariff * 2
-        else:
-            price = student_tariff
-    else:
-        price = PRICES.get(duration, 420)
+    price = lesson_price(student_tariff, duration)
     
     context.user_data["state"] = "waiting_for_confirmation"
     
@@ -1532,18 +1373,17 @@ async def show_instructor_schedule_period(update: Update, context: ContextTypes.
         instructor_id, instructor_name = instructor_data
         
         now = datetime.now(TZ)
-        
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT date, time, duration, student_name, student_phone, status, booking_comment
-                FROM lessons
-                WHERE instructor_id = ? 
-                AND status = 'active'
-                ORDER BY date, time
-            """, (instructor_id,))
-            
-            all_lessons = cursor.fetchall()
+        range_from = max(date_from or now.date(), now.date()).strftime("%Y-%m-%d")
+        range_to = date_to.strftime("%Y-%m-%d") if date_to else "9999-12-31"
+        
+        all_lessons = await aio.fetch_all("""
+            SELECT date, time, duration, student_name, student_phone, status, booking_comment
+            FROM lessons
+            WHERE instructor_id = ? 
+            AND status = 'active'
+            AND date_iso BETWEEN ? AND ?
+            ORDER BY date_iso, time
+        """, (instructor_id, range_from, range_to))
         
         lessons = []
         for date, time, duration, student_name, student_phone, status, booking_comment in all_lessons:
@@ -1733,7 +1573,7 @@ async def handle_stats_custom_period(update: Update, context: ContextTypes.DEFAU
 async def show_instructor_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, instructor_id, date_from, date_to, period_text):
     """Показати статистику інструктора"""
     try:
-        stats = get_instructor_stats_period(instructor_id, date_from, date_to)
+        stats = await aio.get_instructor_stats_period(instructor_id, date_from, date_to)
         
         if not stats:
             await update.message.reply_text("❌ Помилка отримання статистики.")
@@ -1766,17 +1606,13 @@ async def show_cancellation_history(update: Update, context: ContextTypes.DEFAUL
         
         instructor_id = instructor_data[0]
         
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT date, time, student_name, cancelled_by, cancelled_at
-                FROM lessons
-                WHERE instructor_id = ? AND status = 'cancelled'
-                ORDER BY cancelled_at DESC
-                LIMIT 10
-            """, (instructor_id,))
-            
-            cancellations = cursor.fetchall()
+        cancellations = await aio.fetch_all("""
+            SELECT date, time, student_name, cancelled_by, cancelled_at
+            FROM lessons
+            WHERE instructor_id = ? AND status = 'cancelled'
+            ORDER BY cancelled_at DESC
+            LIMIT 10
+        """, (instructor_id,))
         
         if not cancellations:
             await update.message.reply_text("📋 Немає скасованих занять.")
@@ -1811,19 +1647,15 @@ async def rate_student_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         instructor_id = instructor_data[0]
         
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id, date, time, student_name, rating, feedback
-                FROM lessons
-                WHERE instructor_id = ? 
-                  AND status = 'completed'
-                  AND instructor_rating IS NULL
-                ORDER BY date DESC, time DESC
-                LIMIT 10
-            """, (instructor_id,))
-            
-            lessons = cursor.fetchall()
+        lessons = await aio.fetch_all("""
+            SELECT id, date, time, student_name, rating, feedback
+            FROM lessons
+            WHERE instructor_id = ? 
+              AND status = 'completed'
+              AND instructor_rating IS NULL
+            ORDER BY date_iso DESC, time DESC
+            LIMIT 10
+        """, (instructor_id,))
         
         if not lessons:
             await update.message.reply_text("📋 Немає занять для оцінювання.")
@@ -1928,7 +1760,7 @@ async def handle_rating_flow(update: Update, context: ContextTypes.DEFAULT_TYPE)
         rating = context.user_data.get("rating_score")
         student_name = context.user_data.get("rating_student_name")
         
-        if add_instructor_rating(lesson_id, rating, feedback):
+        if await run_db(add_instructor_rating, lesson_id, rating, feedback):
             await update.message.reply_text(
                 f"✅ Оцінку додано!\n\n"
                 f"👤 {student_name}\n"
@@ -1960,17 +1792,13 @@ async def handle_edit_schedule(update: Update, context: ContextTypes.DEFAULT_TYP
         
         instructor_id = instructor_data[0]
         
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id, date, time, student_name
-                FROM lessons
-                WHERE instructor_id = ? AND status = 'active'
-                ORDER BY date, time
-                LIMIT 10
-            """, (instructor_id,))
-            
-            lessons = cursor.fetchall()
+        lessons = await aio.fetch_all("""
+            SELECT id, date, time, student_name
+            FROM lessons
+            WHERE instructor_id = ? AND status = 'active'
+            ORDER BY date_iso, time
+            LIMIT 10
+        """, (instructor_id,))
         
         if not lessons:
             await update.message.reply_text("📋 Немає занять для коригування.")
@@ -2037,7 +1865,9 @@ async def handle_edit_schedule(update: Update, context: ContextTypes.DEFAULT_TYP
         new_date = context.user_data.get("edit_new_date")
         new_time = text
         
-        if update_lesson(lesson_id, date=new_date, time=new_time):
+        if await aio.update_lesson(lesson_id, date=new_date, time=new_time):
+            cancel_lesson_reminders(context.job_queue, lesson_id)
+            schedule_lesson_reminders(context.job_queue, lesson_id, new_date, new_time)
             await update.message.reply_text(
                 f"✅ Графік оновлено!\n\n"
                 f"📅 Нова дата: {new_date}\n"
@@ -2080,42 +1910,15 @@ async def handle_schedule_management(update: Update, context: ContextTypes.DEFAU
         
         if text.startswith("❌ "):
             num = text.replace("❌ ", "").strip()
-            user_id_s = update.message.from_user.id
-            
-            # Спочатку з user_data
+            # user_data відновлюється після рестарту через SQLitePersistence
             blocks_map = context.user_data.get("blocks_map", {})
             
-            # Якщо немає — читаємо з БД (інший інстанс Render)
-            if not blocks_map:
-                import json as _json
-                with get_db() as conn:
-                    cursor = conn.cursor()
-                    try:
-                        cursor.execute("""
-                            SELECT data FROM user_sessions
-                            WHERE user_id = ? AND state = 'waiting_unblock'
-                        """, (user_id_s,))
-                        row = cursor.fetchone()
-                        if row:
-                            blocks_map = _json.loads(row[0])
-                    except Exception as e:
-                        logger.warning(f"session read error: {e}")
-            
             block_id = blocks_map.get(num)
             if block_id:
-                from database import remove_schedule_block
-                if remove_schedule_block(block_id):
+                if await aio.remove_schedule_block(block_id):
                     await update.message.reply_text("✅ Блокування видалено!")
                 else:
                     await update.message.reply_text("❌ Помилка видалення.")
-                # Очищаємо сесію
-                with get_db() as conn:
-                    cursor = conn.cursor()
-                    try:
-                        cursor.execute("DELETE FROM user_sessions WHERE user_id = ?", (user_id_s,))
-                        conn.commit()
-                    except:
-                        pass
                 context.user_data.pop("blocks_map", None)
                 await manage_schedule(update, context)
             else:
@@ -2260,31 +2063,19 @@ async def handle_schedule_management(update: Update, context: ContextTypes.DEFAU
         block_start_min = time_to_minutes(time_start)
         block_end_min = time_to_minutes(time_end)
         
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT student_name, student_phone, time, duration, student_tariff
-                FROM lessons
-                WHERE instructor_id = ? AND date = ? AND status = 'active'
-            """, (instructor_id, date_formatted))
-            
-            lessons = cursor.fetchall()
+        lessons = await aio.fetch_all("""
+            SELECT student_name, student_phone, time, duration, duration_minutes, student_tariff
+            FROM lessons
+            WHERE instructor_id = ? AND date_iso = ? AND status = 'active'
+        """, (instructor_id, normalize_date(date_formatted)))
         
         conflicting_lessons = []
-        for student_name, student_phone, lesson_time, duration, tariff in lessons:
+        for student_name, student_phone, lesson_time, duration, minutes, tariff in lessons:
             if ':' not in lesson_time:
                 continue
             
             lesson_start_min = time_to_minutes(lesson_time)
-            
-            if "1.5" in duration:
-                lesson_duration = 90
-            elif "2" in duration:
-                lesson_duration = 120
-            else:
-                lesson_duration = 60
-            
-            lesson_end_min = lesson_start_min + lesson_duration
+            lesson_end_min = lesson_start_min + minutes
             
             if not (block_end_min <= lesson_start_min or block_start_min >= lesson_end_min):
                 conflicting_lessons.append({
@@ -2292,6 +2083,7 @@ async def handle_schedule_management(update: Update, context: ContextTypes.DEFAU
                     'phone': student_phone or "немає",
                     'time': lesson_time,
                     'duration': duration,
+                    'end_min': lesson_end_min,
                     'tariff': tariff or 0
                 })
         
@@ -2299,13 +2091,7 @@ async def handle_schedule_management(update: Update, context: ContextTypes.DEFAU
             message = f"❌ Не можна заблокувати!\n\n"
             
             for lesson in conflicting_lessons:
-                start_h, start_m = map(int, lesson['time'].split(':'))
-                if "1.5" in lesson['duration']:
-                    end_h, end_m = start_h + 1, start_m + 30
-                elif "2" in lesson['duration']:
-                    end_h, end_m = start_h + 2, start_m
-                else:
-                    end_h, end_m = start_h + 1, start_m
+                end_h, end_m = divmod(lesson['end_min'], 60)
                 
                 message += f"📅 {block_date}, 🕐 {lesson['time']}-{end_h:02d}:{end_m:02d}\n"
                 message += f"👤 {lesson['name']} ({lesson['phone']})\n"
@@ -2320,9 +2106,7 @@ async def handle_schedule_management(update: Update, context: ContextTypes.DEFAU
         
         date_for_block = datetime.strptime(block_date, "%d.%m.%Y").strftime("%Y-%m-%d")
 
-        from database import add_schedule_block
-        
-        if add_schedule_block(instructor_id, date_for_block, time_start, time_end, "blocked", reason):
+        if await aio.add_schedule_block(instructor_id, date_for_block, time_start, time_end, "blocked", reason):
             await update.message.reply_text(
                 f"✅ Час заблоковано!\n\n"
                 f"📅 {block_date}\n"
@@ -2349,52 +2133,27 @@ async def show_blocks_to_unblock(update: Update, context: ContextTypes.DEFAULT_T
         today_date = datetime.now(TZ).date()
         today_str = today_date.strftime('%Y-%m-%d')
         
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id, date, time_start, time_end, reason
-                FROM schedule_blocks
-                WHERE instructor_id = ?
-                AND date >= ?
-                ORDER BY date, time_start
-                LIMIT 20
-            """, (instructor_id, today_str))
-            
-            future_blocks = cursor.fetchall()
+        future_blocks = await aio.fetch_all("""
+            SELECT id, date, time_start, time_end, reason
+            FROM schedule_blocks
+            WHERE instructor_id = ?
+            AND date >= ?
+            ORDER BY date, time_start
+            LIMIT 20
+        """, (instructor_id, today_str))
         
         if not future_blocks:
             await update.message.reply_text("📋 Немає майбутніх блокувань.")
             await manage_schedule(update, context)
             return
         
-        # Зберігаємо map номер->block_id в user_data ТА в БД
+        # Зберігаємо map номер->block_id в user_data
         blocks_map = {}
         for i, (block_id, date, time_start, time_end, reason) in enumerate(future_blocks, 1):
             blocks_map[str(i)] = block_id
         
         context.user_data["blocks_map"] = blocks_map
         
-        # Зберігаємо в БД для надійності між інстансами
-        import json
-        with get_db() as conn:
-            cursor = conn.cursor()
-            try:
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS user_sessions (
-                        user_id INTEGER PRIMARY KEY,
-                        state TEXT,
-                        data TEXT,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                cursor.execute("""
-                    INSERT OR REPLACE INTO user_sessions (user_id, state, data, updated_at)
-                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-                """, (user_id, "waiting_unblock", json.dumps(blocks_map)))
-                conn.commit()
-            except Exception as e:
-                logger.warning(f"Could not save session: {e}")
-        
         text = "🟢 *Оберіть номер блокування для видалення:*\n\n"
         keyboard = []
         
@@ -2430,16 +2189,12 @@ async def show_all_blocks(update: Update, context: ContextTypes.DEFAULT_TYPE):
         instructor_id = instructor_data[0]
         today_date = datetime.now(TZ).date()
         
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT date, time_start, time_end, reason
-                FROM schedule_blocks
-                WHERE instructor_id = ?
-                ORDER BY date DESC, time_start DESC
-            """, (instructor_id,))
-            
-            all_blocks = cursor.fetchall()
+        all_blocks = await aio.fetch_all("""
+            SELECT date, time_start, time_end, reason
+            FROM schedule_blocks
+            WHERE instructor_id = ?
+            ORDER BY date DESC, time_start DESC
+        """, (instructor_id,))
         
         if not all_blocks:
             await update.message.reply_text("📋 У вас немає заблокованих годин.")
@@ -2543,10 +2298,7 @@ async def handle_admin_report(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     if text == "👤 Звіт по інструктору":
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, name FROM instructors ORDER BY name")
-            instructors = cursor.fetchall()
+        instructors = [(inst_id, inst_name) for inst_id, inst_name, _, _ in get_all_instructors()]
         
         keyboard = []
         # ✅ Кнопка "Всі інструктори" на першому місці
@@ -2741,10 +2493,7 @@ async def generate_all_instructors_report(
         period_from = datetime.strptime(date_from, "%Y-%m-%d").strftime("%d.%m.%Y")
         period_to   = datetime.strptime(date_to,   "%Y-%m-%d").strftime("%d.%m.%Y")
 
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, name FROM instructors WHERE is_active = 1 ORDER BY name")
-            instructors = cursor.fetchall()
+        instructors = get_active_instructors()
 
         if not instructors:
             await update.message.reply_text("📋 Інструкторів не знайдено.")
@@ -2768,27 +2517,22 @@ async def generate_all_instructors_report(
         grand_amort    = 0.0
 
         for inst_id, inst_name in instructors:
-            data = get_instructor_report(inst_id, date_from, date_to)
+            data = await aio.get_instructor_report(inst_id, date_from, date_to)
             if not data or data["total_lessons"] == 0:
                 continue  # Пропускаємо інструкторів без занять за період
 
             # Рахуємо загальну суму по тарифах учнів з БД
-            from database import _date_in_range
-            with get_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT date, duration, student_tariff
-                    FROM lessons
-                    WHERE instructor_id = ?
-                    AND status IN ('active', 'completed')
-                """, (inst_id,))
-                cursor2_rows = cursor.fetchall()
+            tariff_rows = await aio.fetch_all("""
+                SELECT duration_minutes, student_tariff
+                FROM lessons
+                WHERE instructor_id = ?
+                AND date_iso BETWEEN ? AND ?
+                AND status IN ('active', 'completed')
+            """, (inst_id, date_from, date_to))
 
             inst_zagalno = 0.0
-            for row_date, row_dur, row_tariff in cursor2_rows:
-                if not _date_in_range(row_date, date_from, date_to):
-                    continue
-                h = 1.5 if row_dur and '1.5' in str(row_dur) else (2.0 if row_dur and '2' in str(row_dur) else 1.0)
+            for row_minutes, row_tariff in tariff_rows:
+                h = row_minutes / 60
                 tariff = row_tariff or 490
                 inst_zagalno += h * tariff
 
@@ -2871,7 +2615,7 @@ async def generate_all_instructors_report(
 async def generate_instructor_report(update: Update, context: ContextTypes.DEFAULT_TYPE, instructor_id, instructor_name, date_from, date_to, period_text):
     """Генерація детального звіту по одному інструктору"""
     try:
-        data = get_instructor_report(instructor_id, date_from, date_to)
+        data = await aio.get_instructor_report(instructor_id, date_from, date_to)
         
         if not data:
             await update.message.reply_text("❌ Помилка отримання даних.")
@@ -2911,7 +2655,7 @@ async def generate_instructor_report(update: Update, context: ContextTypes.DEFAU
 async def generate_admin_report(update: Update, context: ContextTypes.DEFAULT_TYPE, date_from, date_to, period_text):
     """Генерація звіту для адміна"""
     try:
-        report_data = get_admin_report_by_instructors(date_from, date_to)
+        report_data = await aio.get_admin_report_by_instructors(date_from, date_to)
         
         if not report_data:
             await update.message.reply_text("📋 Немає даних за цей період.")
@@ -2933,7 +2677,7 @@ async def generate_admin_report(update: Update, context: ContextTypes.DEFAULT_TY
                 text += f"   📝 Занять: {lessons}\n"
                 text += f"   ⏱ Годин: {hours:.1f}\n"
                 text += f"   💰 Заробіток: {earnings:.0f} грн\n"
-                text += f"   ⭐ Рейтинг: {avg_rating:.1f if avg_rating else '0.0'}\n"
+                text += f"   ⭐ Рейтинг: {avg_rating:.1f}\n"
                 text += f"   ❌ Скасовано: {cancelled}\n\n"
                 
                 total_lessons += lessons
@@ -3008,7 +2752,7 @@ async def handle_admin_add_student_phone(update: Update, context: ContextTypes.D
         )
         return
     
-    existing = get_student_by_phone(text)
+    existing = await run_db(get_student_by_phone, text)
     if existing:
         await update.message.reply_text(
             f"⚠️ Учень з таким номером вже є в системі!\n\n"
@@ -3095,7 +2839,7 @@ async def handle_admin_add_student_tgid(update: Update, context: ContextTypes.DE
             return
         telegram_id = int(text.strip())
         
-        existing = get_student_by_telegram_id(telegram_id)
+        existing = await aio.get_student_by_telegram_id(telegram_id)
         if existing:
             await update.message.reply_text(
                 f"⚠️ Цей Telegram ID вже прив'язаний до учня:\n\n"
@@ -3106,7 +2850,7 @@ async def handle_admin_add_student_tgid(update: Update, context: ContextTypes.DE
             return
     
     try:
-        success = register_student(name, phone, telegram_id, tariff, "admin")
+        success = await aio.register_student(name, phone, telegram_id, tariff, "admin")
         
         if success:
             summary = (
@@ -3192,17 +2936,17 @@ async def handle_admin_manage_bookings(update: Update, context: ContextTypes.DEF
         today = datetime.now(TZ).date()
         dates_with_lessons = []
         
+        counts = dict(await aio.fetch_all("""
+            SELECT date_iso, COUNT(*) FROM lessons 
+            WHERE date_iso BETWEEN ? AND ? AND status = 'active'
+            GROUP BY date_iso
+        """, ((today - timedelta(days=7)).strftime('%Y-%m-%d'),
+              (today + timedelta(days=30)).strftime('%Y-%m-%d'))))
+        
         for i in range(-7, 31):
             date = today + timedelta(days=i)
             date_str = date.strftime('%d.%m.%Y')
-            
-            with get_db() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT COUNT(*) FROM lessons 
-                    WHERE date = ? AND status = 'active'
-                """, (date_str,))
-                count = cursor.fetchone()[0]
+            count = counts.get(date.strftime('%Y-%m-%d'), 0)
             
             if count > 0:
                 weekday = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Нд"][date.weekday()]
@@ -3252,17 +2996,14 @@ async def handle_admin_cancel_select_date(update: Update, context: ContextTypes.
     
     context.user_data["selected_date"] = date_str
     
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT i.name, COUNT(*) as lesson_count
-            FROM lessons l
-            JOIN instructors i ON l.instructor_id = i.id
-            WHERE l.date = ? AND l.status = 'active'
-            GROUP BY i.name
-            ORDER BY i.name
-        """, (date_str,))
-        instructors = cursor.fetchall()
+    instructors = await aio.fetch_all("""
+        SELECT i.name, COUNT(*) as lesson_count
+        FROM lessons l
+        JOIN instructors i ON l.instructor_id = i.id
+        WHERE l.date_iso = ? AND l.status = 'active'
+        GROUP BY i.name
+        ORDER BY i.name
+    """, (normalize_date(date_str),))
     
     if not instructors:
         await update.message.reply_text("📋 Немає активних уроків на цю дату.")
@@ -3301,25 +3042,22 @@ async def handle_admin_cancel_select_instructor(update: Update, context: Context
         instructor_name = text.replace("👨‍🏫 ", "").split(" (")[0].strip()
         instructor_filter = instructor_name
     
-    with get_db() as conn:
-        cursor = conn.cursor()
-        if instructor_filter:
-            cursor.execute("""
-                SELECT l.id, l.time, l.duration, l.student_name, l.student_phone, i.name
-                FROM lessons l
-                JOIN instructors i ON l.instructor_id = i.id
-                WHERE l.date = ? AND l.status = 'active' AND i.name = ?
-                ORDER BY l.time
-            """, (date_str, instructor_filter))
-        else:
-            cursor.execute("""
-                SELECT l.id, l.time, l.duration, l.student_name, l.student_phone, i.name
-                FROM lessons l
-                JOIN instructors i ON l.instructor_id = i.id
-                WHERE l.date = ? AND l.status = 'active'
-                ORDER BY l.time
-            """, (date_str,))
-        lessons = cursor.fetchall()
+    if instructor_filter:
+        lessons = await aio.fetch_all("""
+            SELECT l.id, l.time, l.duration, l.student_name, l.student_phone, i.name
+            FROM lessons l
+            JOIN instructors i ON l.instructor_id = i.id
+            WHERE l.date_iso = ? AND l.status = 'active' AND i.name = ?
+            ORDER BY l.time
+        """, (normalize_date(date_str), instructor_filter))
+    else:
+        lessons = await aio.fetch_all("""
+            SELECT l.id, l.time, l.duration, l.student_name, l.student_phone, i.name
+            FROM lessons l
+            JOIN instructors i ON l.instructor_id = i.id
+            WHERE l.date_iso = ? AND l.status = 'active'
+            ORDER BY l.time
+        """, (normalize_date(date_str),))
     
     if not lessons:
         await update.message.reply_text("📋 Немає уроків для цього інструктора.")
@@ -3365,15 +3103,12 @@ async def handle_admin_cancel_select_lesson(update: Update, context: ContextType
         await update.message.reply_text("❌ Невірний номер. Оберіть зі списку.")
         return
     
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT l.student_name, l.student_phone, l.date, l.time, l.duration, i.name, l.student_telegram_id
-            FROM lessons l
-            JOIN instructors i ON l.instructor_id = i.id
-            WHERE l.id = ?
-        """, (lesson_id,))
-        lesson = cursor.fetchone()
+    lesson = await aio.fetch_one("""
+        SELECT l.student_name, l.student_phone, l.date, l.time, l.duration, i.name, l.student_telegram_id
+        FROM lessons l
+        JOIN instructors i ON l.instructor_id = i.id
+        WHERE l.id = ?
+    """, (lesson_id,))
     
     if not lesson:
         await update.message.reply_text("❌ Урок не знайдено.")
@@ -3382,16 +3117,15 @@ async def handle_admin_cancel_select_lesson(update: Update, context: ContextType
     student_name, student_phone, date, time, duration, instructor_name, student_telegram_id = lesson
     
     try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                UPDATE lessons
-                SET status = 'cancelled',
-                    cancelled_by = 'admin',
-                    cancelled_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            """, (lesson_id,))
-            conn.commit()
+        await aio.execute_write("""
+            UPDATE lessons
+            SET status = 'cancelled',
+                cancelled_by = 'admin',
+                cancelled_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, (lesson_id,))
+        
+        cancel_lesson_reminders(context.job_queue, lesson_id)
         
         if student_telegram_id:
             try:
@@ -3452,7 +3186,7 @@ async def handle_admin_manual_enter_phone(update: Update, context: ContextTypes.
     
     context.user_data["admin_booking"]["phone"] = phone
     
-    student = get_student_by_phone(phone)
+    student = await run_db(get_student_by_phone, phone)
     
     if student:
         student_id, name, student_phone, tariff, registered_via, student_tg_id = student
@@ -3603,8 +3337,9 @@ async def handle_admin_manual_select_transmission(update: Update, context: Conte
         return
     
     keyboard = []
+    ratings = await aio.get_instructor_ratings(instructors)
     for instructor in instructors:
-        rating = get_instructor_rating(instructor)
+        rating = ratings.get(instructor, 0)
         if rating > 0:
             stars = "⭐" * int(rating)
             keyboard.append([KeyboardButton(f"{instructor} {stars} ({rating:.1f})")])
@@ -3642,7 +3377,7 @@ async def handle_admin_manual_select_instructor(update: Update, context: Context
     instructor_name = text.split(" ⭐")[0].split(" 🆕")[0]
     context.user_data["admin_booking"]["instructor"] = instructor_name
     
-    dates = get_next_dates(30, instructor_name)
+    dates = await run_db(get_next_dates, 30, instructor_name)
     
     if not dates:
         await update.message.reply_text(
@@ -3698,7 +3433,7 @@ async def handle_admin_manual_select_date(update: Update, context: ContextTypes.
         context.user_data["admin_booking"]["date"] = date_str
         
         instructor = context.user_data["admin_booking"]["instructor"]
-        free_slots = get_available_time_slots(instructor, date_str)
+        free_slots = await run_db(get_available_time_slots, instructor, date_str)
         
         if not free_slots:
             await update.message.reply_text("❌ Немає вільних часів. Оберіть іншу дату.")
@@ -3796,6 +3531,30 @@ async def handle_admin_manual_select_duration(update: Update, context: ContextTy
         parse_mode="Markdown"
     )
 
+def insert_admin_lesson(booking, instructor_id):
+    """Зберегти урок, створений адміном; повертає id уроку"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO lessons 
+            (student_name, student_phone, student_tariff, instructor_id, date, date_iso, time, starts_at, duration, duration_minutes, status, student_telegram_id, booking_comment)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'active', ?, 'Запис адміном')
+        """, (
+            booking["name"],
+            booking["phone"],
+            booking["tariff"],
+            instructor_id,
+            booking["date"],
+            normalize_date(booking["date"]),
+            booking["time"],
+            lesson_starts_at(booking["date"], booking["time"]),
+            booking["duration"],
+            duration_to_minutes(booking["duration"]),
+            booking.get("student_telegram_id")
+        ))
+        conn.commit()
+        return cursor.lastrowid
+
 async def handle_admin_manual_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     
@@ -3817,23 +3576,9 @@ async def handle_admin_manual_confirm(update: Update, context: ContextTypes.DEFA
     student_telegram_id = booking.get("student_telegram_id")
     
     try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO lessons 
-                (student_name, student_phone, student_tariff, instructor_id, date, time, duration, status, student_telegram_id, booking_comment)
-                VALUES (?, ?, ?, ?, ?, ?, ?, 'active', ?, 'Запис адміном')
-            """, (
-                booking["name"],
-                booking["phone"],
-                booking["tariff"],
-                instructor_id,
-                booking["date"],
-                booking["time"],
-                booking["duration"],
-                student_telegram_id
-            ))
-            conn.commit()
+        lesson_id = await run_db(insert_admin_lesson, booking, instructor_id)
+        
+        schedule_lesson_reminders(context.job_queue, lesson_id, booking["date"], booking["time"])
         
         if student_telegram_id:
             try:
@@ -3876,18 +3621,14 @@ async def show_student_lessons(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = update.message.from_user.id
     
     try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT l.date, l.time, l.duration, i.name, i.phone, l.status, l.booking_comment
-                FROM lessons l
-                JOIN instructors i ON l.instructor_id = i.id
-                WHERE l.student_telegram_id = ? AND l.status = 'active'
-                ORDER BY l.date, l.time
-                LIMIT 10
-            """, (user_id,))
-            
-            lessons = cursor.fetchall()
+        lessons = await aio.fetch_all("""
+            SELECT l.date, l.time, l.duration, i.name, i.phone, l.status, l.booking_comment
+            FROM lessons l
+            JOIN instructors i ON l.instructor_id = i.id
+            WHERE l.student_telegram_id = ? AND l.status = 'active'
+            ORDER BY l.date_iso, l.time
+            LIMIT 10
+        """, (user_id,))
         
         if not lessons:
             await update.message.reply_text("📋 У вас поки немає записів на заняття.")
@@ -3908,6 +3649,57 @@ async def show_student_lessons(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.error(f"Error in show_student_lessons: {e}", exc_info=True)
         await update.message.reply_text("❌ Помилка завантаження записів.")
 
+def get_student_statistics_data(user_id, today_iso):
+    """Заплановані, завершені, оцінки й інструктори учня для show_student_statistics"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT COUNT(*), 
+                   SUM(duration_minutes) / 60.0,
+                   SUM(CASE WHEN duration_minutes = 120 THEN student_tariff * 2 ELSE student_tariff END)
+            FROM lessons
+            WHERE student_telegram_id = ? 
+            AND status = 'active'
+            AND date_iso >= ?
+        """, (user_id, today_iso))
+        
+        planned = cursor.fetchone()
+        
+        cursor.execute("""
+            SELECT COUNT(*), 
+                   SUM(duration_minutes) / 60.0,
+                   SUM(CASE WHEN duration_minutes = 120 THEN student_tariff * 2 ELSE student_tariff END)
+            FROM lessons
+            WHERE student_telegram_id = ? 
+            AND status = 'completed'
+        """, (user_id,))
+        
+        completed = cursor.fetchone()
+        
+        cursor.execute("""
+            SELECT AVG(rating), COUNT(rating)
+            FROM lessons
+            WHERE student_telegram_id = ?
+            AND status = 'completed'
+            AND rating IS NOT NULL
+        """, (user_id,))
+        
+        rating_data = cursor.fetchone()
+        
+        cursor.execute("""
+            SELECT i.name, COUNT(*)
+            FROM lessons l
+            JOIN instructors i ON l.instructor_id = i.id
+            WHERE l.student_telegram_id = ?
+            AND l.status = 'completed'
+            GROUP BY i.name
+            ORDER BY COUNT(*) DESC
+        """, (user_id,))
+        
+        instructors = cursor.fetchall()
+        return planned, completed, rating_data, instructors
+
 async def show_student_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     
@@ -3915,77 +3707,17 @@ async def show_student_statistics(update: Update, context: ContextTypes.DEFAULT_
         from datetime import datetime, timedelta
         
         now = datetime.now(TZ)
-        today_str = now.strftime("%d.%m.%Y")
-        
-        with get_db() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT COUNT(*), 
-                       SUM(CASE 
-                           WHEN duration LIKE '%2%' THEN 2
-                           WHEN duration LIKE '%1.5%' THEN 1.5
-                           ELSE 1
-                       END),
-                       SUM(CASE 
-                           WHEN duration LIKE '%2%' THEN student_tariff * 2
-                           ELSE student_tariff
-                       END)
-                FROM lessons
-                WHERE student_telegram_id = ? 
-                AND status = 'active'
-                AND date >= ?
-            """, (user_id, today_str))
-            
-            planned = cursor.fetchone()
-            planned_count = planned[0] or 0
-            planned_hours = planned[1] or 0
-            planned_cost = planned[2] or 0
-            
-            cursor.execute("""
-                SELECT COUNT(*), 
-                       SUM(CASE 
-                           WHEN duration LIKE '%2%' THEN 2
-                           WHEN duration LIKE '%1.5%' THEN 1.5
-                           ELSE 1
-                       END),
-                       SUM(CASE 
-                           WHEN duration LIKE '%2%' THEN student_tariff * 2
-                           ELSE student_tariff
-                       END)
-                FROM lessons
-                WHERE student_telegram_id = ? 
-                AND status = 'completed'
-            """, (user_id,))
-            
-            completed = cursor.fetchone()
-            completed_count = completed[0] or 0
-            completed_hours = completed[1] or 0
-            completed_cost = completed[2] or 0
-            
-            cursor.execute("""
-                SELECT AVG(rating), COUNT(rating)
-                FROM lessons
-                WHERE student_telegram_id = ?
-                AND status = 'completed'
-                AND rating IS NOT NULL
-            """, (user_id,))
-            
-            rating_data = cursor.fetchone()
-            avg_rating = rating_data[0] or 0
-            rated_lessons = rating_data[1] or 0
-            
-            cursor.execute("""
-                SELECT i.name, COUNT(*)
-                FROM lessons l
-                JOIN instructors i ON l.instructor_id = i.id
-                WHERE l.student_telegram_id = ?
-                AND l.status = 'completed'
-                GROUP BY i.name
-                ORDER BY COUNT(*) DESC
-            """, (user_id,))
-            
-            instructors = cursor.fetchall()
+        today_iso = now.strftime("%Y-%m-%d")
+        
+        planned, completed, rating_data, instructors = await run_db(get_student_statistics_data, user_id, today_iso)
+        planned_count = planned[0] or 0
+        planned_hours = planned[1] or 0
+        planned_cost = planned[2] or 0
+        completed_count = completed[0] or 0
+        completed_hours = completed[1] or 0
+        completed_cost = completed[2] or 0
+        avg_rating = rating_data[0] or 0
+        rated_lessons = rating_data[1] or 0
         
         text = "📊 Статистика\n\n"
         
@@ -4028,18 +3760,14 @@ async def show_lessons_to_cancel(update: Update, context: ContextTypes.DEFAULT_T
     try:
         now = datetime.now(TZ)
         
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT l.id, l.date, l.time, l.duration, i.name
-                FROM lessons l
-                JOIN instructors i ON l.instructor_id = i.id
-                WHERE l.student_telegram_id = ? AND l.status = 'active'
-                ORDER BY l.date, l.time
-                LIMIT 10
-            """, (user_id,))
-            
-            lessons = cursor.fetchall()
+        lessons = await aio.fetch_all("""
+            SELECT l.id, l.date, l.time, l.duration, i.name
+            FROM lessons l
+            JOIN instructors i ON l.instructor_id = i.id
+            WHERE l.student_telegram_id = ? AND l.status = 'active'
+            ORDER BY l.date_iso, l.time
+            LIMIT 10
+        """, (user_id,))
         
         if not lessons:
             await update.message.reply_text("📋 У вас немає активних записів на заняття.")
@@ -4162,35 +3890,29 @@ async def handle_cancel_confirmation(update: Update, context: ContextTypes.DEFAU
         
         user_id = update.message.from_user.id
         
-        with get_db() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT student_name, student_phone, student_tariff, duration, instructor_id
-                FROM lessons
-                WHERE id = ?
-            """, (lesson_id,))
-            
-            lesson_data = cursor.fetchone()
-            
-            if not lesson_data:
-                await update.message.reply_text("❌ Урок не знайдено.")
-                return
-            
-            student_name, student_phone, student_tariff, duration, instructor_id = lesson_data
-            
-            cursor.execute("""
-                UPDATE lessons
-                SET status = 'cancelled',
-                    cancelled_by = 'student',
-                    cancelled_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            """, (lesson_id,))
-            
-            cursor.execute("SELECT telegram_id FROM instructors WHERE id = ?", (instructor_id,))
-            instructor_telegram_id = cursor.fetchone()[0]
-            
-            conn.commit()
+        lesson_data = await aio.fetch_one("""
+            SELECT student_name, student_phone, student_tariff, duration, instructor_id
+            FROM lessons
+            WHERE id = ?
+        """, (lesson_id,))
+        
+        if not lesson_data:
+            await update.message.reply_text("❌ Урок не знайдено.")
+            return
+        
+        student_name, student_phone, student_tariff, duration, instructor_id = lesson_data
+        
+        await aio.execute_write("""
+            UPDATE lessons
+            SET status = 'cancelled',
+                cancelled_by = 'student',
+                cancelled_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, (lesson_id,))
+        
+        instructor_telegram_id = get_instructor_by_id(instructor_id)[1]
+        
+        cancel_lesson_reminders(context.job_queue, lesson_id)
         
         await update.message.reply_text(
             f"✅ *Урок скасовано!*\n\n"
@@ -4201,12 +3923,7 @@ async def handle_cancel_confirmation(update: Update, context: ContextTypes.DEFAU
         
         if instructor_telegram_id:
             try:
-                if student_tariff and "2" in duration:
-                    price = student_tariff * 2
-                elif student_tariff:
-                    price = student_tariff
-                else:
-                    price = PRICES.get(duration, 420)
+                price = lesson_price(student_tariff, duration)
                 
                 await context.bot.send_message(
                     chat_id=instructor_telegram_id,
@@ -4230,6 +3947,44 @@ async def handle_cancel_confirmation(update: Update, context: ContextTypes.DEFAU
         await update.message.reply_text("❌ Помилка скасування.")
 
 
+def booking_refusal_text(result, date):
+    """Пояснення учню, чому try_book_lesson відмовив у записі"""
+    if result.status == BOOKING_CONFLICT:
+        instructor_name, lesson_time, lesson_duration = result.conflict
+        return (
+            f"❌ *Не можна записатись!*\n\n"
+            f"У вас вже є урок в цей час:\n"
+            f"👨‍🏫 {instructor_name}\n"
+            f"📅 {date}\n"
+            f"🕐 {lesson_time} ({lesson_duration})\n\n"
+            f"Оберіть інший час."
+        )
+    if result.status == BOOKING_DAILY_LIMIT:
+        hours = result.booked_minutes / 60
+        return (
+            f"❌ *Ліміт перевищено!*\n\n"
+            f"Ви вже маєте *{hours:.1f} год* на {date}\n"
+            f"Максимум: *2 години на день*\n\n"
+            f"Залишилось: *{2 - hours:.1f} год*"
+        )
+    if result.status == BOOKING_WEEKLY_LIMIT:
+        hours = result.booked_minutes / 60
+        return (
+            f"❌ *Ліміт перевищено!*\n\n"
+            f"Ви вже маєте *{hours:.1f} год* цього тижня\n"
+            f"Максимум: *6 годин на тиждень*\n\n"
+            f"Залишилось: *{6 - hours:.1f} год*"
+        )
+    student_name, lesson_time, lesson_duration = result.conflict
+    return (
+        f"❌ *Інструктор зайнятий!*\n\n"
+        f"На цей час вже записаний інший учень:\n"
+        f"👤 {student_name}\n"
+        f"📅 {date}\n"
+        f"🕐 {lesson_time} ({lesson_duration})\n\n"
+        f"Оберіть інший час або дату."
+    )
+
 async def save_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Зберегти заняття в БД"""
     try:
@@ -4249,150 +4004,22 @@ async def save_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         instructor_id, instructor_telegram_id = instructor_data
         
-        start_hour = int(time.split(':')[0])
-        if "2" in duration:
-            lesson_hours = 2
-        elif "1.5" in duration:
-            lesson_hours = 1.5
-        else:
-            lesson_hours = 1
+        booking_comment = context.user_data.get("booking_comment", "")
         
-        end_hour = start_hour + lesson_hours
+        # Транзакція завершується всередині try_book_lesson — відповідаємо вже після COMMIT
+        result = await aio.try_book_lesson(
+            instructor_id, student_name, student_telegram_id, student_phone, student_tariff,
+            date, time, duration, booking_comment
+        )
+        if result is None:
+            await update.message.reply_text("❌ Помилка збереження запису.")
+            return
+        if not result.ok:
+            await update.message.reply_text(booking_refusal_text(result, date), parse_mode="Markdown")
+            return
+        lesson_id = result.lesson_id
         
-        with get_db() as conn:
-            conn.execute("BEGIN IMMEDIATE")
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT i.name, l.time, l.duration
-                FROM lessons l
-                JOIN instructors i ON l.instructor_id = i.id
-                WHERE l.student_telegram_id = ? AND l.date = ? AND l.status = 'active'
-            """, (student_telegram_id, date))
-            
-            existing_lessons = cursor.fetchall()
-            
-            for existing_instructor, existing_time, existing_duration in existing_lessons:
-                existing_start = int(existing_time.split(':')[0])
-                if "2" in existing_duration:
-                    existing_hours = 2
-                elif "1.5" in existing_duration:
-                    existing_hours = 1.5
-                else:
-                    existing_hours = 1
-                existing_end = existing_start + existing_hours
-                
-                if not (end_hour <= existing_start or start_hour >= existing_end):
-                    await update.message.reply_text(
-                        f"❌ *Не можна записатись!*\n\n"
-                        f"У вас вже є урок в цей час:\n"
-                        f"👨‍🏫 {existing_instructor}\n"
-                        f"📅 {date}\n"
-                        f"🕐 {existing_time} ({existing_duration})\n\n"
-                        f"Оберіть інший час.",
-                        parse_mode="Markdown"
-                    )
-                    return
-            
-            cursor.execute("""
-                SELECT SUM(
-                    CASE 
-                        WHEN duration LIKE '%2%' THEN 2
-                        WHEN duration LIKE '%1.5%' THEN 1.5
-                        ELSE 1
-                    END
-                )
-                FROM lessons
-                WHERE student_telegram_id = ? AND date = ? AND status = 'active'
-            """, (student_telegram_id, date))
-            
-            total_hours_today = cursor.fetchone()[0] or 0
-            
-            if total_hours_today + lesson_hours > 2:
-                await update.message.reply_text(
-                    f"❌ *Ліміт перевищено!*\n\n"
-                    f"Ви вже маєте *{total_hours_today:.1f} год* на {date}\n"
-                    f"Максимум: *2 години на день*\n\n"
-                    f"Залишилось: *{2 - total_hours_today:.1f} год*",
-                    parse_mode="Markdown"
-                )
-                return
-            
-            from datetime import datetime, timedelta
-            date_obj = datetime.strptime(date, "%d.%m.%Y")
-            week_start = date_obj - timedelta(days=date_obj.weekday())
-            week_end = week_start + timedelta(days=6)
-            
-            cursor.execute("""
-                SELECT SUM(
-                    CASE 
-                        WHEN duration LIKE '%2%' THEN 2
-                        WHEN duration LIKE '%1.5%' THEN 1.5
-                        ELSE 1
-                    END
-                )
-                FROM lessons
-                WHERE student_telegram_id = ? 
-                AND substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2) 
-                    BETWEEN ? AND ?
-                AND status = 'active'
-            """, (student_telegram_id, 
-                  week_start.strftime("%Y-%m-%d"), 
-                  week_end.strftime("%Y-%m-%d")))
-            
-            total_hours_week = cursor.fetchone()[0] or 0
-            
-            if total_hours_week + lesson_hours > 6:
-                await update.message.reply_text(
-                    f"❌ *Ліміт перевищено!*\n\n"
-                    f"Ви вже маєте *{total_hours_week:.1f} год* цього тижня\n"
-                    f"Максимум: *6 годин на тиждень*\n\n"
-                    f"Залишилось: *{6 - total_hours_week:.1f} год*",
-                    parse_mode="Markdown"
-                )
-                return
-            
-            cursor.execute("""
-                SELECT student_name, student_telegram_id, time, duration
-                FROM lessons
-                WHERE instructor_id = ? AND date = ? AND status = 'active'
-            """, (instructor_id, date))
-            
-            instructor_lessons = cursor.fetchall()
-            
-            for other_student_name, other_student_id, other_time, other_duration in instructor_lessons:
-                if other_student_id == student_telegram_id:
-                    continue
-                
-                other_start = int(other_time.split(':')[0])
-                if "2" in other_duration:
-                    other_hours = 2
-                elif "1.5" in other_duration:
-                    other_hours = 1.5
-                else:
-                    other_hours = 1
-                other_end = other_start + other_hours
-                
-                if not (end_hour <= other_start or start_hour >= other_end):
-                    await update.message.reply_text(
-                        f"❌ *Інструктор зайнятий!*\n\n"
-                        f"На цей час вже записаний інший учень:\n"
-                        f"👤 {other_student_name}\n"
-                        f"📅 {date}\n"
-                        f"🕐 {other_time} ({other_duration})\n\n"
-                        f"Оберіть інший час або дату.",
-                        parse_mode="Markdown"
-                    )
-                    return
-            
-            booking_comment = context.user_data.get("booking_comment", "")
-            
-            cursor.execute("""
-                INSERT INTO lessons 
-                (instructor_id, student_name, student_telegram_id, student_phone, student_tariff, date, time, duration, status, booking_comment)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'active', ?)
-            """, (instructor_id, student_name, student_telegram_id, student_phone, student_tariff, date, time, duration, booking_comment))
-            conn.commit()
+        schedule_lesson_reminders(context.job_queue, lesson_id, date, time)
         
         await update.message.reply_text(
             f"✅ *Заняття заброньовано!*\n\n"
@@ -4403,15 +4030,7 @@ async def save_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown"
         )
         
-        if student_tariff > 0:
-            if "2" in duration:
-                price = student_tariff * 2
-            else:
-                price = student_tariff
-        else:
-            price = PRICES.get(duration, 420)
-        
-        booking_comment = context.user_data.get("booking_comment", "")
+        price = lesson_price(student_tariff, duration)
         
         if instructor_telegram_id:
             try:
@@ -4458,9 +4077,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_unblock_callback(query, context, block_id):
     try:
-        from database import remove_schedule_block
-        
-        if remove_schedule_block(block_id):
+        if await aio.remove_schedule_block(block_id):
             await query.edit_message_text("✅ Час розблоковано!")
         else:
             await query.edit_message_text("❌ Помилка розблокування.")
@@ -4469,187 +4086,255 @@ async def handle_unblock_callback(query, context, block_id):
         logger.error(f"Error in handle_unblock_callback: {e}", exc_info=True)
         await query.edit_message_text("❌ Помилка.")
 
-# ======================= REMINDERS =======================
-async def send_reminders(context: ContextTypes.DEFAULT_TYPE):
+# ======================= REMINDERS =======================
+# Нагадування плануються на точний час через job_queue.run_once.
+# Уроки, що починаються в одну хвилину, ділять один job: у data — множина id уроків.
+# У webhook-режимі jobs є лише у воркера 0: записи й перенесення в інших воркерах
+# він підхоплює з БД кожні REMINDER_SYNC_INTERVAL секунд (sync_reminder_jobs),
+# а send_reminders пропускає уроки, час яких уже не відповідає job.
+REMINDERS = {
+    "24h": {
+        "offset": timedelta(hours=24),
+        "flag": "reminder_24h_sent",
+        "text": "⏰ *Нагадування!*\n\nУ вас заняття завтра:\n"
+                "👨‍🏫 {instructor}\n📅 {date}\n🕐 {time}",
+    },
+    "2h": {
+        "offset": timedelta(hours=2),
+        "flag": "reminder_2h_sent",
+        "text": "🔔 *Нагадування!*\n\nУ вас заняття через 2 години:\n"
+                "👨‍🏫 {instructor}\n📅 {date}\n🕐 {time}\n\n"
+                "⏰ Не забудьте підготуватися!",
+    },
+}
+# Якщо час нагадування минув не більше ніж на стільки (рестарт, запис впритул) — надсилаємо одразу
+REMINDER_GRACE = timedelta(minutes=30)
+# Як часто воркер 0 webhook-режиму звіряє jobs нагадувань з БД, секунди
+REMINDER_SYNC_INTERVAL = int(os.getenv("REMINDER_SYNC_INTERVAL", "60"))
+
+def lesson_start(date_str, time_str):
+    """Початок уроку з date і time таблиці lessons (дата в обох форматах, як starts_at); None, якщо їх не розібрати"""
+    starts_at = lesson_starts_at(date_str, time_str)
+    if starts_at is None:
+        return None
+    return TZ.localize(datetime.strptime(starts_at, "%Y-%m-%d %H:%M"))
+
+def schedule_lesson_reminders(job_queue, lesson_id, date_str, time_str, skip=()):
+    """Запланувати нагадування 24h/2h для уроку (kinds зі skip вже надіслані); True, якщо додано нове"""
+    if job_queue is None:
+        return False
+    starts = lesson_start(date_str, time_str)
+    if starts is None:
+        logger.error(f"Error parsing lesson date {date_str} {time_str}: урок {lesson_id} без нагадувань")
+        return False
+    
+    now = datetime.now(TZ)
+    added = False
+    for kind, reminder in REMINDERS.items():
+        if kind in skip:
+            continue
+        due = starts - reminder["offset"]
+        if due < now - REMINDER_GRACE:
+            continue
+        
+        name = f"reminders_{kind}_{due.strftime('%Y%m%d%H%M')}"
+        jobs = job_queue.get_jobs_by_name(name)
+        if jobs:
+            added |= lesson_id not in jobs[0].data["lesson_ids"]
+            jobs[0].data["lesson_ids"].add(lesson_id)
+        else:
+            job_queue.run_once(
+                send_reminders,
+                when=due if due > now else 0,
+                name=name,
+                data={"kind": kind, "due": due, "lesson_ids": {lesson_id}}
+            )
+            added = True
+    return added
+
+def cancel_lesson_reminders(job_queue, lesson_id):
+    """Прибрати урок із запланованих нагадувань (скасування, перенесення)"""
+    if job_queue is None:
+        return
+    for job in job_queue.jobs():
+        if not (job.name or "").startswith("reminders_"):
+            continue
+        lesson_ids = job.data["lesson_ids"]
+        if lesson_id in lesson_ids:
+            lesson_ids.discard(lesson_id)
+            if not lesson_ids:
+                job.schedule_removal()
+
+def get_unreminded_lessons():
+    """Активні уроки з сьогодні, яким ще не надіслано хоча б одне нагадування.
+
+    Відбір за starts_at: він нормалізований для обох форматів дати, а уроки з
+    нерозбірною датою (starts_at NULL) не потрапляють у щохвилинну синхронізацію.
+    """
     try:
-        now = datetime.now(TZ)
-        logger.info(f"🔔 send_reminders запущено! Зараз: {now.strftime('%d.%m.%Y %H:%M')}")
-        
+        today = datetime.now(TZ).strftime('%Y-%m-%d 00:00')
         with get_db() as conn:
             cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT l.id, l.student_telegram_id, i.name, l.date, l.time
-                FROM lessons l
-                JOIN instructors i ON l.instructor_id = i.id
-                WHERE l.status = 'active' 
-                AND l.reminder_24h_sent = 0
-            """)
-            
-            all_lessons = cursor.fetchall()
-            lessons_24h = []
-            
-            for lesson_id, student_id, instructor, date_str, time_str in all_lessons:
-                try:
-                    lesson_datetime = datetime.strptime(f"{date_str} {time_str}", "%d.%m.%Y %H:%M")
-                    lesson_datetime = TZ.localize(lesson_datetime)
-                    
-                    time_diff = (lesson_datetime - now).total_seconds() / 3600
-                    
-                    if 23.5 <= time_diff <= 24.5:
-                        lessons_24h.append((lesson_id, student_id, instructor, date_str, time_str))
-                except Exception as e:
-                    logger.error(f"Error parsing lesson date {date_str} {time_str}: {e}")
-            
-            for lesson_id, student_id, instructor, date, time in lessons_24h:
-                try:
-                    await context.bot.send_message(
-                        chat_id=student_id,
-                        text=f"⏰ *Нагадування!*\n\nУ вас заняття завтра:\n"
-                             f"👨‍🏫 {instructor}\n📅 {date}\n🕐 {time}",
-                        parse_mode="Markdown",
-                        reply_markup=ReplyKeyboardRemove()
-                    )
-                    
-                    cursor.execute("UPDATE lessons SET reminder_24h_sent = 1 WHERE id = ?", (lesson_id,))
-                    conn.commit()
-                except Exception as e:
-                    logger.error(f"Failed to send 24h reminder: {e}")
-            
             cursor.execute("""
-                SELECT l.id, l.student_telegram_id, i.name, l.date, l.time
-                FROM lessons l
-                JOIN instructors i ON l.instructor_id = i.id
-                WHERE l.status = 'active' 
-                AND l.reminder_2h_sent = 0
-            """)
-            
-            all_lessons_2h = cursor.fetchall()
-            lessons_2h = []
-            
-            for lesson_id, student_id, instructor, date_str, time_str in all_lessons_2h:
-                try:
-                    lesson_datetime = datetime.strptime(f"{date_str} {time_str}", "%d.%m.%Y %H:%M")
-                    lesson_datetime = TZ.localize(lesson_datetime)
-                    
-                    time_diff = (lesson_datetime - now).total_seconds() / 3600
-                    
-                    if 1.5 <= time_diff <= 2.5:
-                        lessons_2h.append((lesson_id, student_id, instructor, date_str, time_str))
-                except Exception as e:
-                    logger.error(f"Error parsing lesson date {date_str} {time_str}: {e}")
-            
-            for lesson_id, student_id, instructor, date, time in lessons_2h:
-                try:
-                    await context.bot.send_message(
-                        chat_id=student_id,
-                        text=f"🔔 *Нагадування!*\n\nУ вас заняття через 2 години:\n"
-                             f"👨‍🏫 {instructor}\n📅 {date}\n🕐 {time}\n\n"
-                             f"⏰ Не забудьте підготуватися!",
-                        parse_mode="Markdown",
-                        reply_markup=ReplyKeyboardRemove()
-                    )
-                    
-                    cursor.execute("UPDATE lessons SET reminder_2h_sent = 1 WHERE id = ?", (lesson_id,))
-                    conn.commit()
-                except Exception as e:
-                    logger.error(f"Failed to send 2h reminder: {e}")
-        
-        logger.info("✅ Reminders sent successfully")
-        
+                SELECT id, date, time, reminder_24h_sent, reminder_2h_sent
+                FROM lessons
+                WHERE status = 'active'
+                AND starts_at >= ?
+                AND (reminder_24h_sent = 0 OR reminder_2h_sent = 0)
+            """, (today,))
+            return cursor.fetchall()
     except Exception as e:
-        logger.error(f"Error in send_reminders: {e}", exc_info=True)
+        logger.error(f"Error in get_unreminded_lessons: {e}", exc_info=True)
+        return []
+
+def schedule_reminders_for(job_queue, lessons):
+    """Jobs для рядків get_unreminded_lessons(); повертає кількість уроків з новими jobs"""
+    added = 0
+    for lesson_id, date_str, time_str, sent_24h, sent_2h in lessons:
+        skip = [kind for kind, sent in (("24h", sent_24h), ("2h", sent_2h)) if sent]
+        added += schedule_lesson_reminders(job_queue, lesson_id, date_str, time_str, skip)
+    return added
+
+def rebuild_reminder_jobs(job_queue):
+    """Відновити jobs нагадувань з БД після старту бота"""
+    lessons = get_unreminded_lessons()
+    schedule_reminders_for(job_queue, lessons)
+    logger.info(f"🔔 Заплановано нагадування для {len(lessons)} уроків")
 
-async def send_rating_request_to_student(context, student_tg_id, lesson_id, date, time, instructor_name):
+@metrics.instrument("job")
+async def sync_reminder_jobs(context: ContextTypes.DEFAULT_TYPE):
+    """webhook-режим: jobs для уроків, записаних або перенесених у воркерах без job_queue"""
     try:
-        keyboard = [
-            [KeyboardButton("⭐"), KeyboardButton("⭐⭐"), KeyboardButton("⭐⭐⭐")],
-            [KeyboardButton("⭐⭐⭐⭐"), KeyboardButton("⭐⭐⭐⭐⭐")],
-            [KeyboardButton("⏭️ Пропустити")]
+        lessons = await run_db(get_unreminded_lessons)
+        added = schedule_reminders_for(context.job_queue, lessons)
+        if added:
+            logger.info(f"🔔 Нагадування з інших воркерів: додано {added} уроків")
+    except Exception as e:
+        logger.error(f"Error in sync_reminder_jobs: {e}", exc_info=True)
+
+@metrics.instrument("job")
+async def send_reminders(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        kind = context.job.data["kind"]
+        lesson_ids = list(context.job.data["lesson_ids"])
+        reminder = REMINDERS[kind]
+        logger.info(f"🔔 send_reminders ({kind}): {len(lesson_ids)} уроків")
+        
+        # Перечитуємо уроки: між плануванням і відправкою урок могли скасувати
+        lessons = await aio.get_pending_reminders(reminder["flag"], lesson_ids)
+        # ...або перенести там, де цей job не прибрали (інший воркер): нагадування
+        # надішле job нового часу
+        due = context.job.data["due"]
+        lessons = [
+            lesson for lesson in lessons
+            if (starts := lesson_start(lesson[3], lesson[4])) is not None and starts - reminder["offset"] == due
         ]
         
-        await context.bot.send_message(
-            chat_id=student_tg_id,
-            text=f"✅ *Урок завершено!*\n\n"
-                 f"📅 {date} {time}\n"
-                 f"👨‍🏫 {instructor_name}\n\n"
-                 f"⭐ Оцініть інструктора:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
-            parse_mode="Markdown"
-        )
+        messages = [
+            (lesson_id, student_id, {
+                "text": reminder["text"].format(instructor=instructor, date=date, time=time),
+                "parse_mode": "Markdown",
+                "reply_markup": ReplyKeyboardRemove(),
+            })
+            for lesson_id, student_id, instructor, date, time in lessons
+        ]
+        report = await deliver(context.bot, messages, name=f"reminders {kind}")
         
-        context.bot_data[f"rating_lesson_{student_tg_id}"] = {
-            'lesson_id': lesson_id,
-            'instructor_name': instructor_name,
-            'date': date,
-            'time': time
-        }
+        # Невдалі теж позначаємо: deliver уже повторив тимчасові помилки, а Forbidden
+        # (бот заблоковано) не минає — інакше sync_reminder_jobs щохвилини плануватиме їх знову
+        handled = report['sent'] + report['failed']
+        if handled:
+            await aio.mark_reminders_sent(reminder["flag"], handled)
+        if report['failed']:
+            logger.warning(f"🔕 Нагадування {kind} не доставлено для уроків {report['failed']}, повтору не буде")
         
     except Exception as e:
-        logger.error(f"Error sending rating request: {e}", exc_info=True)
+        logger.error(f"Error in send_reminders: {e}", exc_info=True)
+
+def build_rating_request(date, time, instructor_name):
+    """Повідомлення учню з проханням оцінити інструктора після уроку"""
+    keyboard = [
+        [KeyboardButton("⭐"), KeyboardButton("⭐⭐"), KeyboardButton("⭐⭐⭐")],
+        [KeyboardButton("⭐⭐⭐⭐"), KeyboardButton("⭐⭐⭐⭐⭐")],
+        [KeyboardButton("⏭️ Пропустити")]
+    ]
+    return {
+        "text": f"✅ *Урок завершено!*\n\n"
+                f"📅 {date} {time}\n"
+                f"👨‍🏫 {instructor_name}\n\n"
+                f"⭐ Оцініть інструктора:",
+        "reply_markup": ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
+        "parse_mode": "Markdown",
+    }
 
+@metrics.instrument("job")
 async def check_completed_lessons(context: ContextTypes.DEFAULT_TYPE):
     try:
-        now = datetime.now(TZ)
-        
-        with get_db() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT l.id, l.date, l.time, l.student_telegram_id, 
-                       l.instructor_id, i.name as instructor_name
-                FROM lessons l
-                JOIN instructors i ON l.instructor_id = i.id
-                WHERE l.status = 'active'
-            """)
-            
-            lessons_to_complete = []
-            
-            for lesson_id, date_str, time_str, student_tg_id, instructor_id, instructor_name in cursor.fetchall():
-                try:
-                    lesson_datetime = datetime.strptime(f"{date_str} {time_str}", "%d.%m.%Y %H:%M")
-                    lesson_datetime = TZ.localize(lesson_datetime)
-                    
-                    if lesson_datetime < now:
-                        lessons_to_complete.append({
-                            'id': lesson_id,
-                            'date': date_str,
-                            'time': time_str,
-                            'student_tg_id': student_tg_id,
-                            'instructor_id': instructor_id,
-                            'instructor_name': instructor_name
-                        })
-                except Exception as e:
-                    logger.error(f"Error parsing lesson date {date_str} {time_str}: {e}")
-            
-            for lesson in lessons_to_complete:
-                cursor.execute("""
-                    UPDATE lessons
-                    SET status = 'completed', completed_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                """, (lesson['id'],))
-            
-            conn.commit()
+        now = datetime.now(TZ).strftime('%Y-%m-%d %H:%M')
+        
+        completed = await aio.complete_started_lessons(now)
+        
+        instructor_names = {}
+        for instructor_id in {row[4] for row in completed}:
+            instructor = get_instructor_by_id(instructor_id)
+            if instructor:
+                instructor_names[instructor_id] = instructor[0]
+        
+        if completed:
+            logger.info(f"Completed {len(completed)} lessons")
+            
+            requests = {}
+            for lesson_id, date_str, time_str, student_tg_id, instructor_id in completed:
+                if student_tg_id:
+                    requests[lesson_id] = (student_tg_id, date_str, time_str, instructor_names.get(instructor_id))
+            
+            # Ключі оцінювання ставимо до відправки: учень може відповісти, щойно отримає запит
+            for lesson_id, (student_tg_id, date_str, time_str, instructor_name) in requests.items():
+                context.bot_data[f"rating_lesson_{student_tg_id}"] = {
+                    'lesson_id': lesson_id,
+                    'instructor_name': instructor_name,
+                    'date': date_str,
+                    'time': time_str
+                }
+            if context.application.persistence is not None:
+                # У webhook-режимі учня обслуговує інший воркер — він прочитає ключ з БД
+                await context.application.update_persistence()
+                await context.application.persistence.flush()
+            
+            messages = [
+                (lesson_id, student_tg_id, build_rating_request(date_str, time_str, instructor_name))
+                for lesson_id, (student_tg_id, date_str, time_str, instructor_name) in requests.items()
+            ]
+            report = await deliver(context.bot, messages, name="rating requests")
             
-            if lessons_to_complete:
-                logger.info(f"Completed {len(lessons_to_complete)} lessons")
-                
-                for lesson in lessons_to_complete:
-                    try:
-                        await send_rating_request_to_student(
-                            context, 
-                            lesson['student_tg_id'],
-                            lesson['id'],
-                            lesson['date'],
-                            lesson['time'],
-                            lesson['instructor_name']
-                        )
-                    except Exception as e:
-                        logger.error(f"Failed to send rating request for lesson {lesson['id']}: {e}")
+            for lesson_id in requests.keys() - set(report['sent']):
+                key = f"rating_lesson_{requests[lesson_id][0]}"
+                if context.bot_data.get(key, {}).get('lesson_id') == lesson_id:
+                    del context.bot_data[key]
         
     except Exception as e:
         logger.error(f"Error in check_completed_lessons: {e}", exc_info=True)
 
+@metrics.instrument("job")
+async def wal_checkpoint(context: ContextTypes.DEFAULT_TYPE):
+    """Періодичний checkpoint: PASSIVE, а якщо -wal розрісся — TRUNCATE"""
+    try:
+        wal_size = get_wal_size()
+        mode = "TRUNCATE" if wal_size > WAL_TRUNCATE_BYTES else "PASSIVE"
+        result = await aio.checkpoint_wal(mode)
+        if result is None:
+            return
+        busy, log_frames, checkpointed = result
+        if mode == "TRUNCATE":
+            logger.info(f"🧹 WAL {wal_size / 1024 / 1024:.1f} МБ → checkpoint TRUNCATE, "
+                        f"перенесено {checkpointed}/{log_frames} сторінок")
+        if busy or checkpointed < log_frames:
+            # Довгий читач тримає старий знімок — WAL ростиме, доки він не завершиться
+            logger.warning(f"⚠️ Checkpoint {mode} неповний: {checkpointed}/{log_frames} сторінок, "
+                           f"-wal {get_wal_size() / 1024 / 1024:.1f} МБ")
+    except Exception as e:
+        logger.error(f"Error in wal_checkpoint: {e}", exc_info=True)
+
 # ======================= EXPORT WITH PERIOD SELECTION =======================
 async def show_export_period_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
@@ -4752,349 +4437,206 @@ async def handle_export_custom_period(update: Update, context: ContextTypes.DEFA
         logger.error(f"Error in handle_export_custom_period: {e}", exc_info=True)
         await update.message.reply_text("❌ Помилка обробки періоду.")
 
+# Уроки за період для Excel-експорту: перші 14 колонок — аркуш "Уроки", решта — для підсумків
+EXPORT_LESSONS_SQL = """
+    SELECT 
+        l.id, l.date, l.time,
+        i.name as instructor_name,
+        s.name as student_name,
+        s.phone as student_phone,
+        s.tariff,
+        l.duration,
+        s.tariff * l.duration_minutes / 60.0 as earnings,
+        l.status, l.rating, l.feedback,
+        l.instructor_rating, l.instructor_feedback,
+        l.instructor_id, l.duration_minutes, i.price_per_hour
+    FROM lessons l
+    LEFT JOIN instructors i ON l.instructor_id = i.id
+    LEFT JOIN students s ON l.student_telegram_id = s.telegram_id
+    WHERE l.date_iso BETWEEN ? AND ?
+    ORDER BY l.date_iso DESC, l.time DESC
+"""
+EXPORT_LESSON_COLUMNS = 14
+EXPORT_MAX_COLUMN_WIDTH = 50
+EXPORT_HEADER_FILL = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+EXPORT_HEADER_FONT = Font(bold=True, color="FFFFFF")
+EXPORT_HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="center")
+
+class ColumnWidths:
+    """Ширини колонок, що ростуть разом з рядками.
+
+    У write-only аркуші ширини пишуться до першого рядка, тому їх рахують
+    заздалегідь і без повторного перебору комірок.
+    """
+
+    def __init__(self, headers):
+        self.widths = [len(str(header)) for header in headers]
+
+    def update(self, row):
+        for index, value in enumerate(row):
+            if value is not None and len(str(value)) > self.widths[index]:
+                self.widths[index] = len(str(value))
+
+    def apply(self, ws):
+        for index, width in enumerate(self.widths, 1):
+            ws.column_dimensions[get_column_letter(index)].width = min(width + 2, EXPORT_MAX_COLUMN_WIDTH)
+
+def _write_export_sheet(wb, title, headers, widths, rows):
+    """Write-only аркуш: ширини, стилізований заголовок, потім рядки з ітератора"""
+    ws = wb.create_sheet(title=title)
+    widths.apply(ws)
+    header_cells = []
+    for header in headers:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.fill = EXPORT_HEADER_FILL
+        cell.font = EXPORT_HEADER_FONT
+        cell.alignment = EXPORT_HEADER_ALIGNMENT
+        header_cells.append(cell)
+    ws.append(header_cells)
+    for row in rows:
+        ws.append(row)
+
+def build_excel_export(date_from, date_to):
+    """Excel-файл за період (дати dd.mm.YYYY); виконується в робочому потоці.
+
+    Уроки читаються курсором по діапазону date_iso двічі в одній транзакції
+    читання: перший прохід рахує ширини колонок і підсумки по учнях та
+    інструкторах, другий пише рядки у write-only аркуш. Повертає
+    (BytesIO, {'lessons', 'students', 'earnings'}).
+    """
+    period = (normalize_date(date_from), normalize_date(date_to))
+
+    headers1 = ["ID", "Дата", "Час", "Інструктор", "Учень", "Телефон", "Тариф", "Тривалість", "Вартість", "Статус", "⭐ Оцінка учня", "💬 Коментар учня", "⭐ Оцінка інструктора", "💬 Коментар інструктора"]
+    headers2 = ["Учень", "Телефон", "Тариф", "Уроків", "Годин", "Витрачено", "⭐ Середній рейтинг"]
+    headers3 = ["Інструктор", "Тариф", "Уроків", "Годин", "Заробіток", "Рейтинг"]
+    headers4 = ["Інструктор", "Дата", "Час початку", "Час кінця", "Причина", "Створено"]
+
+    lesson_widths = ColumnWidths(headers1)
+    total_lessons = 0
+    total_earnings = 0
+    unique_students = set()
+    students_stats = {}
+    instructors_stats = {}
+
+    wb = Workbook(write_only=True)
+
+    with get_db() as conn:
+        # Обидва проходи бачать один знімок БД (WAL)
+        conn.execute("BEGIN")
+        for lesson in conn.execute(EXPORT_LESSONS_SQL, period):
+            lesson_widths.update(lesson[:EXPORT_LESSON_COLUMNS])
+            (_, _, _, instructor_name, student_name, student_phone, student_tariff, _, earnings,
+             _, rating, _, instructor_rating, _, instructor_id, minutes, instructor_price) = lesson
+
+            total_lessons += 1
+            if earnings:
+                total_earnings += earnings
+            if student_name:
+                unique_students.add(student_name)
+
+            if student_name and student_tariff:
+                stats = students_stats.setdefault(student_name, {
+                    'phone': student_phone, 'tariff': student_tariff,
+                    'lessons': 0, 'hours': 0, 'spent': 0, 'ratings': []
+                })
+                stats['lessons'] += 1
+                stats['hours'] += (minutes or 0) / 60
+                if earnings:
+                    stats['spent'] += earnings
+                if instructor_rating and instructor_rating > 0:
+                    stats['ratings'].append(instructor_rating)
+
+            if instructor_name:
+                stats = instructors_stats.setdefault(instructor_id, {
+                    'name': instructor_name, 'price': instructor_price,
+                    'lessons': 0, 'hours': 0, 'earnings': 0, 'ratings': []
+                })
+                stats['lessons'] += 1
+                stats['hours'] += (minutes or 0) / 60
+                if earnings:
+                    stats['earnings'] += earnings
+                if rating and rating > 0:
+                    stats['ratings'].append(rating)
+
+        _write_export_sheet(
+            wb, "Уроки", headers1, lesson_widths,
+            (lesson[:EXPORT_LESSON_COLUMNS] for lesson in conn.execute(EXPORT_LESSONS_SQL, period))
+        )
+
+        blocked_times = conn.execute("""
+            SELECT 
+                i.name AS instructor_name,
+                sb.date, sb.time_start, sb.time_end, sb.reason, sb.created_at
+            FROM schedule_blocks sb
+            JOIN instructors i ON sb.instructor_id = i.id
+            ORDER BY sb.date DESC, sb.time_start
+        """).fetchall()
+        conn.commit()
+
+    students_rows = []
+    for name, stats in sorted(students_stats.items(), key=lambda x: x[1]['lessons'], reverse=True):
+        avg_rating = sum(stats['ratings']) / len(stats['ratings']) if stats['ratings'] else None
+        if avg_rating:
+            avg_rating = round(avg_rating, 1)
+        students_rows.append((
+            name,
+            stats['phone'],
+            stats['tariff'],
+            stats['lessons'],
+            stats['hours'],
+            stats['spent'],
+            avg_rating if avg_rating else '-'
+        ))
+
+    instructors_rows = []
+    for stats in sorted(instructors_stats.values(), key=lambda x: x['lessons'], reverse=True):
+        avg_rating = sum(stats['ratings']) / len(stats['ratings']) if stats['ratings'] else 0
+        instructors_rows.append((
+            stats['name'],
+            stats['price'],
+            stats['lessons'],
+            stats['hours'],
+            stats['earnings'],
+            round(avg_rating, 1)
+        ))
+
+    blocks_rows = []
+    for instructor_name, date, time_start, time_end, reason, created_at in blocked_times:
+        try:
+            date_obj = datetime.strptime(date, "%Y-%m-%d")
+            weekday = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Нд"][date_obj.weekday()]
+            date_display = f"{weekday} {date_obj.strftime('%d.%m.%Y')}"
+        except (ValueError, TypeError):
+            date_display = date
+
+        try:
+            created_display = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S").strftime("%d.%m.%Y %H:%M")
+        except (ValueError, TypeError):
+            created_display = created_at
+
+        blocks_rows.append([instructor_name, date_display, time_start, time_end, reason or "Не вказано", created_display])
+    if not blocks_rows:
+        blocks_rows.append(["Немає заблокованих часів", "", "", "", "", ""])
+
+    for title, headers, rows in (("Учні", headers2, students_rows),
+                                 ("Інструктори", headers3, instructors_rows),
+                                 ("Заблоковані часи", headers4, blocks_rows)):
+        widths = ColumnWidths(headers)
+        for row in rows:
+            widths.update(row)
+        _write_export_sheet(wb, title, headers, widths, rows)
+
+    excel_file = BytesIO()
+    wb.save(excel_file)
+    excel_file.seek(0)
+    return excel_file, {'lessons': total_lessons, 'students': len(unique_students), 'earnings': total_earnings}
+
 async def export_to_excel_with_period(update: Update, context: ContextTypes.DEFAULT_TYPE, date_from: str, date_to: str, period_name: str):
-    user_id = update.message.from_user.id
-    
     try:
         await update.message.reply_text("⏳ Генерую Excel файл... Зачекайте...")
         
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, PatternFill, Alignment
-        from io import BytesIO
-        
-        wb = Workbook()
-        
-        ws1 = wb.active
-        ws1.title = "Уроки"
-        
-        headers1 = ["ID", "Дата", "Час", "Інструктор", "Учень", "Телефон", "Тариф", "Тривалість", "Вартість", "Статус", "⭐ Оцінка учня", "💬 Коментар учня", "⭐ Оцінка інструктора", "💬 Коментар інструктора"]
-        ws1.append(headers1)
-        
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF")
-        
-        for cell in ws1[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        with get_db() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("PRAGMA table_info(lessons)")
-            columns = {row[1] for row in cursor.fetchall()}
-            has_instructor_rating = 'instructor_rating' in columns
-            has_instructor_feedback = 'instructor_feedback' in columns
-            
-            if has_instructor_rating and has_instructor_feedback:
-                cursor.execute("""
-                    SELECT 
-                        l.id, l.date, l.time,
-                        i.name as instructor_name,
-                        s.name as student_name,
-                        s.phone as student_phone,
-                        s.tariff,
-                        l.duration,
-                        CASE 
-                            WHEN l.duration LIKE '%2%' THEN s.tariff * 2
-                            WHEN l.duration LIKE '%1.5%' THEN s.tariff * 1.5
-                            ELSE s.tariff * 1
-                        END as earnings,
-                        l.status, l.rating, l.feedback,
-                        l.instructor_rating, l.instructor_feedback
-                    FROM lessons l
-                    LEFT JOIN instructors i ON l.instructor_id = i.id
-                    LEFT JOIN students s ON l.student_telegram_id = s.telegram_id
-                    ORDER BY l.date DESC, l.time DESC
-                """)
-            else:
-                cursor.execute("""
-                    SELECT 
-                        l.id, l.date, l.time,
-                        i.name as instructor_name,
-                        s.name as student_name,
-                        s.phone as student_phone,
-                        s.tariff,
-                        l.duration,
-                        CASE 
-                            WHEN l.duration LIKE '%2%' THEN s.tariff * 2
-                            WHEN l.duration LIKE '%1.5%' THEN s.tariff * 1.5
-                            ELSE s.tariff * 1
-                        END as earnings,
-                        l.status, l.rating, l.feedback,
-                        NULL as instructor_rating,
-                        NULL as instructor_feedback
-                    FROM lessons l
-                    LEFT JOIN instructors i ON l.instructor_id = i.id
-                    LEFT JOIN students s ON l.student_telegram_id = s.telegram_id
-                    ORDER BY l.date DESC, l.time DESC
-                """)
-            
-            all_lessons = cursor.fetchall()
-        
-        from datetime import datetime as dt
-        date_from_obj = dt.strptime(date_from, "%d.%m.%Y")
-        date_to_obj = dt.strptime(date_to, "%d.%m.%Y")
-        
-        lessons = []
-        for lesson in all_lessons:
-            try:
-                lesson_date = dt.strptime(lesson[1], "%d.%m.%Y")
-                if date_from_obj <= lesson_date <= date_to_obj:
-                    lessons.append(lesson)
-            except (ValueError, TypeError):
-                continue
-        
-        total_lessons = len(lessons)
-        total_earnings = 0
-        unique_students = set()
-        
-        for lesson in lessons:
-            ws1.append(lesson)
-            if lesson[8]:
-                total_earnings += lesson[8]
-            if lesson[4]:
-                unique_students.add(lesson[4])
-        
-        for column in ws1.columns:
-            max_length = 0
-            column = [cell for cell in column]
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws1.column_dimensions[column[0].column_letter].width = adjusted_width
-        
-        ws2 = wb.create_sheet(title="Учні")
-        headers2 = ["Учень", "Телефон", "Тариф", "Уроків", "Годин", "Витрачено", "⭐ Середній рейтинг"]
-        ws2.append(headers2)
-        
-        for cell in ws2[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        students_stats = {}
-        
-        for lesson in lessons:
-            student_name = lesson[4]
-            student_phone = lesson[5]
-            student_tariff = lesson[6]
-            duration = lesson[7]
-            earnings = lesson[8]
-            instructor_rating = lesson[12]
-            
-            if not student_name or not student_tariff:
-                continue
-            
-            if student_name not in students_stats:
-                students_stats[student_name] = {
-                    'phone': student_phone,
-                    'tariff': student_tariff,
-                    'lessons': 0,
-                    'hours': 0,
-                    'spent': 0,
-                    'ratings': []
-                }
-            
-            students_stats[student_name]['lessons'] += 1
-            
-            if "1.5" in duration:
-                students_stats[student_name]['hours'] += 1.5
-            elif "2" in duration:
-                students_stats[student_name]['hours'] += 2
-            else:
-                students_stats[student_name]['hours'] += 1
-            
-            if earnings:
-                students_stats[student_name]['spent'] += earnings
-            
-            if instructor_rating and instructor_rating > 0:
-                students_stats[student_name]['ratings'].append(instructor_rating)
-        
-        for name, stats in sorted(students_stats.items(), key=lambda x: x[1]['lessons'], reverse=True):
-            avg_rating = sum(stats['ratings']) / len(stats['ratings']) if stats['ratings'] else None
-            if avg_rating:
-                avg_rating = round(avg_rating, 1)
-            
-            ws2.append((
-                name,
-                stats['phone'],
-                stats['tariff'],
-                stats['lessons'],
-                stats['hours'],
-                stats['spent'],
-                avg_rating if avg_rating else '-'
-            ))
-        
-        for column in ws2.columns:
-            max_length = 0
-            column = [cell for cell in column]
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws2.column_dimensions[column[0].column_letter].width = adjusted_width
-        
-        ws3 = wb.create_sheet(title="Інструктори")
-        headers3 = ["Інструктор", "Тариф", "Уроків", "Годин", "Заробіток", "Рейтинг"]
-        ws3.append(headers3)
-        
-        for cell in ws3[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, name, price_per_hour FROM instructors")
-            all_instructors = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
-        
-        instructors_stats = {}
-        
-        for lesson in lessons:
-            instructor_name = lesson[3]
-            if not instructor_name:
-                continue
-            
-            instructor_id = None
-            instructor_price = 0
-            for iid, (iname, iprice) in all_instructors.items():
-                if iname == instructor_name:
-                    instructor_id = iid
-                    instructor_price = iprice
-                    break
-            
-            if not instructor_id:
-                continue
-            
-            if instructor_id not in instructors_stats:
-                instructors_stats[instructor_id] = {
-                    'name': instructor_name,
-                    'price': instructor_price,
-                    'lessons': 0,
-                    'hours': 0,
-                    'earnings': 0,
-                    'ratings': []
-                }
-            
-            instructors_stats[instructor_id]['lessons'] += 1
-            
-            duration = lesson[7]
-            if "1.5" in duration:
-                instructors_stats[instructor_id]['hours'] += 1.5
-            elif "2" in duration:
-                instructors_stats[instructor_id]['hours'] += 2
-            else:
-                instructors_stats[instructor_id]['hours'] += 1
-            
-            earnings = lesson[8]
-            if earnings:
-                instructors_stats[instructor_id]['earnings'] += earnings
-            
-            rating = lesson[10]
-            if rating and rating > 0:
-                instructors_stats[instructor_id]['ratings'].append(rating)
-        
-        for iid, stats in sorted(instructors_stats.items(), key=lambda x: x[1]['lessons'], reverse=True):
-            avg_rating = sum(stats['ratings']) / len(stats['ratings']) if stats['ratings'] else 0
-            ws3.append((
-                stats['name'],
-                stats['price'],
-                stats['lessons'],
-                stats['hours'],
-                stats['earnings'],
-                round(avg_rating, 1)
-            ))
-        
-        for column in ws3.columns:
-            max_length = 0
-            column = [cell for cell in column]
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws3.column_dimensions[column[0].column_letter].width = adjusted_width
-
-        ws4 = wb.create_sheet(title="Заблоковані часи")
-        headers4 = ["Інструктор", "Дата", "Час початку", "Час кінця", "Причина", "Створено"]
-        ws4.append(headers4)
-        
-        for cell in ws4[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT 
-                    i.name AS instructor_name,
-                    sb.date, sb.time_start, sb.time_end, sb.reason, sb.created_at
-                FROM schedule_blocks sb
-                JOIN instructors i ON sb.instructor_id = i.id
-                ORDER BY sb.date DESC, sb.time_start
-            """)
-            blocked_times = cursor.fetchall()
-        
-        if blocked_times:
-            for block in blocked_times:
-                instructor_name = block[0]
-                date = block[1]
-                time_start = block[2]
-                time_end = block[3]
-                reason = block[4] or "Не вказано"
-                created_at = block[5]
-                
-                try:
-                    date_obj = datetime.strptime(date, "%Y-%m-%d")
-                    date_formatted = date_obj.strftime("%d.%m.%Y")
-                    weekday = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Нд"][date_obj.weekday()]
-                    date_display = f"{weekday} {date_formatted}"
-                except:
-                    date_display = date
-                
-                try:
-                    created_obj = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S")
-                    created_display = created_obj.strftime("%d.%m.%Y %H:%M")
-                except:
-                    created_display = created_at
-                
-                ws4.append([
-                    instructor_name,
-                    date_display,
-                    time_start,
-                    time_end,
-                    reason,
-                    created_display
-                ])
-        else:
-            ws4.append(["Немає заблокованих часів", "", "", "", "", ""])
-        
-        for column in ws4.columns:
-            max_length = 0
-            column = [cell for cell in column]
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws4.column_dimensions[column[0].column_letter].width = adjusted_width
-        
-        excel_file = BytesIO()
-        wb.save(excel_file)
-        excel_file.seek(0)
+        # Файл будується в робочому потоці — бот тим часом відповідає іншим
+        excel_file, summary = await asyncio.to_thread(build_excel_export, date_from, date_to)
         
         filename = f"export_{period_name.replace(' ', '_').replace(':', '-')}.xlsx"
         
@@ -5104,9 +4646,9 @@ async def export_to_excel_with_period(update: Update, context: ContextTypes.DEFA
             filename=filename,
             caption=f"📊 *Експорт завершено!*\n\n"
                    f"📅 Період: {period_name}\n"
-                   f"📝 Уроків: {total_lessons}\n"
-                   f"👥 Учнів: {len(unique_students)}\n"
-                   f"💰 Загальний заробіток: {total_earnings:.0f} грн",
+                   f"📝 Уроків: {summary['lessons']}\n"
+                   f"👥 Учнів: {summary['students']}\n"
+                   f"💰 Загальний заробіток: {summary['earnings']:.0f} грн",
             parse_mode="Markdown"
         )
         
@@ -5122,7 +4664,398 @@ async def export_to_excel_with_period(update: Update, context: ContextTypes.DEFA
         )
         await show_admin_panel(update, context)
 
+# ======================= PROFILING =======================
+PROFILE_DEFAULT_SECONDS = 60
+PROFILE_MAX_SECONDS = 600
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [секунди] — семплюючий профайлер обробників і jobs, результат файлом в цей чат"""
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас немає доступу.")
+        return
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text("❌ Формат: /profile 60")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    
+    if not start_profiling_session(context.application, update.message.chat_id, seconds):
+        await update.message.reply_text("⏳ Профілювання вже триває.")
+        return
+    await update.message.reply_text(
+        f"🔬 Профілювання запущено на {seconds} с.\n"
+        f"Файл з результатом надійде в цей чат."
+    )
+
+def start_profiling_session(application, chat_id, seconds):
+    """Запустити профайлер і запланувати відправку результату; False, якщо сеанс уже йде.
+
+    Профілюється процес, що обробив команду. Воркер webhook-режиму без job_queue
+    відкладає відправку звичайною задачею asyncio.
+    """
+    if not profiler.start_profiling():
+        return False
+    if application.job_queue is not None:
+        application.job_queue.run_once(finish_profiling, when=seconds, data={"chat_id": chat_id}, name="profiling")
+    else:
+        application.create_task(send_profile_later(application.bot, chat_id, seconds))
+    logger.info(f"🔬 Профілювання на {seconds} с для чату {chat_id}")
+    return True
+
+async def send_profile_later(bot, chat_id, seconds):
+    await asyncio.sleep(seconds)
+    await send_profile(bot, chat_id)
+
+async def finish_profiling(context: ContextTypes.DEFAULT_TYPE):
+    await send_profile(context.bot, context.job.data["chat_id"])
+
+async def send_profile(bot, chat_id):
+    try:
+        session = profiler.stop_profiling()
+        if session is None:
+            return
+        
+        top = "\n".join(f"{share * 100:5.1f}% {frame}" for frame, share in profiler.top_functions(session.stacks))
+        document = BytesIO(profiler.collapse(session.stacks).encode("utf-8"))
+        filename = f"profile_{datetime.now(TZ).strftime('%Y%m%d_%H%M%S')}.collapsed.txt"
+        
+        await bot.send_document(
+            chat_id=chat_id,
+            document=document,
+            filename=filename,
+            caption=f"🔬 Профіль за {session.elapsed:.0f} с\n"
+                    f"📊 Семплів з активними обробниками: {session.samples}\n"
+                    f"🔥 Найбільше власного часу:\n{top or 'немає даних'}\n\n"
+                    f"Відкрити: speedscope.app або flamegraph.pl"
+        )
+        logger.info(f"✅ Профіль надіслано: {session.samples} семплів, {len(session.stacks)} стеків")
+    except Exception as e:
+        logger.error(f"Error in send_profile: {e}", exc_info=True)
+
+# ======================= MESSAGE ROUTES =======================
+# Рівні маршрутів у порядку пріоритету старого ланцюжка if у handle_message.
+# Ключі: (стан, текст кнопки), (стан, None) — будь-який текст у стані, (None, текст) — у будь-якому стані.
+# На кожному рівні береться один обробник; якщо він повертає False, перевіряється наступний рівень.
+STAR_RATINGS = ["⭐", "⭐⭐", "⭐⭐⭐", "⭐⭐⭐⭐", "⭐⭐⭐⭐⭐"]
+
+MESSAGE_ROUTES = [
+    {
+        **{(None, stars): rate_instructor_by_student for stars in STAR_RATINGS},
+        (None, "⏭️ Пропустити"): skip_instructor_rating,
+    },
+    {
+        ("rating_feedback", "✍️ Написати коментар"): ask_rating_comment,
+        ("rating_feedback", "⏭️ Пропустити"): skip_rating_comment,
+        ("rating_feedback_input", "⏭️ Пропустити"): skip_rating_comment,
+        ("rating_feedback_input", None): save_rating_comment,
+        ("registration_name", "🔙 Скасувати"): cancel_registration,
+        ("registration_name", None): handle_registration_name,
+        ("registration_phone", "🔙 Скасувати"): cancel_registration,
+        ("registration_phone", None): handle_registration_phone,
+    },
+    {
+        (None, "🔐 Панель адміна"): open_admin_panel,
+        (None, "📥 Експорт в Excel"): show_export_period_menu,
+    },
+    {
+        ("admin_panel", "✏️ Управління записами"): handle_admin_manage_bookings,
+        ("admin_panel", "➕ Додати учня"): admin_add_student_start,
+        ("admin_panel", None): handle_admin_report,
+        ("admin_add_student_name", None): handle_admin_add_student_name,
+        ("admin_add_student_phone", None): handle_admin_add_student_phone,
+        ("admin_add_student_tariff", None): handle_admin_add_student_tariff,
+        ("admin_add_student_tgid", None): handle_admin_add_student_tgid,
+        ("admin_manage_bookings", None): handle_admin_manage_bookings,
+        ("admin_cancel_select_date", None): handle_admin_cancel_select_date,
+        ("admin_cancel_select_instructor", None): handle_admin_cancel_select_instructor,
+        ("admin_cancel_select_lesson", None): handle_admin_cancel_select_lesson,
+        ("admin_manual_enter_phone", None): handle_admin_manual_enter_phone,
+        ("admin_manual_confirm_student", None): handle_admin_manual_confirm_student,
+        ("admin_manual_enter_name", None): handle_admin_manual_enter_name,
+        ("admin_manual_select_tariff", None): handle_admin_manual_select_tariff,
+        ("admin_manual_select_transmission", None): handle_admin_manual_select_transmission,
+        ("admin_manual_select_instructor", None): handle_admin_manual_select_instructor,
+        ("admin_manual_select_date", None): handle_admin_manual_select_date,
+        ("admin_manual_select_time", None): handle_admin_manual_select_time,
+        ("admin_manual_select_duration", None): handle_admin_manual_select_duration,
+        ("admin_manual_confirm", None): handle_admin_manual_confirm,
+        ("admin_select_instructor_report", None): handle_instructor_report_select,
+        ("admin_instructor_report_period", None): handle_instructor_report_period,
+        ("admin_instructor_custom_period", None): handle_instructor_custom_period,
+        ("admin_report_period", None): handle_admin_report,
+        ("export_period", None): handle_export_period_choice,
+        ("export_custom_period", None): handle_export_custom_period,
+    },
+    {
+        (None, "🔙 Назад"): back_to_instructor_menu,
+        (None, "📅 Мій розклад"): show_instructor_schedule,
+        (None, "⚙️ Управління графіком"): manage_schedule,
+        (None, "📊 Моя статистика"): show_my_statistics,
+        (None, "❌ Історія скасувань"): show_cancellation_history,
+        (None, "⭐ Оцінити учня"): rate_student_menu,
+    },
+    {
+        ("stats_period", None): handle_stats_period,
+        ("stats_custom_period", None): handle_stats_custom_period,
+        **{(state, None): handle_rating_flow
+           for state in ("rating_select_lesson", "rating_give_score", "rating_give_feedback")},
+        **{(state, None): handle_edit_schedule
+           for state in ("edit_schedule_select", "edit_schedule_date", "edit_schedule_time")},
+        **{(state, None): handle_schedule_management
+           for state in ("schedule_menu", "block_choose_date", "block_choose_time_start", "block_choose_time_end",
+                         "block_choose_reason", "unblock_choose_date", "waiting_unblock")},
+    },
+    {
+        (None, "🚀 Записатися на заняття"): start_booking,
+        (None, "📖 Мої записи"): show_student_lessons,
+        (None, "📋 Мої записи"): show_student_lessons,
+        (None, "❌ Скасувати запис"): show_lessons_to_cancel,
+    },
+    {
+        ("cancel_lesson_select", None): handle_cancel_lesson,
+        ("cancel_lesson_confirm", None): handle_cancel_confirmation,
+        ("waiting_for_confirmation", "✅ Підтвердити"): save_lesson,
+        ("waiting_for_confirmation", "💬 Додати коментар"): ask_booking_comment,
+        ("waiting_for_confirmation", "✏️ Змінити коментар"): ask_booking_comment,
+        ("waiting_for_confirmation", "🔙 Скасувати"): cancel_booking,
+        ("waiting_for_booking_comment", "🔙 Назад"): back_to_booking_confirmation,
+        ("waiting_for_booking_comment", "⏭️ Пропустити"): skip_booking_comment,
+        ("waiting_for_booking_comment", None): save_booking_comment,
+        ("instructor_schedule_menu", "📅 На сьогодні"): show_schedule_today,
+        ("instructor_schedule_menu", "📅 На завтра"): show_schedule_tomorrow,
+        ("instructor_schedule_menu", "📅 На тиждень"): show_schedule_week,
+        ("instructor_schedule_menu", "📅 Свій період"): ask_schedule_custom_period,
+        ("instructor_schedule_menu", "🔙 Назад"): start,
+        ("instructor_schedule_custom_period", "🔙 Назад"): show_instructor_schedule,
+        ("instructor_schedule_custom_period", None): handle_schedule_custom_period,
+        ("waiting_for_transmission", "👨‍🏫 Обрати іншого інструктора"): choose_another_instructor,
+        ("waiting_for_transmission", None): handle_transmission_choice,
+        ("waiting_for_instructor", "🔙 Назад"): start,
+        ("waiting_for_instructor", "⚡ Найближчий вільний час"): show_first_free_slots,
+        ("waiting_for_first_slot", "🔙 Назад"): back_to_instructor_choice,
+        ("waiting_for_first_slot", None): handle_first_slot_choice,
+        ("waiting_for_instructor", None): handle_instructor_choice,
+        ("waiting_for_date", "🔙 Назад"): back_to_instructor_choice,
+        ("waiting_for_date", None): handle_date_choice,
+        ("waiting_for_time", "🔙 Назад"): back_to_date_choice,
+        ("waiting_for_time", None): handle_time_choice,
+        ("waiting_for_duration", "🔙 Назад"): back_to_time_choice,
+        ("waiting_for_duration", None): handle_duration_choice,
+        ("waiting_for_name", None): handle_student_name,
+        ("waiting_for_phone", None): handle_student_phone,
+    },
+]
+
+def build_route_index(routes):
+    """Стан → ({текст: ланцюжок обробників}, ланцюжок для довільного тексту).
+
+    Ланцюжок — обробники з усіх рівнів у порядку пріоритету, тож handle_message
+    робить два пошуки в словниках замість перебору рівнів. Ключ None — стан,
+    якого немає в таблиці (тоді діють лише маршрути за текстом).
+    """
+    states = {state for level in routes for state, _ in level if state is not None}
+    texts = {text for level in routes for _, text in level if text is not None}
+
+    def chain(state, text):
+        handlers = []
+        for level in routes:
+            handler = level.get((state, text)) or level.get((state, None)) or level.get((None, text))
+            if handler is not None:
+                handlers.append(handler)
+        return tuple(handlers)
+
+    return {
+        state: ({text: chain(state, text) for text in texts}, chain(state, None))
+        for state in states | {None}
+    }
+
+ROUTE_INDEX = build_route_index(MESSAGE_ROUTES)
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest, що записує час кожного запиту до Bot API в metrics"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        started = perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            metrics.record_api_call(url.rsplit("/", 1)[-1], perf_counter() - started)
+
 # ======================= MAIN =======================
+def init_storage():
+    """Схема БД і довідник інструкторів (один раз, до запуску обробників)"""
+    init_db()
+    init_lessons_table()
+    init_students_table()
+    migrate_database()
+    init_schedule_blocks_table()
+    init_persistence_table()
+    init_availability_table()
+    
+    ensure_instructors_exist()
+
+def build_application(updater=True, jobs=True, shared_state=False):
+    """Application з усіма обробниками.
+
+    updater=False — оновлення подаються ззовні (воркер webhook-режиму);
+    jobs=False — без нагадувань і службових jobs (їх виконує лише один воркер);
+    shared_state — bot_data спільний з іншими процесами через SQLite.
+    """
+    update_processor = PerUserUpdateProcessor(CONCURRENT_UPDATES)
+    metrics.register_gauge("bot_updates_waiting_user_lock", "Оновлення, що чекають завершення попереднього від того ж користувача",
+                           update_processor.waiting)
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .request(MeteredRequest(connection_pool_size=256))
+        .persistence(SQLitePersistence(shared=shared_state))
+        .concurrent_updates(update_processor)
+    )
+    if updater:
+        builder = builder.get_updates_request(MeteredRequest())
+    else:
+        builder = builder.updater(None)
+    if not jobs:
+        builder = builder.job_queue(None)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        logger.info(f"🧪 Bot API: {TELEGRAM_API_URL}")
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("register490", register_490))
+    app.add_handler(CommandHandler("register590", register_590))
+    app.add_handler(CommandHandler("profile", profile_command))
+    
+    app.add_handler(CallbackQueryHandler(handle_callback))
+    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message))
+    app.add_handler(MessageHandler(filters.CONTACT, handle_message))
+
+    if not jobs:
+        return app
+    if app.job_queue:
+        rebuild_reminder_jobs(app.job_queue)
+        app.job_queue.run_repeating(
+            check_completed_lessons,
+            interval=COMPLETED_CHECK_INTERVAL,
+            first=min(60, COMPLETED_CHECK_INTERVAL)
+        )
+        app.job_queue.run_repeating(wal_checkpoint, interval=WAL_CHECKPOINT_INTERVAL, first=WAL_CHECKPOINT_INTERVAL)
+        if shared_state:
+            app.job_queue.run_repeating(sync_reminder_jobs, interval=REMINDER_SYNC_INTERVAL, first=REMINDER_SYNC_INTERVAL)
+        if PROFILE_SECONDS > 0:
+            start_profiling_session(app, ADMIN_ID[0], PROFILE_SECONDS)
+        logger.info("✅ Job queue налаштовано")
+    else:
+        logger.warning("⚠️ Job queue недоступна - нагадування вимкнено")
+    return app
+
+def start_health_server(port, host='0.0.0.0', render_metrics=metrics.render, on_update=None):
+    """HTTP-сервер у фоновому потоці: / (health), /metrics і, якщо задано on_update, webhook Telegram"""
+    import threading
+    import json
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    
+    class HealthCheckHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] == '/metrics':
+                body = render_metrics().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                body = b'Bot is running!'
+                content_type = 'text/plain'
+            self.send_response(200)
+            self.send_header('Content-type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def do_POST(self):
+            if on_update is None or self.path != WEBHOOK_PATH:
+                self.send_error(404)
+                return
+            if self.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+                self.send_error(403)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            try:
+                update = json.loads(body)
+            except ValueError:
+                self.send_error(400)
+                return
+            on_update(update)
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer((host, port), HealthCheckHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_worker(index, workers, updates, ready):
+    """Процес-обробник webhook-режиму: оновлення з черги головного процесу"""
+    import signal
+    # Ctrl+C отримує вся група процесів; зупиняє воркерів головний процес через чергу
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ["DB_NAME"] = DB_NAME
+    asyncio.run(serve_worker(index, workers, updates, ready))
+
+async def serve_worker(index, workers, updates, ready):
+    app = build_application(updater=False, jobs=index == 0, shared_state=workers > 1)
+    server = start_health_server(0, host='127.0.0.1')
+    loop = asyncio.get_running_loop()
+    async with app:
+        await app.start()
+        ready.put((index, server.server_address[1]))
+        logger.info(f"👷 Воркер {index}/{workers} приймає оновлення")
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        await app.stop()
+    server.shutdown()
+    shutdown_db_executor()
+
+async def set_webhook():
+    from telegram import Bot
+    base_url = f"{TELEGRAM_API_URL}/bot" if TELEGRAM_API_URL else "https://api.telegram.org/bot"
+    async with Bot(TOKEN, base_url=base_url) as bot:
+        await bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+
+def run_webhook(port):
+    """Webhook-режим: головний процес приймає оновлення, WEBHOOK_WORKERS процесів їх обробляють"""
+    import signal
+    import time
+    from webhook import WorkerPool
+    
+    pool = WorkerPool(run_worker, WEBHOOK_WORKERS)
+    # SIGTERM (зупинка сервісу на Render) — як Ctrl+C: воркери дописують чергу і стан
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        pool.start()
+        start_health_server(port, render_metrics=pool.render_metrics, on_update=pool.dispatch)
+        logger.info(f"🌐 Webhook {WEBHOOK_URL}{WEBHOOK_PATH} на порту {port}, воркерів: {WEBHOOK_WORKERS}")
+        print(f"🌐 Webhook-режим на порту {port}, воркерів: {WEBHOOK_WORKERS}")
+        asyncio.run(set_webhook())
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("🛑 Зупинка webhook-режиму")
+    finally:
+        pool.stop()
+
 def main():
     try:
         os.environ["DB_NAME"] = DB_NAME
@@ -5131,35 +5064,7 @@ def main():
         logger.info(f"🔑 TOKEN: {TOKEN[:20]}...")
         logger.info(f"💾 БД: {DB_NAME}")
         
-        init_db()
-        init_lessons_table()
-        init_students_table()
-        migrate_database()
-        init_schedule_blocks_table()
-        
-        ensure_instructors_exist()
-
-        from telegram.ext import JobQueue
-        app = (
-            ApplicationBuilder()
-            .token(TOKEN)
-            .build()
-        )
-
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("register490", register_490))
-        app.add_handler(CommandHandler("register590", register_590))
-        
-        app.add_handler(CallbackQueryHandler(handle_callback))
-        app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message))
-        app.add_handler(MessageHandler(filters.CONTACT, handle_message))
-
-        if app.job_queue:
-            app.job_queue.run_repeating(send_reminders, interval=1800, first=10)
-            app.job_queue.run_repeating(check_completed_lessons, interval=900, first=60)
-            logger.info("✅ Job queue налаштовано")
-        else:
-            logger.warning("⚠️ Job queue недоступна - нагадування вимкнено")
+        init_storage()
 
         logger.info("🚀 Бот запущено!")
         print("🚀 Бот запущено і слухає...")
@@ -5167,27 +5072,20 @@ def main():
         print(f"   490 грн: https://t.me/InstructorIFBot?start=register490")
         print(f"   590 грн: https://t.me/InstructorIFBot?start=register590")
         
-        import threading
-        from http.server import HTTPServer, BaseHTTPRequestHandler
-        
-        class HealthCheckHandler(BaseHTTPRequestHandler):
-            def do_GET(self):
-                self.send_response(200)
-                self.send_header('Content-type', 'text/plain')
-                self.end_headers()
-                self.wfile.write(b'Bot is running!')
-            
-            def log_message(self, format, *args):
-                pass
-        
         port = int(os.environ.get('PORT', 8080))
-        server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
-        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
-        server_thread.start()
-        logger.info(f"🌐 HTTP сервер запущено на порту {port}")
-        print(f"🌐 HTTP сервер запущено на порту {port}")
-        
-        app.run_polling(drop_pending_updates=True, stop_signals=None)
+        if WEBHOOK_URL:
+            run_webhook(port)
+        else:
+            app = build_application()
+            start_health_server(port)
+            logger.info(f"🌐 HTTP сервер запущено на порту {port}")
+            print(f"🌐 HTTP сервер запущено на порту {port}")
+            
+            # SIGINT/SIGTERM зупиняють polling штатно: стан і черга записів зберігаються до виходу
+            app.run_polling(drop_pending_updates=True)
+            shutdown_db_executor()
+        # Перед зупинкою переносимо WAL у файл БД на persistent disk
+        checkpoint_wal("TRUNCATE")
     
     except Exception as e:
         logger.error(f"Critical error: {e}", exc_info=True)
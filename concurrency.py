@@ -0,0 +1,72 @@
+# concurrency.py - Паралельна обробка оновлень різних користувачів
+#
+# За замовчуванням PTB обробляє оновлення по одному: експорт Excel адміна
+# затримує натискання кнопок усіх учнів. PerUserUpdateProcessor пускає оновлення
+# різних користувачів паралельно, а оновлення одного користувача — строго по
+# черзі, через asyncio.Lock на user_id. Тож переходи стану в user_data
+# (handle_message → save_lesson) одного учня не перетинаються.
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Не більше max_concurrent_updates оновлень одночасно, для одного користувача — по одному.
+
+    Замки створюються на час, поки в користувача є оновлення в обробці або в
+    очікуванні, тож словник не росте з кількістю користувачів. asyncio.Lock
+    будить очікувачів у порядку надходження: порядок оновлень користувача зберігається.
+
+    Спершу замок користувача, потім слот: базовий process_update бере слот ще до
+    do_process_update, і черга оновлень одного учня займала б усі слоти, а інші
+    користувачі чекали б на неї.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # {ключ: [замок, кількість оновлень, що його тримають або чекають]}
+        self._locks = {}
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+
+    @staticmethod
+    def update_key(update):
+        """user_id, для оновлень без користувача — chat_id; None — без серіалізації"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    async def process_update(self, update, coroutine):
+        key = self.update_key(update)
+        if key is None:
+            async with self._slots:
+                await self.do_process_update(update, coroutine)
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await self.do_process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        # Замок користувача і слот уже взяв process_update
+        await coroutine
+
+    def waiting(self):
+        """Оновлення, що чекають на замок свого користувача"""
+        return sum(count - 1 for _, count in self._locks.values())
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -2,7 +2,10 @@
 import sqlite3
 import logging
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +42,29 @@ def normalize_date(date_str):
         except ValueError:
             return None
 
+def lesson_starts_at(date_str, time_str):
+    """Початок уроку 'YYYY-MM-DD HH:MM' за місцевим часом (ключ черги завершення)"""
+    try:
+        date_iso = normalize_date(date_str)
+        start_time = datetime.strptime(time_str, '%H:%M').strftime('%H:%M')
+    except (TypeError, ValueError):
+        return None
+    return f"{date_iso} {start_time}" if date_iso else None
+
+def duration_to_minutes(duration_str):
+    """Тривалість уроку в хвилинах з підпису кнопки ('1 година', '1.5 години', '2 години')"""
+    duration_str = str(duration_str or '')
+    if "1.5" in duration_str:
+        return 90
+    if "2" in duration_str:
+        return 120
+    return 60
+
+def minutes_to_hours(minutes):
+    """Хвилини → години; цілі години як int, щоб у текстах було '2г', а не '2.0г'"""
+    minutes = minutes or 0
+    return minutes // 60 if minutes % 60 == 0 else minutes / 60
+
 # ======================= ПІДКЛЮЧЕННЯ =======================
 # Імпортуємо DB_NAME з environment або використовуємо за замовчуванням
 import os
@@ -48,10 +74,122 @@ DB_NAME = os.getenv("DB_NAME", "driving_school.db")
 if os.path.exists("/var/data") and not DB_NAME.startswith("/var/data"):
     DB_NAME = f"/var/data/{os.path.basename(DB_NAME)}"
 
+import threading
+
+# Прагми виконуються один раз — при створенні з'єднання в пулі
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA mmap_size=67108864",
+    # Після checkpoint файл -wal обрізається до цього розміру
+    "PRAGMA journal_size_limit=67108864",
+)
+POOL_SIZE = 4
+
+# ======================= ЖУРНАЛ (WAL) =======================
+# У WAL читачі не чекають на записувача (BEGIN IMMEDIATE у save_lesson), а
+# записувач — на читачів. WAL потребує спільної пам'яті (-shm); якщо файлова
+# система її не підтримує, пул переходить на звичайний журнал відкату.
+# DB_JOURNAL_MODE=truncate|delete — примусово без WAL (для порівняння в benchmark.py wal).
+JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "wal").lower()
+FALLBACK_JOURNAL_MODE = "truncate"
+# Як часто (с) job робить checkpoint і від якого розміру -wal (байт) обрізає його
+WAL_CHECKPOINT_INTERVAL = int(os.getenv("WAL_CHECKPOINT_INTERVAL", "300"))
+WAL_TRUNCATE_BYTES = int(os.getenv("WAL_TRUNCATE_MB", "32")) * 1024 * 1024
+
+def set_journal_mode(conn, mode):
+    """Увімкнути режим журналу на з'єднанні; повертає фактичний режим.
+
+    Без підтримки -shm SQLite не вмикає WAL (повертає старий режим) або, якщо
+    файл уже в WAL, не може його прочитати — в обох випадках вмикається
+    FALLBACK_JOURNAL_MODE.
+    """
+    try:
+        actual = conn.execute(f"PRAGMA journal_mode={mode}").fetchone()[0]
+        # Перше читання відкриває WAL-індекс у -shm
+        conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        if actual == mode:
+            return actual
+        logger.warning(f"⚠️ Режим журналу {mode} недоступний (SQLite залишив {actual})")
+    except sqlite3.OperationalError as e:
+        logger.warning(f"⚠️ Режим журналу {mode} недоступний: {e}")
+    
+    # Монопольне блокування дозволяє відкрити WAL без -shm і вийти з нього
+    conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+    actual = conn.execute(f"PRAGMA journal_mode={FALLBACK_JOURNAL_MODE}").fetchone()[0]
+    conn.execute("PRAGMA locking_mode=NORMAL")
+    conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    logger.warning(f"⚠️ БД працює з журналом {actual}: читачі чекатимуть на записи")
+    return actual
+
+class ConnectionPool:
+    """Невеликий пул довгоживучих з'єднань SQLite.
+
+    З'єднання створюються з check_same_thread=False і видаються в монопольне
+    користування на час одного `with get_db()`, тож їх можна безпечно
+    використовувати як з event loop, так і з робочих потоків.
+    MeteredConnection рахує запити й прочитані рядки для /metrics.
+    """
+
+    def __init__(self, db_name, size=POOL_SIZE):
+        self.db_name = db_name
+        self.size = size
+        # Режим, з яким відкрилось перше з'єднання; наступні не пробують WAL повторно
+        self.journal_mode = None
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_name, check_same_thread=False, factory=metrics.MeteredConnection)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        mode = set_journal_mode(conn, self.journal_mode or JOURNAL_MODE)
+        if self.journal_mode is None:
+            self.journal_mode = mode
+            logger.info(f"💾 Режим журналу SQLite: {mode}")
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, conn):
+        # Незакомічена транзакція відкочується — так само, як раніше при conn.close()
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Пул для поточного DB_NAME (bot.py підміняє DB_NAME після імпорту)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_name != DB_NAME:
+            if _pool is not None:
+                _pool.close_all()
+            _pool = ConnectionPool(DB_NAME)
+        return _pool
+
 @contextmanager
 def get_db():
     """Context manager для безпечної роботи з БД"""
-    conn = sqlite3.connect(DB_NAME)
+    pool = get_pool()
+    conn = pool.acquire()
     try:
         yield conn
     except Exception as e:
@@ -59,9 +197,251 @@ def get_db():
         logger.error(f"Database error: {e}")
         raise
     finally:
-        conn.close()
+        pool.release(conn)
+
+def get_wal_size():
+    """Розмір файлу -wal у байтах (0 — немає файлу або не WAL)"""
+    try:
+        return os.path.getsize(f"{DB_NAME}-wal")
+    except OSError:
+        return 0
+
+def checkpoint_wal(mode="PASSIVE"):
+    """Перенести сторінки з -wal у файл БД.
+
+    PASSIVE не чекає на читачів і записувачів; TRUNCATE дочікується їх (busy_timeout)
+    і обрізає -wal до нуля. Повертає (busy, кадрів у WAL, перенесено кадрів) або None.
+    """
+    if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        logger.error(f"Помилка checkpoint_wal: невідомий режим {mode}")
+        return None
+    if get_pool().journal_mode not in (None, "wal"):
+        return None
+    try:
+        with get_db() as conn:
+            return conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    except Exception as e:
+        logger.error(f"Помилка checkpoint_wal: {e}")
+        return None
+
+metrics.register_gauge("bot_sqlite_wal_bytes", "Розмір файлу -wal, байт", get_wal_size)
+metrics.register_gauge("bot_sqlite_wal_enabled", "1 — БД у режимі WAL, 0 — журнал відкату",
+                       lambda: int(get_pool().journal_mode == "wal"))
+
+def fetch_all(sql, params=()):
+    """Усі рядки одного SELECT (помилка БД піднімається далі, як у `with get_db()`)"""
+    with get_db() as conn:
+        return conn.execute(sql, params).fetchall()
+
+def fetch_one(sql, params=()):
+    """Перший рядок одного SELECT або None"""
+    with get_db() as conn:
+        return conn.execute(sql, params).fetchone()
+
+def execute_write(sql, params=()):
+    """Один INSERT/UPDATE/DELETE з комітом; повертає кількість змінених рядків"""
+    with get_db() as conn:
+        rowcount = conn.execute(sql, params).rowcount
+        conn.commit()
+        return rowcount
+
+# ======================= ВИКОНАВЕЦЬ ЗАПИТІВ =======================
+# Запити sqlite3 блокують потік, що їх викликав. Обробники бота виконують їх у
+# власному пулі потоків (по потоку на з'єднання пулу), а event loop тим часом
+# обслуговує інші оновлення та jobs. DB_OFFLOAD=0 — виконання прямо в циклі,
+# як раніше (для порівняння затримок: python benchmark.py latency).
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+DB_OFFLOAD = os.getenv("DB_OFFLOAD", "1") != "0"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_db_executor():
+    """Пул потоків для запитів; розмір збігається з пулом з'єднань"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="db")
+        return _executor
+
+def shutdown_db_executor():
+    """Дочекатись запитів, що виконуються, і зупинити пул потоків"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+async def run_db(func, *args, **kwargs):
+    """Виконати синхронну функцію роботи з БД, не блокуючи event loop"""
+    if not DB_OFFLOAD:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    # Контекст (поточний замір metrics) переноситься в робочий потік, як в asyncio.to_thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_db_executor(), partial(context.run, func, *args, **kwargs))
+
+class AsyncDatabase:
+    """Awaitable-версії функцій модуля: `await aio.get_student_by_telegram_id(tg_id)`"""
+
+    def __getattr__(self, name):
+        func = globals().get(name)
+        if name.startswith("_") or not callable(func):
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            return await run_db(func, *args, **kwargs)
+
+        call.__name__ = call.__qualname__ = name
+        call.__doc__ = func.__doc__
+        setattr(self, name, call)
+        return call
+
+aio = AsyncDatabase()
 
 # ======================= ІНІЦІАЛІЗАЦІЯ =======================
+# Складені індекси під гарячі запити: (інструктор|учень, дата, статус),
+# вибірка нагадувань та перевірка блокувань інструктора на дату
+LESSONS_INDEXES = {
+    'idx_lessons_instructor_date_status': 'lessons(instructor_id, date_iso, status)',
+    'idx_lessons_student_date_status': 'lessons(student_telegram_id, date_iso, status)',
+    'idx_lessons_status_reminder': 'lessons(status, reminder_24h_sent)',
+    # Покривний для звіту адміна за період: діапазон дат без звернень до рядків таблиці
+    'idx_lessons_date_minutes': 'lessons(date_iso, instructor_id, status, duration_minutes, rating)',
+    'idx_lessons_status_starts_at': 'lessons(status, starts_at)',
+}
+SCHEDULE_BLOCKS_INDEXES = {
+    'idx_schedule_blocks_instructor_date_time': 'schedule_blocks(instructor_id, date, time_start)',
+}
+# Старі одноколонкові індекси — покриваються префіксами складених
+OBSOLETE_INDEXES = (
+    'idx_lessons_instructor',
+    'idx_lessons_date',
+    'idx_lessons_student',
+    'idx_lessons_status',
+    'idx_schedule_blocks_instructor',
+    'idx_schedule_blocks_date',
+    'idx_lessons_date_iso',
+    'idx_lessons_date_report',
+)
+
+# Агрегати оцінок у instructors (rating_sum, rating_count) підтримують тригери —
+# так їх не оминає жоден шлях запису lessons.rating (бот, адмінка, update_lesson)
+RATING_TRIGGERS = {
+    'trg_lessons_rating_insert': """
+        AFTER INSERT ON lessons WHEN NEW.rating IS NOT NULL
+        BEGIN
+            UPDATE instructors SET rating_sum = rating_sum + NEW.rating, rating_count = rating_count + 1
+            WHERE id = NEW.instructor_id;
+        END
+    """,
+    'trg_lessons_rating_delete': """
+        AFTER DELETE ON lessons WHEN OLD.rating IS NOT NULL
+        BEGIN
+            UPDATE instructors SET rating_sum = rating_sum - OLD.rating, rating_count = rating_count - 1
+            WHERE id = OLD.instructor_id;
+        END
+    """,
+    'trg_lessons_rating_update': """
+        AFTER UPDATE OF rating, instructor_id ON lessons
+        WHEN OLD.rating IS NOT NEW.rating OR OLD.instructor_id IS NOT NEW.instructor_id
+        BEGIN
+            UPDATE instructors SET rating_sum = rating_sum - OLD.rating, rating_count = rating_count - 1
+            WHERE id = OLD.instructor_id AND OLD.rating IS NOT NULL;
+            UPDATE instructors SET rating_sum = rating_sum + NEW.rating, rating_count = rating_count + 1
+            WHERE id = NEW.instructor_id AND NEW.rating IS NOT NULL;
+        END
+    """,
+}
+
+# Робочі години: погодинні клітинки WORK_HOURS_START..WORK_HOURS_END-1
+WORK_HOURS_START = 8
+WORK_HOURS_END = 18
+
+# Зайнятість інструктора по днях: біт i у busy_mask — година WORK_HOURS_START + i
+# зайнята активним уроком або блокуванням. Рядок перераховують тригери на lessons
+# і schedule_blocks, тож маска не розходиться з розкладом за жодного шляху запису.
+# Дня без рядка в таблиці немає — він повністю вільний.
+def _availability_refresh_sql(instructor_id, date_iso):
+    """Перерахунок маски одного дня (для тіла тригера: аргументи — NEW.x / OLD.x)"""
+    hours = " UNION ALL ".join(f"SELECT {hour} AS hour" for hour in range(WORK_HOURS_START, WORK_HOURS_END))
+    lesson_hour = "CAST(substr(l.time, 1, instr(l.time, ':') - 1) AS INTEGER)"
+    return f"""
+            INSERT INTO instructor_availability (instructor_id, date_iso, busy_mask)
+            SELECT {instructor_id}, {date_iso}, (
+                SELECT COALESCE(SUM(1 << (h.hour - {WORK_HOURS_START})), 0)
+                FROM ({hours}) h
+                WHERE EXISTS (
+                    SELECT 1 FROM lessons l
+                    WHERE l.instructor_id = {instructor_id} AND l.date_iso = {date_iso} AND l.status = 'active'
+                    AND instr(l.time, ':') > 0
+                    AND h.hour >= {lesson_hour} AND h.hour < {lesson_hour} + (l.duration_minutes + 59) / 60
+                ) OR EXISTS (
+                    SELECT 1 FROM schedule_blocks b
+                    WHERE b.instructor_id = {instructor_id} AND b.date = {date_iso}
+                    AND b.time_start <= printf('%02d:00', h.hour) AND printf('%02d:00', h.hour) < b.time_end
+                )
+            )
+            WHERE {instructor_id} IS NOT NULL AND {date_iso} IS NOT NULL
+            ON CONFLICT (instructor_id, date_iso) DO UPDATE SET busy_mask = excluded.busy_mask;"""
+
+AVAILABILITY_TRIGGERS = {
+    'trg_lessons_availability_insert': f"""
+        AFTER INSERT ON lessons WHEN NEW.status = 'active'
+        BEGIN{_availability_refresh_sql('NEW.instructor_id', 'NEW.date_iso')}
+        END
+    """,
+    'trg_lessons_availability_delete': f"""
+        AFTER DELETE ON lessons WHEN OLD.status = 'active'
+        BEGIN{_availability_refresh_sql('OLD.instructor_id', 'OLD.date_iso')}
+        END
+    """,
+    'trg_lessons_availability_update': f"""
+        AFTER UPDATE OF status, instructor_id, date_iso, time, duration_minutes ON lessons
+        WHEN (OLD.status = 'active' OR NEW.status = 'active')
+        AND (OLD.status IS NOT NEW.status OR OLD.instructor_id IS NOT NEW.instructor_id
+             OR OLD.date_iso IS NOT NEW.date_iso OR OLD.time IS NOT NEW.time
+             OR OLD.duration_minutes IS NOT NEW.duration_minutes)
+        BEGIN
+            {_availability_refresh_sql('OLD.instructor_id', 'OLD.date_iso').strip()}
+            {_availability_refresh_sql('NEW.instructor_id', 'NEW.date_iso').strip()}
+        END
+    """,
+    'trg_schedule_blocks_availability_insert': f"""
+        AFTER INSERT ON schedule_blocks
+        BEGIN{_availability_refresh_sql('NEW.instructor_id', 'NEW.date')}
+        END
+    """,
+    'trg_schedule_blocks_availability_delete': f"""
+        AFTER DELETE ON schedule_blocks
+        BEGIN{_availability_refresh_sql('OLD.instructor_id', 'OLD.date')}
+        END
+    """,
+    'trg_schedule_blocks_availability_update': f"""
+        AFTER UPDATE OF instructor_id, date, time_start, time_end ON schedule_blocks
+        BEGIN
+            {_availability_refresh_sql('OLD.instructor_id', 'OLD.date').strip()}
+            {_availability_refresh_sql('NEW.instructor_id', 'NEW.date').strip()}
+        END
+    """,
+}
+
+def create_indexes(cursor, indexes):
+    """Створити індекси; на старій схемі без потрібних колонок їх добудує migrate_database"""
+    for name, target in indexes.items():
+        try:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+        except sqlite3.OperationalError as e:
+            logger.debug(f"Індекс {name} поки не створено: {e}")
+
+def drop_obsolete_indexes(cursor):
+    for name in OBSOLETE_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
 def init_db():
     """Створення таблиці інструкторів"""
     try:
@@ -76,6 +456,8 @@ def init_db():
                     phone TEXT,
                     price_per_hour INTEGER DEFAULT 400,
                     is_active INTEGER DEFAULT 1,
+                    rating_sum INTEGER NOT NULL DEFAULT 0,
+                    rating_count INTEGER NOT NULL DEFAULT 0,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
@@ -99,8 +481,11 @@ def init_lessons_table():
                     student_phone TEXT,
                     student_tariff INTEGER DEFAULT 0,
                     date TEXT NOT NULL,
+                    date_iso TEXT,
                     time TEXT NOT NULL,
+                    starts_at TEXT,
                     duration TEXT NOT NULL,
+                    duration_minutes INTEGER,
                     status TEXT DEFAULT 'active',
                     rating INTEGER,
                     feedback TEXT,
@@ -115,22 +500,7 @@ def init_lessons_table():
             """)
             
             # Індекси для швидкодії
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_lessons_instructor 
-                ON lessons(instructor_id)
-            """)
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_lessons_date 
-                ON lessons(date)
-            """)
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_lessons_student 
-                ON lessons(student_telegram_id)
-            """)
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_lessons_status 
-                ON lessons(status)
-            """)
+            create_indexes(cursor, LESSONS_INDEXES)
             
             conn.commit()
         logger.info("✅ Таблиця lessons готова")
@@ -157,15 +527,7 @@ def init_schedule_blocks_table():
                 )
             """)
             
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_schedule_blocks_instructor 
-                ON schedule_blocks(instructor_id)
-            """)
-            
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_schedule_blocks_date 
-                ON schedule_blocks(date)
-            """)
+            create_indexes(cursor, SCHEDULE_BLOCKS_INDEXES)
             
             conn.commit()
         logger.info("✅ Таблиця schedule_blocks готова")
@@ -201,6 +563,54 @@ def init_students_table():
         logger.error(f"Помилка init_students_table: {e}")
         raise
 
+def init_persistence_table():
+    """Таблиця стану розмов (user_data/bot_data) для SQLitePersistence"""
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS conversation_state (
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (kind, key)
+                ) WITHOUT ROWID
+            """)
+            # Стару таблицю user_sessions (blocks_map для розблокування) замінила conversation_state
+            cursor.execute("DROP TABLE IF EXISTS user_sessions")
+            conn.commit()
+        logger.info("✅ Таблиця conversation_state готова")
+    except Exception as e:
+        logger.error(f"Помилка init_persistence_table: {e}")
+        raise
+
+def init_availability_table():
+    """Маски зайнятих годин інструкторів по днях і тригери, що їх підтримують"""
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'instructor_availability'")
+            created = cursor.fetchone() is None
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS instructor_availability (
+                    instructor_id INTEGER NOT NULL,
+                    date_iso TEXT NOT NULL,
+                    busy_mask INTEGER NOT NULL,
+                    PRIMARY KEY (instructor_id, date_iso)
+                ) WITHOUT ROWID
+            """)
+            for name, body in AVAILABILITY_TRIGGERS.items():
+                cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+            # На існуючій БД маски заповнюються з розкладу один раз
+            if created:
+                _rebuild_instructor_availability(cursor)
+            conn.commit()
+        logger.info("✅ Таблиця instructor_availability готова")
+    except Exception as e:
+        logger.error(f"Помилка init_availability_table: {e}")
+        raise
+
 def migrate_database():
     """Додавання нових полів до існуючої БД"""
     try:
@@ -227,7 +637,10 @@ def migrate_database():
                 'completed_at': 'TIMESTAMP',
                 'instructor_rating': 'INTEGER',      # Оцінка інструктора для учня
                 'instructor_feedback': 'TEXT',       # Коментар інструктора про учня
-                'booking_comment': 'TEXT'            # Коментар учня при записі
+                'booking_comment': 'TEXT',           # Коментар учня при записі
+                'date_iso': 'TEXT',                  # Дата уроку у форматі YYYY-MM-DD
+                'starts_at': 'TEXT',                 # Початок уроку 'YYYY-MM-DD HH:MM'
+                'duration_minutes': 'INTEGER'        # Тривалість у хвилинах (з duration)
             }
             
             for col, col_type in new_cols.items():
@@ -240,6 +653,44 @@ def migrate_database():
             
             # Оновлюємо старі записи
             cursor.execute("UPDATE lessons SET status = 'active' WHERE status IS NULL")
+
+            # date_iso для записів, створених до появи колонки
+            cursor.execute("SELECT id, date FROM lessons WHERE date_iso IS NULL")
+            backfill = [(normalize_date(date), lesson_id) for lesson_id, date in cursor.fetchall()]
+            if backfill:
+                cursor.executemany("UPDATE lessons SET date_iso = ? WHERE id = ?", backfill)
+                logger.info(f"✅ Заповнено date_iso для {len(backfill)} уроків")
+
+            cursor.execute("SELECT id, date, time FROM lessons WHERE starts_at IS NULL")
+            backfill = [(lesson_starts_at(date, time), lesson_id) for lesson_id, date, time in cursor.fetchall()]
+            if backfill:
+                cursor.executemany("UPDATE lessons SET starts_at = ? WHERE id = ?", backfill)
+                logger.info(f"✅ Заповнено starts_at для {len(backfill)} уроків")
+
+            cursor.execute("SELECT id, duration FROM lessons WHERE duration_minutes IS NULL")
+            backfill = [(duration_to_minutes(duration), lesson_id) for lesson_id, duration in cursor.fetchall()]
+            if backfill:
+                cursor.executemany("UPDATE lessons SET duration_minutes = ? WHERE id = ?", backfill)
+                logger.info(f"✅ Заповнено duration_minutes для {len(backfill)} уроків")
+
+            # Складені індекси, які init_lessons_table не змогла створити на старій схемі
+            create_indexes(cursor, LESSONS_INDEXES)
+            drop_obsolete_indexes(cursor)
+
+            # Агрегати оцінок інструкторів: на старій БД колонки додаються і заповнюються один раз
+            cursor.execute("PRAGMA table_info(instructors)")
+            instructor_cols = {row[1] for row in cursor.fetchall()}
+            added_rating_cols = False
+            for col in ('rating_sum', 'rating_count'):
+                if col not in instructor_cols:
+                    cursor.execute(f"ALTER TABLE instructors ADD COLUMN {col} INTEGER NOT NULL DEFAULT 0")
+                    logger.info(f"✅ Додано поле instructors.{col}")
+                    added_rating_cols = True
+            for name, body in RATING_TRIGGERS.items():
+                cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+            if added_rating_cols:
+                _rebuild_instructor_ratings(cursor)
+
             conn.commit()
             
         logger.info("✅ Міграція БД завершена")
@@ -247,79 +698,165 @@ def migrate_database():
         logger.error(f"Помилка migrate_database: {e}")
 
 # ======================= ЗАПИТИ - ІНСТРУКТОРИ =======================
+class InstructorDirectory:
+    """Знімок таблиці instructors в пам'яті (read-through кеш).
+
+    Інструкторів близько десятка і змінюються вони лише через
+    ensure_instructors_exist, тому таблиця читається одним запитом при першому
+    зверненні і тримається до invalidate_instructor_cache().
+    """
+
+    def __init__(self, db_name, rows):
+        self.db_name = db_name
+        self.all = [(inst_id, name, transmission, telegram_id)
+                    for inst_id, name, transmission, telegram_id, _ in sorted(rows, key=lambda r: r[1])]
+        self.active = [(inst_id, name) for inst_id, name, _, _, is_active in sorted(rows, key=lambda r: r[1])
+                       if is_active]
+        self.by_id = {inst_id: (name, telegram_id) for inst_id, name, _, telegram_id, _ in rows}
+        self.by_name = {}
+        self.by_telegram_id = {}
+        by_transmission = {}
+        # Рядки йдуть за id — як і раніше, при дублікатах імені береться перший
+        for inst_id, name, transmission, telegram_id, _ in rows:
+            self.by_name.setdefault(name, (inst_id, telegram_id))
+            if telegram_id is not None:
+                self.by_telegram_id.setdefault(telegram_id, (inst_id, name))
+            by_transmission.setdefault(transmission, set()).add(name)
+        self.by_transmission = {t: sorted(names) for t, names in by_transmission.items()}
+
+_instructor_directory = None
+_instructor_directory_lock = threading.Lock()
+INSTRUCTOR_CACHE_STATS = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+def get_instructor_directory():
+    """Довідник інструкторів для поточного DB_NAME; None якщо БД недоступна"""
+    global _instructor_directory
+    directory = _instructor_directory
+    if directory is not None and directory.db_name == DB_NAME:
+        INSTRUCTOR_CACHE_STATS['hits'] += 1
+        return directory
+
+    with _instructor_directory_lock:
+        directory = _instructor_directory
+        if directory is not None and directory.db_name == DB_NAME:
+            INSTRUCTOR_CACHE_STATS['hits'] += 1
+            return directory
+
+        INSTRUCTOR_CACHE_STATS['misses'] += 1
+        try:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, name, transmission_type, telegram_id, is_active
+                    FROM instructors
+                    ORDER BY id
+                """)
+                directory = InstructorDirectory(DB_NAME, cursor.fetchall())
+        except Exception as e:
+            logger.error(f"Помилка get_instructor_directory: {e}")
+            return None
+
+        _instructor_directory = directory
+        return directory
+
+def invalidate_instructor_cache():
+    """Викликати після кожного запису в таблицю instructors (агрегатів оцінок у знімку немає)"""
+    global _instructor_directory
+    with _instructor_directory_lock:
+        _instructor_directory = None
+        INSTRUCTOR_CACHE_STATS['invalidations'] += 1
+
 def get_instructors_by_transmission(transmission_type):
     """Отримати інструкторів за типом коробки"""
-    try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT DISTINCT name FROM instructors WHERE transmission_type = ? ORDER BY name",
-                (transmission_type,)
-            )
-            return [row[0] for row in cursor.fetchall()]
-    except Exception as e:
-        logger.error(f"Помилка get_instructors_by_transmission: {e}")
+    directory = get_instructor_directory()
+    if directory is None:
         return []
+    return list(directory.by_transmission.get(transmission_type, []))
 
 def get_instructor_by_name(name):
     """Отримати ID та telegram_id інструктора"""
-    try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, telegram_id FROM instructors WHERE name = ?",
-                (name,)
-            )
-            return cursor.fetchone()
-    except Exception as e:
-        logger.error(f"Помилка get_instructor_by_name: {e}")
-        return None
+    directory = get_instructor_directory()
+    return directory.by_name.get(name) if directory else None
 
 def get_instructor_by_telegram_id(telegram_id):
     """Отримати дані інструктора за telegram_id"""
-    try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, name FROM instructors WHERE telegram_id = ?",
-                (telegram_id,)
-            )
-            return cursor.fetchone()
-    except Exception as e:
-        logger.error(f"Помилка get_instructor_by_telegram_id: {e}")
-        return None
+    directory = get_instructor_directory()
+    return directory.by_telegram_id.get(telegram_id) if directory else None
+
+def get_instructor_by_id(instructor_id):
+    """Отримати name та telegram_id інструктора за id"""
+    directory = get_instructor_directory()
+    return directory.by_id.get(instructor_id) if directory else None
 
 def get_instructor_rating(instructor_name):
     """Отримати середній рейтинг інструктора"""
+    return get_instructor_ratings([instructor_name]).get(instructor_name, 0)
+
+def get_instructor_ratings(instructor_names):
+    """Середні рейтинги {ім'я: рейтинг} одним запитом з агрегатів rating_sum/rating_count"""
+    names = list(instructor_names)
+    if not names:
+        return {}
     try:
         with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT AVG(rating)
-                FROM lessons l
-                JOIN instructors i ON l.instructor_id = i.id
-                WHERE i.name = ? AND l.rating IS NOT NULL
-            """, (instructor_name,))
-            result = cursor.fetchone()
-            return round(result[0], 1) if result and result[0] else 0
-    except Exception as e:
-        logger.error(f"Помилка get_instructor_rating: {e}")
-        return 0
+            placeholders = ",".join("?" * len(names))
+            cursor.execute(f"""
+                SELECT name, SUM(rating_sum), SUM(rating_count)
+                FROM instructors
+                WHERE name IN ({placeholders})
+                GROUP BY name
+            """, names)
+            ratings = {name: 0 for name in names}
+            for name, rating_sum, rating_count in cursor.fetchall():
+                if rating_count and rating_sum:
+                    ratings[name] = round(rating_sum / rating_count, 1)
+            return ratings
+    except Exception as e:
+        logger.error(f"Помилка get_instructor_ratings: {e}")
+        return {name: 0 for name in names}
 
-def get_all_instructors():
-    """НОВА: Отримати всіх інструкторів для звітності адміна"""
+def _rebuild_instructor_ratings(cursor):
+    """Перерахувати агрегати з lessons; повертає кількість інструкторів з розбіжністю"""
+    cursor.execute("SELECT id, rating_sum, rating_count FROM instructors")
+    before = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+    cursor.execute("""
+        UPDATE instructors
+        SET rating_sum = COALESCE((SELECT SUM(rating) FROM lessons
+                                   WHERE lessons.instructor_id = instructors.id AND rating IS NOT NULL), 0),
+            rating_count = (SELECT COUNT(rating) FROM lessons
+                            WHERE lessons.instructor_id = instructors.id)
+        RETURNING id, rating_sum, rating_count
+    """)
+    return sum(1 for row in cursor.fetchall() if before.get(row[0]) != tuple(row[1:]))
+
+def rebuild_instructor_ratings():
+    """Перебудувати rating_sum/rating_count з нуля (перевірка агрегатів).
+
+    Повертає кількість інструкторів, у яких збережений агрегат розходився
+    з lessons, або None при помилці.
+    """
     try:
         with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id, name, transmission_type, telegram_id
-                FROM instructors
-                ORDER BY name
-            """)
-            return cursor.fetchall()
+            drifted = _rebuild_instructor_ratings(cursor)
+            conn.commit()
+        if drifted:
+            logger.warning(f"⚠️ Агрегати оцінок розходились у {drifted} інструкторів — перебудовано")
+        return drifted
     except Exception as e:
-        logger.error(f"Помилка get_all_instructors: {e}")
-        return []
+        logger.error(f"Помилка rebuild_instructor_ratings: {e}")
+        return None
+
+def get_all_instructors():
+    """НОВА: Отримати всіх інструкторів для звітності адміна"""
+    directory = get_instructor_directory()
+    return list(directory.all) if directory else []
+
+def get_active_instructors():
+    """Активні інструктори (id, name) за алфавітом"""
+    directory = get_instructor_directory()
+    return list(directory.active) if directory else []
 
 # ======================= ЗАПИТИ - БЛОКУВАННЯ РОЗКЛАДУ =======================
 def add_schedule_block(instructor_id, date, time_start, time_end, block_type, reason=""):
@@ -396,6 +933,137 @@ def is_time_blocked(instructor_id, date, time_slot):
         logger.error(f"Помилка is_time_blocked: {e}")
         return False
 
+def get_instructor_busy_schedule(instructor_id, dates):
+    """Активні уроки та блокування інструктора на кілька дат за два запити.
+
+    dates — список об'єктів date. Повертає пару словників з ключами "РРРР-ММ-ДД":
+    booked {дата: [(time, duration_minutes), ...]} та blocks {дата: [(time_start, time_end), ...]},
+    або None при помилці.
+    """
+    if not dates:
+        return {}, {}
+
+    date_from = min(dates).strftime('%Y-%m-%d')
+    date_to = max(dates).strftime('%Y-%m-%d')
+
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT date_iso, time, duration_minutes FROM lessons
+                WHERE instructor_id = ? AND status = 'active'
+                AND date_iso BETWEEN ? AND ?
+            """, (instructor_id, date_from, date_to))
+            booked = {}
+            for date, time, minutes in cursor.fetchall():
+                booked.setdefault(date, []).append((time, minutes))
+
+            cursor.execute("""
+                SELECT date, time_start, time_end FROM schedule_blocks
+                WHERE instructor_id = ? AND date BETWEEN ? AND ?
+            """, (instructor_id, date_from, date_to))
+            blocks = {}
+            for date, time_start, time_end in cursor.fetchall():
+                blocks.setdefault(date, []).append((time_start, time_end))
+
+            return booked, blocks
+    except Exception as e:
+        logger.error(f"Помилка get_instructor_busy_schedule: {e}")
+        return None
+
+# ======================= ЗАПИТИ - ВІЛЬНІ ГОДИНИ =======================
+def availability_mask(booked, blocks):
+    """busy_mask одного дня з уроків [(time, duration_minutes)] і блокувань [(time_start, time_end)].
+
+    Те саме, що рахують тригери instructor_availability: урок 1.5 години займає
+    обидві погодинні клітинки, блокування — години, початок яких у [time_start, time_end).
+    """
+    mask = 0
+    for booked_time, minutes in booked:
+        if ':' not in booked_time:
+            continue
+        start_hour = int(booked_time.split(':')[0])
+        for hour in range(start_hour, start_hour - (-minutes // 60)):
+            if WORK_HOURS_START <= hour < WORK_HOURS_END:
+                mask |= 1 << (hour - WORK_HOURS_START)
+    for hour in range(WORK_HOURS_START, WORK_HOURS_END):
+        slot = f"{hour:02d}:00"
+        if any(time_start <= slot < time_end for time_start, time_end in blocks):
+            mask |= 1 << (hour - WORK_HOURS_START)
+    return mask
+
+def get_instructor_availability(instructor_id, dates):
+    """Маски зайнятих годин на кілька дат одним запитом: {"РРРР-ММ-ДД": busy_mask}.
+
+    Дат без рядка у словнику немає — вони повністю вільні. None при помилці.
+    """
+    availability = get_instructors_availability([instructor_id], dates)
+    return None if availability is None else availability.get(instructor_id, {})
+
+def get_instructors_availability(instructor_ids, dates):
+    """Маски кількох інструкторів на вікно дат одним запитом: {instructor_id: {"РРРР-ММ-ДД": busy_mask}}"""
+    ids = list(instructor_ids)
+    if not ids or not dates:
+        return {}
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            placeholders = ",".join("?" * len(ids))
+            cursor.execute(f"""
+                SELECT instructor_id, date_iso, busy_mask FROM instructor_availability
+                WHERE instructor_id IN ({placeholders}) AND date_iso BETWEEN ? AND ?
+            """, ids + [min(dates).strftime('%Y-%m-%d'), max(dates).strftime('%Y-%m-%d')])
+            availability = {instructor_id: {} for instructor_id in ids}
+            for instructor_id, date_iso, busy_mask in cursor.fetchall():
+                availability[instructor_id][date_iso] = busy_mask
+            return availability
+    except Exception as e:
+        logger.error(f"Помилка get_instructors_availability: {e}")
+        return None
+
+def _rebuild_instructor_availability(cursor):
+    """Перерахувати всі маски з lessons і schedule_blocks; повертає кількість днів, що розходились"""
+    cursor.execute("SELECT instructor_id, date_iso, busy_mask FROM instructor_availability")
+    before = {(instructor_id, date): mask for instructor_id, date, mask in cursor.fetchall()}
+
+    days = {}
+    cursor.execute("""
+        SELECT instructor_id, date_iso, time, duration_minutes FROM lessons
+        WHERE status = 'active' AND date_iso IS NOT NULL
+    """)
+    for instructor_id, date, time, minutes in cursor.fetchall():
+        days.setdefault((instructor_id, date), ([], []))[0].append((time, minutes))
+    cursor.execute("SELECT instructor_id, date, time_start, time_end FROM schedule_blocks")
+    for instructor_id, date, time_start, time_end in cursor.fetchall():
+        days.setdefault((instructor_id, date), ([], []))[1].append((time_start, time_end))
+    after = {key: availability_mask(booked, blocks) for key, (booked, blocks) in days.items()}
+
+    cursor.execute("DELETE FROM instructor_availability")
+    cursor.executemany(
+        "INSERT INTO instructor_availability (instructor_id, date_iso, busy_mask) VALUES (?, ?, ?)",
+        [(instructor_id, date, mask) for (instructor_id, date), mask in after.items() if mask]
+    )
+    # Рядок з нульовою маскою (усе скасовано) рівнозначний відсутньому
+    return sum(1 for key in before.keys() | after.keys() if before.get(key, 0) != after.get(key, 0))
+
+def rebuild_instructor_availability():
+    """Перебудувати instructor_availability з нуля (перевірка тригерів).
+
+    Повертає кількість днів, у яких збережена маска розходилась з розкладом,
+    або None при помилці.
+    """
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            drifted = _rebuild_instructor_availability(cursor)
+            conn.commit()
+        if drifted:
+            logger.warning(f"⚠️ Маски вільних годин розходились у {drifted} днях — перебудовано")
+        return drifted
+    except Exception as e:
+        logger.error(f"Помилка rebuild_instructor_availability: {e}")
+        return None
+
 # ======================= ЗАПИТИ - ЗАНЯТТЯ =======================
 def is_time_slot_available(instructor_id, date, start_time, duration):
     """Перевірка чи вільний часовий слот"""
@@ -403,9 +1071,9 @@ def is_time_slot_available(instructor_id, date, start_time, duration):
         with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT time, duration FROM lessons
-                WHERE instructor_id = ? AND date = ? AND status = 'active'
-            """, (instructor_id, date))
+                SELECT time, duration_minutes FROM lessons
+                WHERE instructor_id = ? AND date_iso = ? AND status = 'active'
+            """, (instructor_id, normalize_date(date)))
             booked = cursor.fetchall()
     except Exception as e:
         logger.error(f"Помилка is_time_slot_available: {e}")
@@ -416,22 +1084,14 @@ def is_time_slot_available(instructor_id, date, start_time, duration):
         h, m = map(int, time_str.split(':'))
         return h * 60 + m
     
-    def duration_to_minutes(dur_str):
-        """Конвертація тривалості в хвилини"""
-        if "1.5" in dur_str:
-            return 90
-        elif "2" in dur_str:
-            return 120
-        return 60
-    
     new_start = time_to_minutes(start_time)
     new_end = new_start + duration_to_minutes(duration)
     
-    for booked_time, booked_duration in booked:
+    for booked_time, booked_minutes in booked:
         if ':' not in booked_time:
             continue
         booked_start = time_to_minutes(booked_time)
-        booked_end = booked_start + duration_to_minutes(booked_duration)
+        booked_end = booked_start + booked_minutes
         
         # Якщо є перетин
         if not (new_end <= booked_start or new_start >= booked_end):
@@ -439,12 +1099,131 @@ def is_time_slot_available(instructor_id, date, start_time, duration):
     
     return True
 
+# Ліміти учня на запис
+DAILY_LIMIT_MINUTES = 2 * 60
+WEEKLY_LIMIT_MINUTES = 6 * 60
+
+BOOKING_OK = "ok"
+BOOKING_CONFLICT = "conflict"                # в учня вже є урок у цей час
+BOOKING_INSTRUCTOR_BUSY = "instructor_busy"  # інструктор зайнятий іншим учнем
+BOOKING_DAILY_LIMIT = "daily_limit"
+BOOKING_WEEKLY_LIMIT = "weekly_limit"
+
+class BookingResult:
+    """Результат try_book_lesson.
+
+    status — одна з констант BOOKING_*; lesson_id — id нового уроку (BOOKING_OK);
+    conflict — (ім'я інструктора або учня, time, duration) уроку, що перетинається;
+    booked_minutes — вже заброньовано учнем за день/тиждень (для лімітів);
+    lock_seconds — скільки транзакція тримала блокування запису.
+    """
+    __slots__ = ("status", "lesson_id", "conflict", "booked_minutes", "lock_seconds")
+
+    def __init__(self, status, lesson_id=None, conflict=None, booked_minutes=0):
+        self.status = status
+        self.lesson_id = lesson_id
+        self.conflict = conflict
+        self.booked_minutes = booked_minutes
+        self.lock_seconds = 0.0
+
+    @property
+    def ok(self):
+        return self.status == BOOKING_OK
+
+def _overlaps(start, end, time_str, minutes):
+    other_start = int(time_str.split(':')[0]) * 60
+    return not (end <= other_start or start >= other_start + minutes)
+
+def _check_booking(cursor, instructor_id, student_telegram_id, date_iso, start, end):
+    """Перевірки запису в межах транзакції; None — можна записувати"""
+    cursor.execute("""
+        SELECT i.name, l.time, l.duration, l.duration_minutes
+        FROM lessons l
+        JOIN instructors i ON l.instructor_id = i.id
+        WHERE l.student_telegram_id = ? AND l.date_iso = ? AND l.status = 'active'
+    """, (student_telegram_id, date_iso))
+    student_lessons = cursor.fetchall()
+    for instructor_name, time_str, duration, minutes in student_lessons:
+        if _overlaps(start, end, time_str, minutes):
+            return BookingResult(BOOKING_CONFLICT, conflict=(instructor_name, time_str, duration))
+    
+    minutes_today = sum(minutes for _, _, _, minutes in student_lessons)
+    if minutes_today + end - start > DAILY_LIMIT_MINUTES:
+        return BookingResult(BOOKING_DAILY_LIMIT, booked_minutes=minutes_today)
+    
+    day = datetime.strptime(date_iso, "%Y-%m-%d")
+    week_start = day - timedelta(days=day.weekday())
+    cursor.execute("""
+        SELECT SUM(duration_minutes)
+        FROM lessons
+        WHERE student_telegram_id = ? AND date_iso BETWEEN ? AND ? AND status = 'active'
+    """, (student_telegram_id, week_start.strftime("%Y-%m-%d"), (week_start + timedelta(days=6)).strftime("%Y-%m-%d")))
+    minutes_week = cursor.fetchone()[0] or 0
+    if minutes_week + end - start > WEEKLY_LIMIT_MINUTES:
+        return BookingResult(BOOKING_WEEKLY_LIMIT, booked_minutes=minutes_week)
+    
+    cursor.execute("""
+        SELECT student_name, student_telegram_id, time, duration, duration_minutes
+        FROM lessons
+        WHERE instructor_id = ? AND date_iso = ? AND status = 'active'
+    """, (instructor_id, date_iso))
+    for student_name, other_student_id, time_str, duration, minutes in cursor.fetchall():
+        if other_student_id != student_telegram_id and _overlaps(start, end, time_str, minutes):
+            return BookingResult(BOOKING_INSTRUCTOR_BUSY, conflict=(student_name, time_str, duration))
+    return None
+
+def try_book_lesson(instructor_id, student_name, student_telegram_id, student_phone, student_tariff,
+                    date, time, duration, booking_comment=""):
+    """Атомарно перевірити перетини й ліміти учня та записати урок.
+
+    Синхронна і без звернень до мережі: BEGIN IMMEDIATE тримається лише на час
+    трьох SELECT та INSERT, а повідомлення користувачу надсилаються після неї.
+    Повертає BookingResult або None при помилці БД.
+    """
+    date_iso = normalize_date(date)
+    start = int(time.split(':')[0]) * 60
+    minutes = duration_to_minutes(duration)
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            conn.execute("BEGIN IMMEDIATE")
+            locked_at = perf_counter()
+            result = _check_booking(cursor, instructor_id, student_telegram_id, date_iso, start, start + minutes)
+            if result is None:
+                cursor.execute("""
+                    INSERT INTO lessons
+                    (instructor_id, student_name, student_telegram_id, student_phone, student_tariff, date, date_iso,
+                     time, starts_at, duration, duration_minutes, status, booking_comment)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'active', ?)
+                """, (instructor_id, student_name, student_telegram_id, student_phone, student_tariff, date, date_iso,
+                      time, lesson_starts_at(date, time), duration, minutes, booking_comment))
+                result = BookingResult(BOOKING_OK, lesson_id=cursor.lastrowid)
+                conn.commit()
+            else:
+                conn.rollback()
+            result.lock_seconds = perf_counter() - locked_at
+            return result
+    except Exception as e:
+        logger.error(f"Помилка try_book_lesson: {e}")
+        return None
+
 def update_lesson(lesson_id, **kwargs):
     """НОВА: Оновити дані заняття (для коригування графіку)"""
     try:
         with get_db() as conn:
             cursor = conn.cursor()
             
+            # Перенесення на іншу дату/час оновлює і date_iso, starts_at
+            if 'date' in kwargs or 'time' in kwargs:
+                cursor.execute("SELECT date, time FROM lessons WHERE id = ?", (lesson_id,))
+                current = cursor.fetchone()
+                if current:
+                    new_date = kwargs.get('date', current[0])
+                    kwargs['date_iso'] = normalize_date(new_date)
+                    kwargs['starts_at'] = lesson_starts_at(new_date, kwargs.get('time', current[1]))
+            if 'duration' in kwargs:
+                kwargs['duration_minutes'] = duration_to_minutes(kwargs['duration'])
+            
             # Формуємо SQL запит динамічно
             set_clause = ", ".join([f"{key} = ?" for key in kwargs.keys()])
             values = list(kwargs.values()) + [lesson_id]
@@ -461,6 +1240,78 @@ def update_lesson(lesson_id, **kwargs):
         logger.error(f"Помилка update_lesson: {e}")
         return False
 
+REMINDER_FLAGS = ('reminder_24h_sent', 'reminder_2h_sent')
+FLAG_BATCH_SIZE = 500
+
+def mark_reminders_sent(flag, lesson_ids):
+    """Позначити нагадування надісланими — одна транзакція на весь пакет"""
+    if flag not in REMINDER_FLAGS:
+        logger.error(f"Помилка mark_reminders_sent: невідоме поле {flag}")
+        return False
+    lesson_ids = list(lesson_ids)
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            for i in range(0, len(lesson_ids), FLAG_BATCH_SIZE):
+                batch = lesson_ids[i:i + FLAG_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                cursor.execute(f"UPDATE lessons SET {flag} = 1 WHERE id IN ({placeholders})", batch)
+            conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"Помилка mark_reminders_sent: {e}")
+        return False
+
+def get_pending_reminders(flag, lesson_ids):
+    """Уроки пакета, яким ще треба надіслати нагадування (активні, з telegram_id учня)"""
+    if flag not in REMINDER_FLAGS:
+        logger.error(f"Помилка get_pending_reminders: невідоме поле {flag}")
+        return []
+    lesson_ids = list(lesson_ids)
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            lessons = []
+            for i in range(0, len(lesson_ids), FLAG_BATCH_SIZE):
+                batch = lesson_ids[i:i + FLAG_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                cursor.execute(f"""
+                    SELECT l.id, l.student_telegram_id, i.name, l.date, l.time
+                    FROM lessons l
+                    JOIN instructors i ON l.instructor_id = i.id
+                    WHERE l.id IN ({placeholders})
+                    AND l.status = 'active'
+                    AND l.{flag} = 0
+                    AND l.student_telegram_id IS NOT NULL
+                """, batch)
+                lessons.extend(cursor.fetchall())
+            return lessons
+    except Exception as e:
+        logger.error(f"Помилка get_pending_reminders: {e}")
+        return []
+
+def complete_started_lessons(now):
+    """Позначити завершеними активні уроки, що почались до now ('YYYY-MM-DD HH:MM').
+
+    Один UPDATE по індексу (status, starts_at); повертає
+    [(id, date, time, student_telegram_id, instructor_id), ...].
+    """
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE lessons
+                SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+                WHERE status = 'active' AND starts_at < ?
+                RETURNING id, date, time, student_telegram_id, instructor_id
+            """, (now,))
+            completed = cursor.fetchall()
+            conn.commit()
+            return completed
+    except Exception as e:
+        logger.error(f"Помилка complete_started_lessons: {e}")
+        return []
+
 def add_lesson_rating(lesson_id, rating, feedback=""):
     """НОВА: Додати оцінку після завершення уроку"""
     try:
@@ -479,32 +1330,31 @@ def add_lesson_rating(lesson_id, rating, feedback=""):
 
 # ======================= ЗАПИТИ - СТАТИСТИКА =======================
 def get_instructor_stats_period(instructor_id, date_from, date_to):
-    """НОВА: Статистика інструктора за період"""
+    """НОВА: Статистика інструктора за період (дати dd.mm.YYYY або YYYY-MM-DD)"""
+    date_from = normalize_date(date_from)
+    date_to = normalize_date(date_to)
     try:
         with get_db() as conn:
             cursor = conn.cursor()
             
             # Загальна кількість занять
             cursor.execute("""
-                SELECT COUNT(*), 
-                       SUM(CASE WHEN duration LIKE '%1.5%' THEN 1.5
-                                WHEN duration LIKE '%2%' THEN 2
-                                ELSE 1 END) as total_hours
+                SELECT COUNT(*), SUM(duration_minutes)
                 FROM lessons
                 WHERE instructor_id = ? 
-                  AND date BETWEEN ? AND ?
+                  AND date_iso BETWEEN ? AND ?
                   AND status IN ('active', 'completed')
             """, (instructor_id, date_from, date_to))
             
-            total_lessons, total_hours = cursor.fetchone()
-            total_hours = total_hours or 0
+            total_lessons, total_minutes = cursor.fetchone()
+            total_hours = minutes_to_hours(total_minutes)
             
             # Середній рейтинг
             cursor.execute("""
                 SELECT AVG(rating)
                 FROM lessons
                 WHERE instructor_id = ? 
-                  AND date BETWEEN ? AND ?
+                  AND date_iso BETWEEN ? AND ?
                   AND rating IS NOT NULL
             """, (instructor_id, date_from, date_to))
             
@@ -515,7 +1365,7 @@ def get_instructor_stats_period(instructor_id, date_from, date_to):
                 SELECT COUNT(*)
                 FROM lessons
                 WHERE instructor_id = ? 
-                  AND date BETWEEN ? AND ?
+                  AND date_iso BETWEEN ? AND ?
                   AND status = 'cancelled'
             """, (instructor_id, date_from, date_to))
             
@@ -535,60 +1385,40 @@ def get_instructor_stats_period(instructor_id, date_from, date_to):
         logger.error(f"Помилка get_instructor_stats_period: {e}")
         return None
 
-def _date_in_range(date_str, date_from, date_to):
-    """Перевіряє чи дата (dd.mm.YYYY або YYYY-MM-DD) входить в діапазон (YYYY-MM-DD)"""
-    try:
-        try:
-            d = datetime.strptime(date_str, '%d.%m.%Y').date()
-        except ValueError:
-            d = datetime.strptime(date_str, '%Y-%m-%d').date()
-        df = datetime.strptime(date_from, '%Y-%m-%d').date()
-        dt = datetime.strptime(date_to, '%Y-%m-%d').date()
-        return df <= d <= dt
-    except:
-        return False
-
 def get_admin_report_by_instructors(date_from, date_to):
-    """Звіт для адміна по всіх інструкторах за період"""
+    """Звіт для адміна по всіх інструкторах за період.
+
+    Один груповий запит по діапазону date_iso замість окремої вибірки на
+    кожного інструктора; години — SUM(duration_minutes).
+    """
     try:
         with get_db() as conn:
             cursor = conn.cursor()
-            # Отримуємо всіх інструкторів
-            cursor.execute("SELECT id, name FROM instructors ORDER BY name")
-            instructors = cursor.fetchall()
-            
-            result = []
-            for inst_id, inst_name in instructors:
-                # Отримуємо всі уроки інструктора
-                cursor.execute("""
-                    SELECT date, duration, status, rating
+            cursor.execute("""
+                SELECT i.name,
+                       COALESCE(s.total_lessons, 0),
+                       COALESCE(s.total_minutes, 0),
+                       COALESCE(s.avg_rating, 0),
+                       COALESCE(s.cancelled, 0)
+                FROM instructors i
+                LEFT JOIN (
+                    SELECT instructor_id,
+                           SUM(status != 'cancelled') AS total_lessons,
+                           SUM(CASE WHEN status != 'cancelled' THEN duration_minutes END) AS total_minutes,
+                           AVG(CASE WHEN rating THEN rating END) AS avg_rating,
+                           SUM(status = 'cancelled') AS cancelled
                     FROM lessons
-                    WHERE instructor_id = ?
-                    AND status IN ('active', 'completed', 'cancelled')
-                """, (inst_id,))
-                all_lessons = cursor.fetchall()
-                
-                # Фільтруємо по даті в Python
-                lessons_in_range = [l for l in all_lessons if _date_in_range(l[0], date_from, date_to)]
-                
-                total_lessons = len([l for l in lessons_in_range if l[2] != 'cancelled'])
-                cancelled = len([l for l in lessons_in_range if l[2] == 'cancelled'])
-                
-                total_hours = 0
-                ratings = []
-                for _, duration, status, rating in lessons_in_range:
-                    if status != 'cancelled':
-                        if duration and '1.5' in str(duration):
-                            total_hours += 1.5
-                        elif duration and '2' in str(duration):
-                            total_hours += 2
-                        else:
-                            total_hours += 1
-                    if rating:
-                        ratings.append(rating)
-                
-                avg_rating = sum(ratings) / len(ratings) if ratings else 0
-                result.append((inst_name, total_lessons, total_hours, avg_rating, cancelled))
+                    WHERE date_iso BETWEEN ? AND ?
+                    -- '+' не дає планувальнику взяти індекс за статусом: ці три статуси — майже вся таблиця
+                    AND +status IN ('active', 'completed', 'cancelled')
+                    GROUP BY instructor_id
+                ) s ON s.instructor_id = i.id
+                ORDER BY i.name
+            """, (date_from, date_to))
+            result = [
+                (name, total_lessons, minutes_to_hours(total_minutes), avg_rating, cancelled)
+                for name, total_lessons, total_minutes, avg_rating, cancelled in cursor.fetchall()
+            ]
             
             # Сортуємо по кількості годин
             result.sort(key=lambda x: x[2], reverse=True)
@@ -603,15 +1433,14 @@ def get_instructor_report(instructor_id, date_from, date_to):
         with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT date, time, duration, student_name, status, rating
+                SELECT date, time, duration_minutes, student_name, status, rating
                 FROM lessons
                 WHERE instructor_id = ?
+                AND date_iso BETWEEN ? AND ?
                 AND status IN ('active', 'completed', 'cancelled')
-                ORDER BY date, time
-            """, (instructor_id,))
-            all_lessons = cursor.fetchall()
-            
-            lessons_in_range = [l for l in all_lessons if _date_in_range(l[0], date_from, date_to)]
+                ORDER BY date_iso, time
+            """, (instructor_id, date_from, date_to))
+            lessons_in_range = cursor.fetchall()
             
             total_lessons = len([l for l in lessons_in_range if l[4] != 'cancelled'])
             cancelled = len([l for l in lessons_in_range if l[4] == 'cancelled'])
@@ -619,8 +1448,8 @@ def get_instructor_report(instructor_id, date_from, date_to):
             total_hours = 0
             ratings = []
             details = []
-            for date, time, duration, student_name, status, rating in lessons_in_range:
-                hours = 1.5 if duration and '1.5' in str(duration) else (2 if duration and '2' in str(duration) else 1)
+            for date, time, minutes, student_name, status, rating in lessons_in_range:
+                hours = minutes_to_hours(minutes)
                 if status != 'cancelled':
                     total_hours += hours
                 if rating:
@@ -721,3 +1550,54 @@ def add_instructor_rating(lesson_id, rating, feedback=""):
     except Exception as e:
         logger.error(f"Помилка add_instructor_rating: {e}")
         return False
+
+# ======================= ЗАПИТИ - СТАН РОЗМОВ =======================
+# Стан, що не оновлювався стільки днів, не відновлюється після рестарту
+CONVERSATION_STATE_TTL_DAYS = 30
+
+def load_conversation_state(kind, since=None):
+    """Збережені записи одного виду ('user', 'chat', 'bot'): {key: bytes}.
+
+    since — лише записи, оновлені не раніше цього часу (unix, с); без нього
+    повертаються всі, а застарілі видаляються.
+    """
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            if since is not None:
+                cursor.execute("""
+                    SELECT key, data FROM conversation_state
+                    WHERE kind = ? AND updated_at >= datetime(?, 'unixepoch')
+                """, (kind, int(since)))
+                return dict(cursor.fetchall())
+            cursor.execute("""
+                DELETE FROM conversation_state
+                WHERE kind = ? AND updated_at < datetime('now', ?)
+            """, (kind, f"-{CONVERSATION_STATE_TTL_DAYS} days"))
+            cursor.execute("SELECT key, data FROM conversation_state WHERE kind = ?", (kind,))
+            rows = cursor.fetchall()
+            conn.commit()
+            return dict(rows)
+    except Exception as e:
+        logger.error(f"Помилка load_conversation_state: {e}")
+        return {}
+
+def save_conversation_state(changed, dropped=()):
+    """Записати пакет змін однією транзакцією.
+
+    changed — [(kind, key, bytes)], dropped — [(kind, key)]. Повертає True/False.
+    """
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO conversation_state (kind, key, data, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+            """, changed)
+            cursor.executemany("DELETE FROM conversation_state WHERE kind = ? AND key = ?", dropped)
+            conn.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Помилка save_conversation_state: {e}")
+        return False
@@ -0,0 +1,109 @@
+# delivery.py - Розсилка повідомлень з обмеженою паралельністю та лімітами Telegram
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram: ~30 повідомлень/с на бота і ~1 повідомлення/с в один чат
+MAX_CONCURRENCY = 8
+GLOBAL_RATE = 25
+PER_CHAT_INTERVAL = 1.0
+MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY = 1.0
+
+class RateLimiter:
+    """Рівномірні інтервали між відправками: не більше rate повідомлень за секунду"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+
+    async def wait(self):
+        # Без await між читанням і записом _next — у межах циклу подій це атомарно,
+        # тож замок не потрібен і лімітер можна ділити між циклами (бенчмарки)
+        now = time.monotonic()
+        delay = self._next - now
+        self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        """Flood control діє на весь бот — відкладаємо всі наступні відправки"""
+        self._next = max(self._next, time.monotonic() + seconds)
+
+# Один бюджет на весь процес: пакети нагадувань 24h/2h і запитів оцінки
+# можуть іти одночасно, а ліміт Bot API спільний
+rate_limiter = RateLimiter(GLOBAL_RATE)
+
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+async def _send(bot, limiter, chat_id, kwargs, report):
+    """Одне повідомлення з повторами; True якщо доставлено"""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        await limiter.wait()
+        try:
+            await bot.send_message(chat_id=chat_id, **kwargs)
+            return True
+        except RetryAfter as e:
+            delay = _retry_after_seconds(e)
+            limiter.pause(delay)
+            logger.warning(f"⏳ Flood control для {chat_id}: чекаємо {delay:.0f} с")
+        except (Forbidden, BadRequest) as e:
+            # Бот заблоковано або чат недоступний — повтор не допоможе
+            logger.error(f"Не вдалось надіслати {chat_id}: {e}")
+            return False
+        except NetworkError as e:
+            # TimedOut теж NetworkError
+            delay = RETRY_BASE_DELAY * 2 ** (attempt - 1)
+            logger.warning(f"Тимчасова помилка для {chat_id} (спроба {attempt}): {e}")
+            await asyncio.sleep(delay)
+        except Exception as e:
+            logger.error(f"Не вдалось надіслати {chat_id}: {e}")
+            return False
+        report["retries"] += 1
+    logger.error(f"Не вдалось надіслати {chat_id}: вичерпано {MAX_ATTEMPTS} спроб")
+    return False
+
+async def deliver(bot, messages, name="delivery", concurrency=MAX_CONCURRENCY, limiter=rate_limiter):
+    """Надіслати пакет повідомлень.
+
+    messages — список (key, chat_id, kwargs для send_message). Повідомлення в один
+    чат ідуть послідовно з інтервалом PER_CHAT_INTERVAL, різні чати — паралельно
+    (не більше concurrency одночасно). Повертає звіт {'sent': [key, ...],
+    'failed': [key, ...], 'retries': n, 'elapsed': с}.
+    """
+    report = {'sent': [], 'failed': [], 'retries': 0, 'elapsed': 0.0}
+    if not messages:
+        return report
+
+    by_chat = {}
+    for key, chat_id, kwargs in messages:
+        by_chat.setdefault(chat_id, []).append((key, kwargs))
+
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+
+    async def send_chat(chat_id, chat_messages):
+        async with semaphore:
+            for index, (key, kwargs) in enumerate(chat_messages):
+                if index:
+                    await asyncio.sleep(PER_CHAT_INTERVAL)
+                if await _send(bot, limiter, chat_id, kwargs, report):
+                    report['sent'].append(key)
+                else:
+                    report['failed'].append(key)
+
+    await asyncio.gather(*(send_chat(chat_id, items) for chat_id, items in by_chat.items()))
+
+    report['elapsed'] = time.perf_counter() - started
+    throughput = len(report['sent']) / report['elapsed'] if report['elapsed'] else 0.0
+    logger.info(
+        f"📨 {name}: надіслано {len(report['sent'])}/{len(messages)} за {report['elapsed']:.2f} с "
+        f"({throughput:.1f}/с), помилок {len(report['failed'])}, повторів {report['retries']}"
+    )
+    return report
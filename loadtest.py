@@ -0,0 +1,684 @@
+# loadtest.py - Навантажувальний тест бота на локальному фейковому Telegram Bot API
+#
+# Бот запускається окремим процесом (справжній main(), polling) у тимчасовій
+# теці зі своєю БД і ходить на фейковий сервер через TELEGRAM_API_URL.
+# Сценарії учнів та інструкторів шлють оновлення і чекають відповідей.
+# З --webhook-workers N бот працює у webhook-режимі, і фейковий сервер
+# надсилає оновлення POST-запитами на його порт. --api-latency-ms імітує RTT
+# до справжнього Telegram: тоді видно, скільки дає паралельна обробка
+# оновлень (порівняйте --concurrent-updates 1 і за замовчуванням). Мережа не потрібна.
+#
+# Запуск:
+#   python loadtest.py [--students N] [--duration S] [--think S] [--max-p99 MS] [--webhook-workers N]
+#                      [--api-latency-ms MS] [--concurrent-updates N]
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import random
+import re
+import socket
+import sqlite3
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from urllib.request import urlopen
+
+import pytz
+
+import database
+
+BOT_USER = {
+    "id": 8593442263,
+    "is_bot": True,
+    "first_name": "Автоінструктор",
+    "username": "InstructorIFBot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+ADMIN_ID = 280240917  # адмін без ролі інструктора (ADMIN_ID у bot.py)
+STUDENT_ID_BASE = 500000000
+TZ = pytz.timezone("Europe/Kyiv")
+
+# Повідомлення, які бот надсилає сам (jobs, сповіщення іншої сторони), а не у відповідь на крок
+PUSH_MARKERS = (
+    "Нагадування!", "Урок завершено!", "Новий запис!", "Урок скасовано учнем",
+    "скасовано адміністратором", "Вас записано на заняття!",
+)
+
+# ======================= ФЕЙКОВИЙ BOT API =======================
+def _markup_buttons(markup):
+    """Тексти кнопок з reply_markup (ReplyKeyboardMarkup або InlineKeyboardMarkup)"""
+    if not markup:
+        return None
+    rows = markup.get("keyboard") or markup.get("inline_keyboard")
+    if rows is None:
+        return None
+    return [button if isinstance(button, str) else button.get("text", "") for row in rows for button in row]
+
+class FakeTelegramServer:
+    """Мінімальний Bot API: getMe, getUpdates (long polling), setWebhook, sendMessage, sendDocument.
+
+    Решта методів відповідає `true`. Відправлені ботом повідомлення передаються
+    в on_message(chat_id, message) з потоку HTTP-сервера. Після setWebhook
+    оновлення не чекають getUpdates, а надсилаються на webhook по порядку.
+    """
+
+    def __init__(self, on_message=None, host="127.0.0.1", port=0, latency=0.0):
+        self.on_message = on_message
+        self.latency = latency
+        self.calls = Counter()
+        self.api_time = Counter()
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._cond = threading.Condition()
+        self.polling = threading.Event()
+        self.webhook_set = threading.Event()
+        self._webhook_outbox = queue.Queue()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки й тіло йдуть окремими send(): без TCP_NODELAY кожна відповідь чекає ~40 мс delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                started = time.perf_counter()
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                params = server._parse_params(self)
+                if server.latency and method != "getUpdates":
+                    time.sleep(server.latency)
+                result = server.dispatch(method, params)
+                body = json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                if method != "getUpdates":
+                    server.api_time[method] += time.perf_counter() - started
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @staticmethod
+    def _parse_params(request):
+        """Параметри з query, form-urlencoded, JSON або multipart (sendDocument)"""
+        params = {k: v[0] for k, v in parse_qs(urlparse(request.path).query).items()}
+        length = int(request.headers.get("Content-Length") or 0)
+        if not length:
+            return params
+        body = request.rfile.read(length)
+        content_type = request.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            params.update(json.loads(body))
+        elif content_type.startswith("multipart/form-data"):
+            message = BytesParser().parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body
+            )
+            for part in message.get_payload():
+                name = part.get_param("name", header="content-disposition")
+                filename = part.get_filename()
+                payload = part.get_payload(decode=True)
+                params[name] = {"filename": filename, "size": len(payload)} if filename else payload.decode("utf-8")
+        else:
+            params.update({k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()})
+        return params
+
+    def dispatch(self, method, params):
+        self.calls[method] += 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "setWebhook":
+            threading.Thread(target=self._send_webhooks, args=(params["url"], params.get("secret_token")),
+                             daemon=True).start()
+            self.webhook_set.set()
+            return True
+        if method in ("sendMessage", "sendDocument"):
+            return self._record_message(method, params)
+        return True
+
+    def push_update(self, user_id, text):
+        """Поставити в чергу повідомлення від користувача; повертає update_id"""
+        user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+        with self._cond:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+            message = {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+                "from": user,
+                "text": text,
+            }
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            if self.webhook_set.is_set():
+                self._webhook_outbox.put({"update_id": update_id, "message": message})
+            else:
+                self._updates.append({"update_id": update_id, "message": message})
+                self._cond.notify_all()
+        return update_id
+
+    def _send_webhooks(self, url, secret_token):
+        """Один потік, одне keep-alive з'єднання: оновлення доходять у порядку push_update"""
+        target = urlparse(url)
+        headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret_token or ""}
+        conn = None
+        while True:
+            update = self._webhook_outbox.get()
+            body = json.dumps(update, ensure_ascii=False).encode("utf-8")
+            for _ in range(2):
+                try:
+                    conn = conn or http.client.HTTPConnection(target.hostname, target.port, timeout=10)
+                    conn.request("POST", target.path, body, headers)
+                    conn.getresponse().read()
+                    self.calls["webhook"] += 1
+                    break
+                except OSError:
+                    conn = None
+
+    def _get_updates(self, params):
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return list(self._updates[:int(params.get("limit") or 100)])
+
+    def _record_message(self, method, params):
+        chat_id = int(params["chat_id"])
+        markup = params.get("reply_markup")
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        with self._cond:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if method == "sendDocument":
+            document = params.get("document") or {}
+            message["document"] = {
+                "file_id": f"doc{message_id}",
+                "file_unique_id": f"doc{message_id}",
+                "file_name": document.get("filename") if isinstance(document, dict) else None,
+            }
+        else:
+            message["text"] = params.get("text", "")
+        if self.on_message:
+            self.on_message(chat_id, dict(message, buttons=_markup_buttons(markup)))
+        return message
+
+# ======================= СИМУЛЬОВАНІ КОРИСТУВАЧІ =======================
+class StepFailed(Exception):
+    pass
+
+class SimUser:
+    """Один чат: надсилає текст і чекає відповіді бота"""
+
+    def __init__(self, harness, user_id):
+        self.harness = harness
+        self.user_id = user_id
+        self.inbox = asyncio.Queue()
+        self.buttons = []
+        self.rating_requested = False
+
+    def deliver(self, message):
+        text = message.get("text") or ""
+        if any(marker in text for marker in PUSH_MARKERS):
+            self.harness.pushes += 1
+            if "Урок завершено!" in text:
+                self.rating_requested = True
+            return
+        self.inbox.put_nowait(message)
+
+    async def send(self, label, text, settle=0.3):
+        """Надіслати текст; затримка — до першої відповіді. Чекаємо до повідомлення з клавіатурою.
+
+        settle — скільки чекати наступного повідомлення тієї ж відповіді понад RTT Bot API.
+        """
+        settle += 2 * self.harness.server.latency
+        while not self.inbox.empty():
+            self.inbox.get_nowait()
+        started = time.perf_counter()
+        self.harness.server.push_update(self.user_id, text)
+        try:
+            message = await asyncio.wait_for(self.inbox.get(), self.harness.step_timeout)
+        except asyncio.TimeoutError:
+            self.harness.timeouts[label] += 1
+            raise StepFailed(label)
+        self.harness.latencies.setdefault(label, []).append(time.perf_counter() - started)
+        replies = [message]
+        while message.get("buttons") is None:
+            try:
+                message = await asyncio.wait_for(self.inbox.get(), settle)
+            except asyncio.TimeoutError:
+                break
+            replies.append(message)
+        if message.get("buttons") is not None:
+            self.buttons = message["buttons"]
+        return replies
+
+    def pick(self, rnd, exclude=("🔙 Назад",)):
+        options = [b for b in self.buttons if b and b not in exclude]
+        if not options:
+            raise StepFailed("немає кнопок")
+        return rnd.choice(options)
+
+FIRST_FREE = "⚡ Найближчий вільний час"
+
+async def student_book(user, rnd):
+    await user.send("start", "/start")
+    await user.send("book:menu", "🚀 Записатися на заняття")
+    await user.send("book:transmission", rnd.choice(["🚗 Автомат", "🚙 Механіка"]))
+    if rnd.random() < 0.3:
+        await user.send("book:first_free", FIRST_FREE)
+        if not any(":" in b for b in user.buttons):
+            return
+        await user.send("book:first_slot", user.pick(rnd))
+    else:
+        await user.send("book:instructor", user.pick(rnd, exclude=("🔙 Назад", FIRST_FREE)))
+        if "👨‍🏫 Обрати іншого інструктора" in user.buttons:
+            return
+        await user.send("book:date", user.pick(rnd))
+        if not any(":" in b for b in user.buttons):
+            return
+        await user.send("book:time", user.pick(rnd))
+    await user.send("book:duration", rnd.choice(["1 година", "1 година", "2 години"]))
+    if "✅ Підтвердити" in user.buttons:
+        await user.send("book:confirm", "✅ Підтвердити")
+
+async def student_cancel(user, rnd):
+    await user.send("start", "/start")
+    await user.send("cancel:list", "❌ Скасувати запис")
+    numbers = [b for b in user.buttons if b.isdigit()]
+    if not numbers:
+        return
+    await user.send("cancel:select", rnd.choice(numbers))
+    if "✅ Так, скасувати" in user.buttons:
+        await user.send("cancel:confirm", "✅ Так, скасувати")
+
+async def student_view(user, rnd):
+    await user.send("start", "/start")
+    await user.send(
+        "view:lessons" if rnd.random() < 0.7 else "view:stats",
+        "📋 Мої записи" if rnd.random() < 0.7 else "📊 Моя статистика"
+    )
+
+async def student_rate(user, rnd):
+    user.rating_requested = False
+    await user.send("rate:stars", rnd.choice(["⭐⭐⭐", "⭐⭐⭐⭐", "⭐⭐⭐⭐⭐"]))
+    if "✍️ Написати коментар" in user.buttons and rnd.random() < 0.5:
+        await user.send("rate:comment", "✍️ Написати коментар")
+        await user.send("rate:comment_text", "Дякую, все чудово")
+    elif "⏭️ Пропустити" in user.buttons:
+        await user.send("rate:skip", "⏭️ Пропустити")
+
+async def instructor_block(user, rnd):
+    await user.send("start", "/start")
+    await user.send("block:menu", "⚙️ Управління графіком")
+    await user.send("block:start", "🔴 Заблокувати час")
+    await user.send("block:date", user.pick(rnd))
+    await user.send("block:time_start", user.pick(rnd))
+    await user.send("block:time_end", user.buttons[0])
+    await user.send("block:reason", "➡️ Пропустити")
+
+async def instructor_rate(user, rnd):
+    await user.send("start", "/start")
+    await user.send("irate:list", "⭐ Оцінити учня")
+    numbers = [b for b in user.buttons if b.isdigit()]
+    if not numbers:
+        return
+    await user.send("irate:select", rnd.choice(numbers))
+    await user.send("irate:score", rnd.choice(["4", "5"]))
+    await user.send("irate:feedback", "➡️ Пропустити")
+
+async def instructor_schedule(user, rnd):
+    await user.send("start", "/start")
+    await user.send("schedule:menu", "📅 Мій розклад")
+    await user.send("schedule:week", "📅 На тиждень")
+
+async def admin_export(user, rnd):
+    await user.send("start", "/start")
+    await user.send("export:menu", "📥 Експорт в Excel")
+    await user.send("export:week", "📊 За тиждень", settle=5)
+
+STUDENT_SCENARIOS = ((student_book, 5), (student_cancel, 2), (student_view, 3))
+INSTRUCTOR_SCENARIOS = ((instructor_block, 1), (instructor_rate, 2), (instructor_schedule, 3))
+
+# ======================= ПРОГІН =======================
+class LockProbe:
+    """Частка моментів, коли запис у БД зайнятий: BEGIN IMMEDIATE без очікування кожні interval с"""
+
+    def __init__(self, db_path, interval=0.02):
+        self.db_path = db_path
+        self.interval = interval
+        self.samples = 0
+        self.locked = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path, timeout=0, isolation_level=None)
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("ROLLBACK")
+            except sqlite3.OperationalError:
+                self.locked += 1
+        conn.close()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.users = {}
+        self.latencies = {}
+        self.timeouts = Counter()
+        self.failed = Counter()
+        self.pushes = 0
+        self.step_timeout = args.step_timeout
+        self.loop = None
+        self.server = FakeTelegramServer(on_message=self._on_message, latency=args.api_latency_ms / 1000)
+
+    def _on_message(self, chat_id, message):
+        user = self.users.get(chat_id)
+        if user is not None and self.loop is not None:
+            self.loop.call_soon_threadsafe(user.deliver, message)
+
+    def seed(self, db_path, rnd):
+        """Учні та історія уроків; інструкторів уже додав бот при старті"""
+        database.DB_NAME = db_path
+        now = datetime.now(TZ)
+        with database.get_db() as conn:
+            instructor_ids = [row[0] for row in conn.execute("SELECT id FROM instructors")]
+            conn.executemany(
+                "INSERT INTO students (name, phone, telegram_id, tariff, registered_via) VALUES (?, ?, ?, ?, 'admin')",
+                [(f"Учень {i}", f"+38050{i:07d}", STUDENT_ID_BASE + i, rnd.choice([490, 550]))
+                 for i in range(self.args.students)]
+            )
+            lessons = []
+            for i in range(self.args.students):
+                student_id = STUDENT_ID_BASE + i
+                # Минулі уроки — інструкторам є кого оцінювати
+                for days_ago in rnd.sample(range(1, 60), 2):
+                    lessons.append((rnd.choice(instructor_ids), student_id, now - timedelta(days=days_ago), "completed"))
+                # Урок, що вже почався: job завершення попросить учня оцінити інструктора
+                if rnd.random() < 0.3:
+                    lessons.append((rnd.choice(instructor_ids), student_id, now - timedelta(hours=2), "active"))
+            conn.executemany("""
+                INSERT INTO lessons (instructor_id, student_name, student_telegram_id, student_tariff, date, date_iso,
+                                     time, starts_at, duration, duration_minutes, status)
+                VALUES (?, ?, ?, 490, ?, ?, ?, ?, '1 година', 60, ?)
+            """, [
+                (instructor_id, f"Учень {student_id - STUDENT_ID_BASE}", student_id,
+                 at.strftime('%d.%m.%Y'), at.strftime('%Y-%m-%d'), at.strftime('%H:00'),
+                 at.strftime('%Y-%m-%d %H:00'), status)
+                for instructor_id, student_id, at, status in lessons
+            ])
+            conn.commit()
+            return [row[0] for row in conn.execute("SELECT telegram_id FROM instructors WHERE telegram_id != ?", (ADMIN_ID,))]
+
+    async def run_user(self, user, scenarios, deadline, seed):
+        rnd = random.Random(seed)
+        functions, weights = zip(*scenarios)
+        await asyncio.sleep(rnd.uniform(0, self.args.think))
+        while time.perf_counter() < deadline:
+            scenario = student_rate if user.rating_requested else rnd.choices(functions, weights)[0]
+            try:
+                await scenario(user, rnd)
+            except StepFailed as e:
+                self.failed[f"{scenario.__name__}: {e}"] += 1
+            await asyncio.sleep(rnd.uniform(0, 2 * self.args.think))
+
+    async def drive(self, instructor_ids):
+        self.loop = asyncio.get_running_loop()
+        deadline = time.perf_counter() + self.args.duration
+        tasks = []
+        for i in range(self.args.students):
+            user = self.users[STUDENT_ID_BASE + i] = SimUser(self, STUDENT_ID_BASE + i)
+            tasks.append(self.run_user(user, STUDENT_SCENARIOS, deadline, i))
+        for telegram_id in instructor_ids:
+            user = self.users[telegram_id] = SimUser(self, telegram_id)
+            tasks.append(self.run_user(user, INSTRUCTOR_SCENARIOS, deadline, telegram_id))
+        admin = self.users[ADMIN_ID] = SimUser(self, ADMIN_ID)
+        tasks.append(self.run_user(admin, ((admin_export, 1),), deadline, ADMIN_ID))
+        started = time.perf_counter()
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+    def run(self):
+        health_port = self.args.health_port or free_port()
+        if os.path.exists("/var/data"):
+            sys.exit("❌ Знайдено /var/data: bot.py працюватиме з робочою БД, навантажувальний тест заборонено")
+        base = os.path.dirname(os.path.abspath(__file__))
+        rnd = random.Random(self.args.seed)
+        self.server.start()
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(
+                os.environ,
+                TELEGRAM_API_URL=self.server.url,
+                COMPLETED_CHECK_INTERVAL=str(self.args.completed_interval),
+                PORT=str(health_port),
+                PYTHONUNBUFFERED="1",
+            )
+            if self.args.concurrent_updates:
+                env["CONCURRENT_UPDATES"] = str(self.args.concurrent_updates)
+            env.pop("DB_NAME", None)
+            if self.args.webhook_workers:
+                env.update(WEBHOOK_URL=f"http://127.0.0.1:{health_port}", WEBHOOK_WORKERS=str(self.args.webhook_workers))
+            else:
+                env.pop("WEBHOOK_URL", None)
+            # stdout/stderr бота — у файл поруч з bot.log: traceback падіння при старті
+            # потрапляє лише сюди, а tmp зникне разом з обома файлами
+            with open(os.path.join(tmp, BOT_OUTPUT), "wb") as output:
+                bot = subprocess.Popen(
+                    [sys.executable, os.path.join(base, "bot.py")],
+                    cwd=tmp, env=env, stdout=output, stderr=subprocess.STDOUT
+                )
+            db_path = os.path.join(tmp, "driving_school.db")
+            try:
+                if self.args.webhook_workers:
+                    wait_bot_ready(bot, self.server.webhook_set, 60, "не встановив webhook")
+                else:
+                    wait_bot_ready(bot, self.server.polling, 30, "не почав polling")
+                instructor_ids = self.seed(db_path, rnd)
+                probe = LockProbe(db_path).start()
+                elapsed = asyncio.run(self.drive(instructor_ids))
+                probe.stop()
+                with urlopen(f"http://127.0.0.1:{health_port}/metrics", timeout=10) as response:
+                    handler_metrics = parse_handler_metrics(response.read().decode("utf-8"))
+            except BaseException:
+                print_bot_output(tmp)
+                raise
+            finally:
+                shutdown = self.stop_bot(bot, db_path)
+                self.server.stop()
+                database.get_pool().close_all()
+            with open(os.path.join(tmp, "bot.log"), encoding="utf-8", errors="replace") as f:
+                log = f.read()
+        return self.report(elapsed, probe, log, handler_metrics, shutdown)
+
+    def stop_bot(self, bot, db_path):
+        """SIGTERM, як при зупинці сервісу: бот має вийти сам, дописавши стан і обрізавши -wal"""
+        bot.terminate()
+        try:
+            code = bot.wait(SHUTDOWN_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+            bot.wait()
+            return f"не зупинився за {SHUTDOWN_TIMEOUT} с після SIGTERM"
+        # Перевіряємо до close_all: останнє з'єднання цього процесу саме перенесло б -wal у БД
+        wal = db_path + "-wal"
+        wal_bytes = os.path.getsize(wal) if os.path.exists(wal) else 0
+        if code != 0:
+            return f"код виходу {code} після SIGTERM"
+        if wal_bytes:
+            return f"-wal не обрізано при зупинці ({wal_bytes} байт)"
+        return None
+
+    def report(self, elapsed, probe, log, handler_metrics, shutdown):
+        steps = sum(len(v) for v in self.latencies.values())
+        mode = f"webhook, воркерів: {self.args.webhook_workers}" if self.args.webhook_workers else "polling"
+        if self.args.concurrent_updates:
+            mode += f", оновлень одночасно: {self.args.concurrent_updates}"
+        if self.args.api_latency_ms:
+            mode += f", RTT Bot API {self.args.api_latency_ms:.0f} мс"
+        print(f"🚦 {self.args.students} учнів, {len(self.users) - self.args.students - 1} інструкторів, "
+              f"{elapsed:.1f} с ({mode})")
+        print(f"   оновлень оброблено: {steps} ({steps / elapsed:.1f}/с), відповідей бота: "
+              f"{self.server.calls['sendMessage'] + self.server.calls['sendDocument']}, "
+              f"сповіщень від jobs/інших користувачів: {self.pushes}")
+        print(f"   {'крок':22} {'n':>6} {'p50 мс':>9} {'p95 мс':>9} {'p99 мс':>9} {'max мс':>9}")
+        worst_p99 = 0.0
+        for label in sorted(self.latencies):
+            values = sorted(self.latencies[label])
+            p = lambda q: values[min(len(values) - 1, int(len(values) * q))] * 1000
+            worst_p99 = max(worst_p99, p(0.99))
+            print(f"   {label:22} {len(values):6} {p(0.5):9.1f} {p(0.95):9.1f} {p(0.99):9.1f} {values[-1] * 1000:9.1f}")
+        api_calls = sum(c for m, c in self.server.calls.items() if m != "getUpdates")
+        print(f"   Bot API: {dict(self.server.calls)}; "
+              f"час сервера на виклик {sum(self.server.api_time.values()) / max(api_calls, 1) * 1000:.2f} мс")
+        locked_pct = probe.locked / probe.samples * 100 if probe.samples else 0.0
+        print(f"   SQLite: запис зайнятий у {locked_pct:.1f}% з {probe.samples} проб, "
+              f"'database is locked' у bot.log: {log.count('database is locked')}, "
+              f"ERROR у bot.log: {log.count(' - ERROR - ')}")
+        print(f"   /metrics бота, найдорожчі обробники за сумарним часом:")
+        print(f"   {'обробник':34} {'n':>6} {'сер. мс':>9} {'SQL/виклик':>11} {'рядків/виклик':>14} {'API мс/виклик':>14}")
+        for name, values in sorted(handler_metrics.items(), key=lambda item: -item[1]["sum"])[:METRICS_TOP]:
+            calls = values["count"] or 1
+            print(f"   {name:34} {values['count']:6.0f} {values['sum'] / calls * 1000:9.1f} "
+                  f"{values['sql_statements'] / calls:11.1f} {values['rows_read'] / calls:14.1f} "
+                  f"{values['telegram_api_seconds'] / calls * 1000:14.2f}")
+        if self.timeouts:
+            print(f"   ⏳ без відповіді за {self.step_timeout:.0f} с: {dict(self.timeouts)}")
+        if self.failed:
+            print(f"   ⚠️ перервані сценарії: {dict(self.failed)}")
+
+        if shutdown:
+            print(f"   ⚠️ зупинка бота: {shutdown}")
+        else:
+            print("   зупинка бота по SIGTERM: штатна, -wal обрізано")
+
+        ok = not self.timeouts and (self.args.max_p99 is None or worst_p99 <= self.args.max_p99)
+        if not ok:
+            print(f"❌ Регресія: p99 {worst_p99:.1f} мс, таймаутів {sum(self.timeouts.values())}")
+        elif shutdown:
+            print("❌ Бот не зупинився штатно")
+        else:
+            print("✅ Навантаження пройдено")
+        return ok and not shutdown
+
+METRICS_TOP = 10
+HANDLER_METRIC = re.compile(
+    r'^bot_handler_(duration_seconds_sum|duration_seconds_count|sql_statements_total|rows_read_total|'
+    r'telegram_api_seconds_total)\{(?:worker="\d+",)?kind="(\w+)",handler="(\w+)",state="([^"]*)"\} (\S+)$'
+)
+
+BOT_OUTPUT = "bot.out"
+SHUTDOWN_TIMEOUT = 15
+OUTPUT_TAIL_LINES = 40
+
+def wait_bot_ready(bot, event, timeout, what):
+    """Чекати на подію фейкового сервера; вийти одразу, якщо процес бота завершився"""
+    deadline = time.monotonic() + timeout
+    while not event.wait(0.5):
+        if bot.poll() is not None:
+            sys.exit(f"❌ Бот завершився з кодом {bot.returncode} до старту")
+        if time.monotonic() > deadline:
+            sys.exit(f"❌ Бот {what} за {timeout} с")
+
+def print_bot_output(tmp):
+    """Хвіст stdout/stderr і bot.log бота — перед тим, як тимчасова тека зникне"""
+    for name in (BOT_OUTPUT, "bot.log"):
+        path = os.path.join(tmp, name)
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()[-OUTPUT_TAIL_LINES:]
+        print(f"----- {name} (останні {len(lines)} рядків) -----", file=sys.stderr)
+        for line in lines:
+            print(line, file=sys.stderr)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def parse_handler_metrics(text):
+    """/metrics → {"kind:handler": {"sum", "count", "sql_statements", ...}} (стани підсумовуються)"""
+    result = {}
+    for line in text.splitlines():
+        match = HANDLER_METRIC.match(line)
+        if not match:
+            continue
+        metric, kind, handler, _, value = match.groups()
+        key = metric.replace("duration_seconds_", "").replace("_total", "")
+        values = result.setdefault(f"{kind}:{handler}", dict.fromkeys(
+            ("sum", "count", "sql_statements", "rows_read", "telegram_api_seconds"), 0.0))
+        values[key] += float(value)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Навантажувальний тест бота на фейковому Bot API")
+    parser.add_argument("--students", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=30.0, help="тривалість навантаження, с")
+    parser.add_argument("--think", type=float, default=2.0, help="середня пауза між кроками сценаріїв, с")
+    parser.add_argument("--step-timeout", type=float, default=15.0)
+    parser.add_argument("--completed-interval", type=int, default=5, help="COMPLETED_CHECK_INTERVAL для бота")
+    parser.add_argument("--health-port", type=int, default=0, help="PORT health-сервера бота (0 — будь-який вільний)")
+    parser.add_argument("--max-p99", type=float, help="поріг p99 у мс для будь-якого кроку; вище — код виходу 1")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--webhook-workers", type=int, default=0, help="webhook-режим з N воркерами (0 — polling)")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="затримка відповіді фейкового Bot API")
+    parser.add_argument("--concurrent-updates", type=int, default=0,
+                        help="CONCURRENT_UPDATES для бота (0 — його значення за замовчуванням)")
+    args = parser.parse_args()
+    sys.exit(0 if LoadTest(args).run() else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+# metrics.py - Інструментування обробників і jobs для /metrics (формат Prometheus)
+#
+# Кожен маршрут handle_message і кожен job виконується всередині measure(): на час
+# виконання в contextvar лежить Sample, куди з'єднання БД дописують кількість
+# SQL-запитів і прочитаних рядків, а запити до Bot API — свій час. Контекст
+# копіюється в робочі потоки БД (run_db) і в задачі asyncio, тож усе, що обробник
+# запустив, рахується йому.
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+# Межі гістограми часу обробника, секунди
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = ContextVar("metrics_sample", default=None)
+
+class Sample:
+    """Лічильники одного виклику обробника"""
+    __slots__ = ("sql_statements", "rows_read", "api_calls", "api_seconds", "_lock")
+
+    def __init__(self):
+        self.sql_statements = 0
+        self.rows_read = 0
+        self.api_calls = 0
+        self.api_seconds = 0.0
+        # Запити БД дописують з робочих потоків
+        self._lock = threading.Lock()
+
+    def add(self, sql_statements=0, rows_read=0, api_calls=0, api_seconds=0.0):
+        with self._lock:
+            self.sql_statements += sql_statements
+            self.rows_read += rows_read
+            self.api_calls += api_calls
+            self.api_seconds += api_seconds
+
+class HandlerStats:
+    """Накопичені значення для однієї пари (тип, обробник, стан)"""
+    __slots__ = ("calls", "errors", "seconds", "buckets", "sql_statements", "rows_read", "api_calls", "api_seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.sql_statements = 0
+        self.rows_read = 0
+        self.api_calls = 0
+        self.api_seconds = 0.0
+
+    def observe(self, elapsed, sample, failed):
+        self.calls += 1
+        self.errors += failed
+        self.seconds += elapsed
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+                break
+        self.sql_statements += sample.sql_statements
+        self.rows_read += sample.rows_read
+        self.api_calls += sample.api_calls
+        self.api_seconds += sample.api_seconds
+
+_handlers = {}
+# Скільки обробників і jobs виконується зараз (profiler.py семплює лише тоді)
+_in_flight = 0
+# Запити до Bot API за методом (включно з getUpdates): [кількість, секунди]
+_api_methods = {}
+# Gauges, що обчислюються під час кожного /metrics: {назва: (опис, функція)}
+_gauges = {}
+_registry_lock = threading.Lock()
+
+@contextmanager
+def measure(kind, name, state=""):
+    """Заміряти виконання обробника: with measure("route", "show_student_lessons", state): ..."""
+    global _in_flight
+    sample = Sample()
+    token = _current.set(sample)
+    started = time.perf_counter()
+    failed = False
+    _in_flight += 1
+    try:
+        yield sample
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        _in_flight -= 1
+        _current.reset(token)
+        with _registry_lock:
+            stats = _handlers.get((kind, name, state))
+            if stats is None:
+                stats = _handlers[(kind, name, state)] = HandlerStats()
+            stats.observe(elapsed, sample, failed)
+
+def instrument(kind):
+    """Декоратор для корутин-jobs: @instrument("job")"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with measure(kind, func.__name__):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def in_flight():
+    """Кількість обробників і jobs, що виконуються зараз"""
+    return _in_flight
+
+def record_api_call(method, elapsed):
+    """Один запит до Bot API (викликається з MeteredRequest у bot.py)"""
+    sample = _current.get()
+    if sample is not None:
+        sample.add(api_calls=1, api_seconds=elapsed)
+    with _registry_lock:
+        stats = _api_methods.setdefault(method, [0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+
+def register_gauge(name, help_text, func):
+    """Gauge зі значенням func() на момент запиту /metrics (розмір WAL тощо)"""
+    _gauges[name] = (help_text, func)
+
+# ======================= SQLITE =======================
+class MeteredCursor(sqlite3.Cursor):
+    """Курсор, що рахує прочитані рядки для поточного Sample"""
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _count_rows(1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        _count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _count_rows(len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        _count_rows(1)
+        return row
+
+class MeteredConnection(sqlite3.Connection):
+    """З'єднання для пулу: курсори MeteredCursor і лічильник виконаних запитів"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_trace_callback(_count_statement)
+
+    def cursor(self, factory=MeteredCursor):
+        # conn.execute() теж створює курсор через цей метод
+        return super().cursor(factory)
+
+def _count_rows(rows):
+    sample = _current.get()
+    if sample is not None and rows:
+        sample.add(rows_read=rows)
+
+def _count_statement(sql):
+    # Тригери sqlite3 повідомляє окремими рядками "-- TRIGGER ..."
+    if sql.startswith("--"):
+        return
+    sample = _current.get()
+    if sample is not None:
+        sample.add(sql_statements=1)
+
+# ======================= ЕКСПОРТ =======================
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+HANDLER_COUNTERS = (
+    ("bot_handler_errors_total", "Виклики, що завершились винятком", "errors"),
+    ("bot_handler_sql_statements_total", "Виконані SQL-запити", "sql_statements"),
+    ("bot_handler_rows_read_total", "Рядки, прочитані з БД", "rows_read"),
+    ("bot_handler_telegram_api_calls_total", "Запити до Bot API", "api_calls"),
+    ("bot_handler_telegram_api_seconds_total", "Час у запитах до Bot API, с", "api_seconds"),
+)
+
+def render():
+    """Усі метрики у текстовому форматі Prometheus 0.0.4"""
+    with _registry_lock:
+        handlers = sorted(_handlers.items())
+        snapshot = [(key, stats.calls, stats.seconds, list(stats.buckets),
+                     {attr: getattr(stats, attr) for _, _, attr in HANDLER_COUNTERS})
+                    for key, stats in handlers]
+        api_methods = sorted((method, list(stats)) for method, stats in _api_methods.items())
+
+    lines = [
+        "# HELP bot_handler_duration_seconds Час виконання маршруту handle_message або job",
+        "# TYPE bot_handler_duration_seconds histogram",
+    ]
+    for (kind, name, state), calls, seconds, buckets, _ in snapshot:
+        cumulative = 0
+        for bound, count in zip(DURATION_BUCKETS, buckets):
+            cumulative += count
+            lines.append(f"bot_handler_duration_seconds_bucket"
+                         f"{_labels(kind=kind, handler=name, state=state, le=bound)} {cumulative}")
+        lines.append(f"bot_handler_duration_seconds_bucket{_labels(kind=kind, handler=name, state=state, le='+Inf')} {calls}")
+        lines.append(f"bot_handler_duration_seconds_sum{_labels(kind=kind, handler=name, state=state)} {seconds}")
+        lines.append(f"bot_handler_duration_seconds_count{_labels(kind=kind, handler=name, state=state)} {calls}")
+
+    for metric, help_text, attr in HANDLER_COUNTERS:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for (kind, name, state), _, _, _, counters in snapshot:
+            lines.append(f"{metric}{_labels(kind=kind, handler=name, state=state)} {counters[attr]}")
+
+    lines.append("# HELP bot_telegram_api_requests_total Запити до Bot API за методом")
+    lines.append("# TYPE bot_telegram_api_requests_total counter")
+    for method, (calls, _) in api_methods:
+        lines.append(f"bot_telegram_api_requests_total{_labels(method=method)} {calls}")
+    lines.append("# HELP bot_telegram_api_seconds_total Час запитів до Bot API за методом, с")
+    lines.append("# TYPE bot_telegram_api_seconds_total counter")
+    for method, (_, seconds) in api_methods:
+        lines.append(f"bot_telegram_api_seconds_total{_labels(method=method)} {seconds}")
+
+    for name, (help_text, func) in sorted(_gauges.items()):
+        try:
+            value = func()
+        except Exception:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def merge(texts, label):
+    """Звести тексти render() кількох процесів в один: {значення мітки: текст} → текст.
+
+    Кожен рядок-семпл отримує мітку label, HELP/TYPE кожної метрики йдуть один раз,
+    а семпли однієї метрики — разом, як вимагає формат.
+    """
+    families = {}
+    for value, text in texts.items():
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                family = families.setdefault(line.split(" ", 3)[2], [line, None, []])
+            elif line.startswith("# TYPE "):
+                family[1] = line
+            elif line and family is not None:
+                name, _, rest = line.partition("{")
+                if rest:
+                    family[2].append(f'{name}{{{label}="{_escape(value)}",{rest}')
+                else:
+                    name, sample = line.split(" ", 1)
+                    family[2].append(f'{name}{_labels(**{label: value})} {sample}')
+    lines = []
+    for help_line, type_line, samples in families.values():
+        lines.append(help_line)
+        lines.append(type_line)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+def reset():
+    """Очистити накопичене (для бенчмарків)"""
+    with _registry_lock:
+        _handlers.clear()
+        _api_methods.clear()
@@ -0,0 +1,202 @@
+# persistence.py - Збереження user_data/bot_data у SQLite (BasePersistence для PTB)
+#
+# Application раз на update_interval викликає update_user_data для змінених
+# користувачів і update_bot_data. Ці виклики лише складають дані в буфер; запис
+# робить одна задача, що пише весь пакет однією транзакцією у робочому потоці БД.
+# Для кожного запису пам'ятаємо останні збережені байти, тож незмінений стан
+# (більшість bot_data між тиками) у БД не пишеться. bot_data зберігається по
+# ключах (rating_lesson_*, rating_feedback_*), щоб зміна одного ключа не
+# переписувала решту.
+#
+# У webhook-режимі з кількома воркерами (shared=True) user_data кожного
+# користувача живе в одному процесі, а bot_data пишуть усі: job оцінювання у
+# воркері 0 ставить ключ, учень відповідає у своєму воркері. Тому перед кожним
+# оновленням воркер дочитує ключі bot_data, які інші процеси записали після його
+# попереднього читання.
+import asyncio
+import logging
+import os
+import pickle
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import load_conversation_state, save_conversation_state, run_db
+
+logger = logging.getLogger(__name__)
+
+# Як часто Application скидає змінений стан у persistence, секунди
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "10"))
+
+USER = "user"
+BOT = "bot"
+# updated_at у БД має точність до секунди: перечитуємо з запасом
+REFRESH_OVERLAP = 2
+
+def _dump(data):
+    return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+class SQLitePersistence(BasePersistence):
+    """user_data і bot_data у таблиці conversation_state; chat_data, розмови й callback_data не зберігаються"""
+
+    def __init__(self, update_interval=SESSION_FLUSH_INTERVAL, shared=False):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        # Останні записані байти: {(kind, key): bytes}
+        self._saved = {}
+        # Ще не записані зміни: {(kind, key): bytes або None для видалення}
+        self._pending = {}
+        # Пакет, що пишеться зараз: його значення вже не в _pending, але ще не в _saved
+        self._in_flight = {}
+        self._write_task = None
+        # Пакети пишуться по одному: _in_flight і порядок записів залишаються однозначними
+        self._write_lock = asyncio.Lock()
+        self.shared = shared
+        self._refreshed_at = time.time()
+
+    # ---------- Завантаження ----------
+    async def get_user_data(self):
+        rows = await run_db(load_conversation_state, USER)
+        user_data = {}
+        for key, blob in rows.items():
+            data = self._load(USER, key, blob)
+            if data is not None:
+                user_data[int(key)] = data
+        logger.info(f"💾 Відновлено user_data для {len(user_data)} користувачів")
+        return user_data
+
+    async def get_bot_data(self):
+        rows = await run_db(load_conversation_state, BOT)
+        bot_data = {}
+        for key, blob in rows.items():
+            data = self._load(BOT, key, blob)
+            if data is not None:
+                bot_data[key] = data
+        return bot_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    def _load(self, kind, key, blob):
+        try:
+            data = pickle.loads(blob)
+        except Exception as e:
+            logger.error(f"Помилка _load {kind}/{key}: {e}")
+            return None
+        self._saved[(kind, key)] = bytes(blob)
+        return data
+
+    # ---------- Оновлення (write-behind) ----------
+    async def update_user_data(self, user_id, data):
+        self._stage(USER, str(user_id), _dump(data) if data else None)
+
+    async def drop_user_data(self, user_id):
+        self._stage(USER, str(user_id), None)
+
+    async def update_bot_data(self, data):
+        for key, value in data.items():
+            self._stage(BOT, str(key), _dump(value))
+        # Ключі, яких більше немає в bot_data (оцінку вже отримано), включно з тими,
+        # що ще пишуться або чекають запису
+        present = {str(key) for key in data}
+        for kind, key in {*self._saved, *self._in_flight, *self._pending}:
+            if kind == BOT and key not in present:
+                self._stage(BOT, key, None)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        """Дочитати ключі bot_data, записані іншими воркерами (лише shared=True)"""
+        if not self.shared:
+            return
+        started = time.time()
+        rows = await run_db(load_conversation_state, BOT, self._refreshed_at - REFRESH_OVERLAP)
+        self._refreshed_at = started
+        for key, blob in rows.items():
+            saved = self._saved.get((BOT, key))
+            if blob == saved or (BOT, key) in self._pending or (BOT, key) in self._in_flight:
+                continue
+            # Ключ, уже відомий цьому процесу, оновлюємо, лише якщо локально він не змінювався
+            # (видалений тут, але ще не записаний — теж зміна)
+            if saved is not None and (key not in bot_data or _dump(bot_data[key]) != saved):
+                continue
+            data = self._load(BOT, key, blob)
+            if data is not None:
+                bot_data[key] = data
+
+    def _latest(self, entry):
+        """Останнє значення запису, яке потрапить у БД: з буфера, з пакета в дорозі або збережене"""
+        if entry in self._pending:
+            return self._pending[entry]
+        if entry in self._in_flight:
+            return self._in_flight[entry]
+        return self._saved.get(entry)
+
+    def _stage(self, kind, key, blob):
+        """Покласти зміну в буфер, якщо вона відрізняється від того, що буде в БД"""
+        # Порівняння лише з _saved пропустило б повернення A→B→A, поки B ще пишеться
+        if self._latest((kind, key)) == blob:
+            return
+        self._pending[(kind, key)] = blob
+        # Application викликає update_* для всіх змінених записів разом (asyncio.gather);
+        # задача запуститься після них і запише весь пакет
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        async with self._write_lock:
+            batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            self._in_flight = batch
+            changed = [(kind, key, blob) for (kind, key), blob in batch.items() if blob is not None]
+            dropped = [(kind, key) for (kind, key), blob in batch.items() if blob is None]
+            try:
+                written = await run_db(save_conversation_state, changed, dropped)
+            finally:
+                self._in_flight = {}
+            if written:
+                for entry, blob in batch.items():
+                    if blob is None:
+                        self._saved.pop(entry, None)
+                    else:
+                        self._saved[entry] = blob
+            else:
+                # Повернемо в буфер, якщо за цей час не з'явилось новіших змін
+                for entry, blob in batch.items():
+                    self._pending.setdefault(entry, blob)
+                return
+        # Зміни, що надійшли під час запису, пишемо наступним пакетом
+        if self._pending:
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def flush(self):
+        """Дописати все, що лишилось у буфері (при зупинці бота і коли стан потрібен іншим воркерам)"""
+        if self._write_task is not None:
+            await self._write_task
+        # Під замком: дочекається пакета, запланованого задачею вище, і допише решту
+        await self._write_pending()
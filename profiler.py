@@ -0,0 +1,108 @@
+# profiler.py - Семплюючий профайлер для живого процесу бота
+#
+# Окремий потік раз на interval знімає стеки потоків event loop і робочих
+# потоків БД (sys._current_frames) — лише поки виконується хоча б один маршрут
+# handle_message або job (metrics.in_flight). Результат — collapsed stacks
+# ("кадр;кадр;... кількість"), які відкриваються в speedscope.app або flamegraph.pl.
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import metrics
+
+DEFAULT_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "10")) / 1000
+MAX_DEPTH = 64
+# Потоки, стеки яких потрапляють у профіль (назви з threading)
+SAMPLED_THREAD_PREFIXES = ("MainThread", "db_", "asyncio_")
+# Кадри очікування: потік простоює, семпл не рахується
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("thread.py", "_worker"),
+}
+
+class SamplingProfiler:
+    """Один сеанс профілювання: start() → stop() повертає Counter стеків"""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.time() - self.started_at
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if metrics.in_flight():
+                self._sample()
+
+    def _sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        self.samples += 1
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident, "")
+            if not name.startswith(SAMPLED_THREAD_PREFIXES):
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            # Робочі потоки БД зводимо в один корінь "db", щоб їх стеки складались разом
+            stack.append(name.split("_")[0] if name != "MainThread" else name)
+            self.stacks[";".join(reversed(stack))] += 1
+
+def collapse(stacks):
+    """Текст у форматі collapsed stacks, найчастіші стеки першими"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+def top_functions(stacks, limit=5):
+    """[(кадр, частка семплів, де він на вершині стека)] — де витрачається власний час"""
+    total = sum(stacks.values())
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    return [(frame, count / total) for frame, count in leaves.most_common(limit)] if total else []
+
+_session = None
+_session_lock = threading.Lock()
+
+def start_profiling(interval=DEFAULT_INTERVAL):
+    """Почати сеанс; False, якщо інший сеанс уже йде"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            return False
+        _session = SamplingProfiler(interval).start()
+        return True
+
+def stop_profiling():
+    """Зупинити сеанс і повернути профайлер з результатами (None, якщо сеансу не було)"""
+    global _session
+    with _session_lock:
+        session, _session = _session, None
+    if session is not None:
+        session.stop()
+    return session
+
+def is_profiling():
+    return _session is not None
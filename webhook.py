@@ -0,0 +1,74 @@
+# webhook.py - Прийом оновлень через webhook і розподіл між процесами-обробниками
+#
+# Головний процес приймає POST від Telegram і кладе оновлення в чергу воркера
+# user_id % кількість воркерів: усі оновлення одного користувача обробляє один
+# процес у порядку надходження, різні користувачі — паралельно в різних процесах.
+# Стан розмов спільний через SQLite (persistence.py). Кожен воркер піднімає свій
+# /metrics на локальному порту, головний процес зводить їх з міткою worker.
+import logging
+import multiprocessing
+from urllib.request import urlopen
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+def update_user_id(update):
+    """id користувача з JSON оновлення (message.from, callback_query.from тощо); 0, якщо його немає"""
+    for value in update.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user")
+            if isinstance(sender, dict):
+                return sender.get("id", 0)
+    return 0
+
+class WorkerPool:
+    """Процеси target(index, workers, updates, ready) і маршрутизація оновлень між ними.
+
+    target читає dict оновлень з updates до None і кладе в ready пару
+    (index, порт свого /metrics), коли готовий приймати оновлення.
+    """
+
+    def __init__(self, target, workers):
+        # spawn, а не fork: батьківський процес уже має відкриті з'єднання SQLite
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue() for _ in range(workers)]
+        self.ready = context.Queue()
+        self.processes = [
+            context.Process(target=target, args=(index, workers, queue, self.ready), name=f"worker-{index}")
+            for index, queue in enumerate(self.queues)
+        ]
+        self.metrics_ports = {}
+
+    def start(self, timeout=120):
+        for process in self.processes:
+            process.start()
+        for _ in self.processes:
+            index, port = self.ready.get(timeout=timeout)
+            self.metrics_ports[index] = port
+        logger.info(f"👷 Запущено {len(self.processes)} воркерів: {sorted(self.metrics_ports.items())}")
+
+    def dispatch(self, update):
+        """Передати оновлення (dict з JSON Telegram) воркеру його користувача"""
+        self.queues[update_user_id(update) % len(self.queues)].put(update)
+
+    def render_metrics(self):
+        """/metrics усіх воркерів одним текстом"""
+        texts = {}
+        for index, port in sorted(self.metrics_ports.items()):
+            try:
+                with urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+                    texts[str(index)] = response.read().decode("utf-8")
+            except Exception as e:
+                logger.error(f"Помилка render_metrics воркера {index}: {e}")
+        return metrics.merge(texts, "worker")
+
+    def stop(self, timeout=30):
+        """Дочекатися, поки воркери оброблять чергу і збережуть стан"""
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"⚠️ {process.name} не зупинився за {timeout} с")
+                process.terminate()